@@ -0,0 +1,156 @@
+"""
+Reads delta bundles directly from tar or zip archives, without extracting them to disk.
+
+Files in an archive are addressed by virtual paths below the path of the archive itself, e.g. delta.tar/data/p1.xml.
+Labels and inventories are read in a single pass over the archive. Data files are left in the archive, and streamed
+from it when they are copied into an integrated bundle. Compressed tar archives can be checked, but not integrated:
+without an index, each data file could only be reached by decompressing the archive from its start again.
+"""
+import io
+import logging
+import os
+import posixpath
+import tarfile
+import zipfile
+from typing import Dict, IO, List, Union
+
+import bundlewriter
+
+logger = logging.getLogger(__name__)
+
+# The magic numbers of the compressions that tarfile.open detects
+COMPRESSION_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")
+
+
+def is_archive(path: str) -> bool:
+    """Determines if the given path is a tar or zip archive, rather than a directory"""
+    return os.path.isfile(path) and (tarfile.is_tarfile(path) or zipfile.is_zipfile(path))
+
+
+def is_compressed_tar(path: str) -> bool:
+    """Determines if the given path is a compressed tar archive"""
+    if not os.path.isfile(path) or zipfile.is_zipfile(path) or not tarfile.is_tarfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(6).startswith(COMPRESSION_MAGIC)
+
+
+class ArchiveMember(bundlewriter.StreamSource):
+    """
+    A reference to a file inside an archive, which can be opened for streaming
+    """
+    def __init__(self, archive: "DeltaArchive", name: str):
+        self.archive = archive
+        self.name = name
+
+    def open(self) -> IO[bytes]:
+        return self.archive.open_member(self.name)
+
+    def size(self) -> int:
+        return self.archive.member_size(self.name)
+
+    def __repr__(self):
+        return f"{self.archive.path}!{self.name}"
+
+
+class DeltaArchive:
+    def __init__(self, path: str):
+        self.path = path
+        self.tar = None
+        self.zip = None
+        self.tar_members: Dict[str, tarfile.TarInfo] = {}
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+        else:
+            self.tar = tarfile.open(path)
+
+    def load(self) -> Dict[str, Union[bytes, ArchiveMember]]:
+        """
+        Reads the archive in a single pass. Labels and likely inventories are read into memory, and every other file is
+        recorded as a reference into the archive. Returns a source map from virtual path to contents or reference,
+        in archive order.
+        """
+        logger.info(f"Reading archive: {self.path}")
+        sources = {}
+        if self.zip:
+            for info in self.zip.infolist():
+                if not info.is_dir():
+                    name = _normalize(info.filename)
+                    sources[self.virtual_path(name)] = self.zip.read(info) if _is_metadata(name) else ArchiveMember(self, info.filename)
+        else:
+            for info in self.tar:
+                if info.isfile():
+                    name = _normalize(info.name)
+                    self.tar_members[info.name] = info
+                    sources[self.virtual_path(name)] = self.tar.extractfile(info).read() if _is_metadata(name) else ArchiveMember(self, info.name)
+        return sources
+
+    def open_member(self, name: str) -> IO[bytes]:
+        if self.zip:
+            return self.zip.open(name)
+        return self.tar.extractfile(self.tar_members[name])
+
+    def member_size(self, name: str) -> int:
+        if self.zip:
+            return self.zip.getinfo(name).file_size
+        return self.tar_members[name].size
+
+    def virtual_path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def close(self) -> None:
+        if self.zip:
+            self.zip.close()
+        if self.tar:
+            self.tar.close()
+
+
+def archives(sources: Dict[str, bundlewriter.Source]) -> List[DeltaArchive]:
+    """The archives that a source map refers to for files that are still in them"""
+    found = {}
+    for source in (sources or {}).values():
+        if isinstance(source, ArchiveMember):
+            found.setdefault(id(source.archive), source.archive)
+    return list(found.values())
+
+
+def check_integrable(sources: Dict[str, bundlewriter.Source]) -> None:
+    """Raises an exception if a source map refers to files in a compressed tar archive"""
+    for archive in archives(sources):
+        if is_compressed_tar(archive.path):
+            raise Exception(f"Cannot integrate from the compressed tar archive {archive.path}: each of its files could only be read by "
+                            f"decompressing it from the start. Use an uncompressed tar or zip archive, or extract it first.")
+
+
+def close_archives(sources: Dict[str, bundlewriter.Source]) -> None:
+    """Closes the archives that a source map refers to, once their files are no longer needed"""
+    for archive in archives(sources):
+        archive.close()
+
+
+def make_opener(sources: Dict[str, Union[bytes, ArchiveMember]]):
+    """
+    Creates a replacement for the builtin open() that opens files of a loaded archive by their virtual path, in text
+    mode, so that archive contents can be parsed exactly like files on disk.
+    """
+    def opener(path: str, newline: str = None) -> IO[str]:
+        source = sources.get(path)
+        if source is None:
+            raise FileNotFoundError(f"No such file in archive: {path}")
+        if isinstance(source, ArchiveMember):
+            with source.open() as f:
+                source = f.read()
+        return io.TextIOWrapper(io.BytesIO(source), encoding="utf-8", newline=newline)
+    return opener
+
+
+def _normalize(name: str) -> str:
+    return posixpath.normpath(name).lstrip("/")
+
+
+def _is_metadata(name: str) -> bool:
+    """
+    Labels and collection inventories are needed to load a bundle, and are read into memory up front
+    """
+    basename = posixpath.basename(name)
+    return basename.endswith(".xml") or basename.startswith("collection")
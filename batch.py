@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Runs readiness checks and integrations for many bundles in a single process.
+
+The manifest is a CSV file with one bundle per line:
+
+    previous_bundle_directory,delta_bundle_directory[,merged_bundle_directory]
+
+When the merged bundle directory is omitted, only the readiness check is performed. Blank lines and lines starting
+with # are ignored.
+"""
+import argparse
+import concurrent.futures
+import csv
+import logging
+import sys
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import archiveclient
+import bundleloader
+from ready import check_ready, summarize_errors
+from superseder import supersede
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchEntry:
+    previous_bundle_directory: str
+    delta_bundle_directory: str
+    merged_bundle_directory: Optional[str] = None
+
+
+@dataclass
+class BatchResult:
+    entry: BatchEntry
+    error_count: int = 0
+    warning_count: int = 0
+    summary: str = ""
+    integrated: bool = False
+    failure: Optional[str] = None
+    error_types: List[str] = field(default_factory=list)
+
+    def ok(self) -> bool:
+        return self.failure is None and self.error_count == 0
+
+
+def read_manifest(manifest_path: str) -> List[BatchEntry]:
+    """
+    Reads the (previous, delta, merged) triples from a batch manifest
+    """
+    entries = []
+    with open(manifest_path, newline="") as f:
+        for row in csv.reader(f):
+            row = [x.strip() for x in row]
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            if len(row) not in (2, 3):
+                raise Exception(f"Invalid manifest line, expected 2 or 3 columns: {','.join(row)}")
+            entries.append(BatchEntry(row[0], row[1], row[2] if len(row) == 3 and row[2] else None))
+    return entries
+
+
+def process_entry(entry: BatchEntry, jaxa: bool, dry: bool) -> BatchResult:
+    """
+    Checks a single delta bundle and integrates it if requested. Any failure is captured in the result rather than
+    raised, so that one bad bundle does not stop the rest of the batch.
+    """
+    result = BatchResult(entry)
+    delta_fullbundle = None
+    try:
+        previous_fullbundle = bundleloader.load_local_bundle(entry.previous_bundle_directory)
+        delta_fullbundle = bundleloader.load_local_bundle(entry.delta_bundle_directory)
+
+        issues = check_ready(previous_fullbundle, delta_fullbundle, jaxa)
+        result.error_count = len([x for x in issues if x.severity == "error"])
+        result.warning_count = len([x for x in issues if x.severity == "warning"])
+        result.summary = summarize_errors(issues)
+        result.error_types = sorted(set(x.error_type for x in issues if x.severity == "error"))
+
+        if not result.error_count and entry.merged_bundle_directory:
+            supersede(previous_fullbundle, delta_fullbundle, entry.merged_bundle_directory, dry, jaxa)
+            result.integrated = True
+    except Exception as e:
+        logger.exception(f"Failed to process {entry.delta_bundle_directory} against {entry.previous_bundle_directory}")
+        result.failure = f"{type(e).__name__}: {e}"
+    finally:
+        if delta_fullbundle is not None:
+            archiveclient.close_archives(delta_fullbundle.sources)
+    return result
+
+
+def run_batch(entries: List[BatchEntry], jaxa: bool, dry: bool, workers: int) -> List[BatchResult]:
+    """
+    Processes every manifest entry on a shared worker pool. At most `workers` bundles are in flight at once.
+    Results are returned in manifest order.
+    """
+    logger.info(f"Processing {len(entries)} bundles with {workers} workers")
+    if workers <= 1:
+        return [process_entry(entry, jaxa, dry) for entry in entries]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_entry, entry, jaxa, dry) for entry in entries]
+        results = []
+        for entry, future in zip(entries, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(f"Worker failed while processing {entry.delta_bundle_directory}")
+                results.append(BatchResult(entry, failure=f"{type(e).__name__}: {e}"))
+        return results
+
+
+def report_batch(results: List[BatchResult], report_path: str = None) -> None:
+    """
+    Logs a consolidated report for the whole batch, and optionally writes it as a CSV file
+    """
+    lines = []
+    for result in results:
+        entry = result.entry
+        if result.failure:
+            status = "FAILED"
+        elif result.error_count:
+            status = "NOT READY"
+        elif result.integrated:
+            status = "INTEGRATED"
+        else:
+            status = "READY"
+        lines.append(f"{status}: {entry.delta_bundle_directory} against {entry.previous_bundle_directory} - "
+                     f"errors: {result.error_count}, warnings: {result.warning_count}"
+                     + (f", {result.failure}" if result.failure else ""))
+        if result.summary:
+            lines.append(result.summary)
+
+    succeeded = len([x for x in results if x.ok()])
+    logger.info("Batch report:\n" + "\n".join(lines) + f"\nSucceeded: {succeeded}, Failed: {len(results) - succeeded}, Total: {len(results)}")
+
+    if report_path:
+        with open(report_path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["previous", "delta", "merged", "integrated", "errors", "warnings", "error_types", "failure"])
+            for result in results:
+                entry = result.entry
+                writer.writerow([entry.previous_bundle_directory, entry.delta_bundle_directory,
+                                 entry.merged_bundle_directory or "", result.integrated, result.error_count,
+                                 result.warning_count, ";".join(result.error_types), result.failure or ""])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("manifest", type=str)
+    parser.add_argument("-j", "--jaxa", action="store_true")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    parser.add_argument("-D", "--dry", action="store_true")
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-r", "--report", type=str)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(processName)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+    logger.info(f'Batch manifest: {args.manifest}')
+
+    entries = read_manifest(args.manifest)
+    results = run_batch(entries, args.jaxa, args.dry, args.workers)
+    report_batch(results, args.report)
+
+    return 0 if all(x.ok() for x in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
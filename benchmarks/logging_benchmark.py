@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measures the cost of logging in the per-product code paths of a readiness check and integration.
+
+Runs the filename consistency check, the inventory version increment check and the supersede report over a synthetic
+bundle, once with DEBUG logging (every per-product message is written, as all of them were before they were moved to
+DEBUG) and once with INFO logging (only progress and summaries are written). Reports the run time and log volume of
+each.
+
+    $ python benchmarks/logging_benchmark.py -n 200000
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import labeltypes
+import pds4
+import superseder
+import validator
+from lids import LidVid
+
+
+def make_products(count: int, vid: str, base: str) -> list:
+    products = []
+    for i in range(count):
+        lidvid = LidVid.assemble(f"urn:nasa:pds:bench:data:product_{i:08d}", vid)
+        label = labeltypes.ProductLabel(identification_area=labeltypes.IdentificationArea(lidvid, "data", None))
+        products.append(pds4.BasicProduct(label, label_path=f"{base}/data/product_{i:08d}.xml",
+                                          data_paths=[f"{base}/data/product_{i:08d}.dat"]))
+    return products
+
+
+def make_inventory(products: list) -> pds4.CollectionInventory:
+    return pds4.CollectionInventory(pds4.InventoryItem(p.lidvid(), "P") for p in products)
+
+
+def run(previous_products: list, delta_products: list) -> None:
+    previous_inventory = make_inventory(previous_products)
+    delta_inventory = make_inventory(delta_products)
+    validator.check_filename_consistency(previous_products, delta_products)
+    validator._check_dict_increment(previous_inventory.items, delta_inventory.items)
+    superseder.report_superseded([], previous_products, delta_products, "/previous", "/delta", "/merged")
+
+
+def measure(level: int, previous_products: list, delta_products: list) -> tuple:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logfile = os.path.join(tmpdir, "bench.log")
+        handler = logging.FileHandler(logfile)
+        handler.setFormatter(logging.Formatter('%(asctime)s;%(levelname)s;%(name)s; %(message)s'))
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(level)
+        start = time.perf_counter()
+        run(previous_products, delta_products)
+        elapsed = time.perf_counter() - start
+        handler.close()
+        root.handlers = []
+        return elapsed, os.path.getsize(logfile)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--products", type=int, default=100000)
+    args = parser.parse_args()
+
+    previous_products = make_products(args.products, "1.0", "/previous")
+    delta_products = make_products(args.products, "2.0", "/delta")
+
+    results = [(name, *measure(level, previous_products, delta_products))
+               for name, level in (("DEBUG (per-product)", logging.DEBUG), ("INFO (summaries)", logging.INFO))]
+
+    print(f"{args.products} products")
+    print(f"{'logging':<22}{'time (s)':>12}{'log size (MB)':>16}")
+    for name, elapsed, size in results:
+        print(f"{name:<22}{elapsed:>12.2f}{size / 1024 / 1024:>16.1f}")
+    (_, debug_time, debug_size), (_, info_time, info_size) = results
+    print(f"Saving: {100 * (1 - info_time / debug_time):.0f}% of run time, {100 * (1 - info_size / max(debug_size, 1)):.0f}% of log volume")
+
+
+if __name__ == "__main__":
+    main()
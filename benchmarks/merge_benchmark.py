@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measures merging collection inventories in the calling process against merging them in a pool of worker processes.
+
+Builds synthetic previous and delta collections, then merges them with superseder.generate_collections, once serially
+and once with a pool of workers. To show where the pool's time goes, it also times the parts of the pool path
+separately: packing the inventories into a shared catalog in the parent, and the merge, sort and md5 work that the
+workers do. The pool can only win when that work, divided among the available cores, saves more than the packing and
+the start of the workers cost; superseder.POOL_MIN_ROWS is set from where it does.
+
+    $ python benchmarks/merge_benchmark.py -c 4 -n 250000 -w 4
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bundlewriter
+import labeltypes
+import pds4
+import superseder
+from lids import LidVid
+from sharedcatalog import SharedCatalog
+
+LABEL = (b'<Product_Collection xmlns="http://pds.nasa.gov/pds4/pds/v1"><File_Area_Inventory><File><file_size>0</file_size>'
+         b'<md5_checksum>0</md5_checksum></File><Inventory><records>0</records></Inventory></File_Area_Inventory></Product_Collection>')
+
+
+def make_collection(index: int, vid: str, count: int, base: str) -> pds4.CollectionProduct:
+    lid = f"urn:nasa:pds:bench:data_{index:02d}"
+    label = labeltypes.ProductLabel(identification_area=labeltypes.IdentificationArea(LidVid.assemble(lid, vid), "data", None))
+    inventory = pds4.CollectionInventory(pds4.InventoryItem(LidVid.assemble(f"{lid}:product_{i:08d}", "1.0"), "P")
+                                         for i in range(count))
+    return pds4.CollectionProduct(label, inventory, label_path=f"{base}/data_{index:02d}/collection.xml",
+                                  inventory_path=f"{base}/data_{index:02d}/collection.csv")
+
+
+def make_delta_collection(previous: pds4.CollectionProduct, added: int) -> pds4.CollectionProduct:
+    lidvid = previous.lidvid()
+    label = labeltypes.ProductLabel(identification_area=labeltypes.IdentificationArea(lidvid.inc_major(), "data", None))
+    count = len(previous.inventory.items)
+    inventory = pds4.CollectionInventory(pds4.InventoryItem(LidVid.assemble(f"{lidvid.lid}:product_{i:08d}", "1.0"), "P")
+                                         for i in range(count, count + added))
+    directory = os.path.basename(os.path.dirname(previous.label_path))
+    return pds4.CollectionProduct(label, inventory, label_path=f"/delta/{directory}/collection.xml",
+                                  inventory_path=f"/delta/{directory}/collection.csv")
+
+
+def merge(previous_collections: list, delta_collections: list, workers: int) -> dict:
+    # The pool is measured however few rows there are, to find where it starts to win
+    superseder.POOL_MIN_ROWS = 0
+    writer = bundlewriter.VirtualWriter(dict((c.label_path, LABEL) for c in delta_collections))
+    superseder.generate_collections(previous_collections, delta_collections, "/previous", "/delta", "/merged", writer, workers)
+    return writer.files
+
+
+def worker_work(previous_collections: list, delta_collections: list) -> float:
+    """The merge, sort and md5 work that the pool moves into workers, timed in this process"""
+    with SharedCatalog.create(c for pair in zip(previous_collections, delta_collections) for c in pair) as catalog:
+        start = time.perf_counter()
+        for index in range(len(previous_collections)):
+            rows = superseder.merge_inventory_rows(catalog.inventory_rows(2 * index), catalog.inventory_rows(2 * index + 1))
+            hashlib.md5(("\r\n".join(rows) + "\r\n").encode("utf-8")).hexdigest()
+        return time.perf_counter() - start
+
+
+def timed(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--collections", type=int, default=4)
+    parser.add_argument("-n", "--products", type=int, default=250000, help="Products in each previous collection")
+    parser.add_argument("-a", "--added", type=int, default=1000, help="Products added to each collection by the delta")
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    previous_collections = [make_collection(i, "1.0", args.products, "/previous") for i in range(args.collections)]
+    delta_collections = [make_delta_collection(c, args.added) for c in previous_collections]
+
+    serial, serial_files = timed(merge, previous_collections, delta_collections, 1)
+    pool, pool_files = timed(merge, previous_collections, delta_collections, args.workers)
+    if serial_files != pool_files:
+        raise Exception("The pool wrote different files than the serial merge")
+    pack, catalog = timed(SharedCatalog.create, [c for pair in zip(previous_collections, delta_collections) for c in pair])
+    catalog.close()
+    work = worker_work(previous_collections, delta_collections)
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+    print(f"{args.collections} collections of {args.products} products, {args.added} added to each, {cores} cores available")
+    print(f"{'serial merge':<36}{serial:>10.3f}s")
+    print(f"{f'pool of {args.workers} workers':<36}{pool:>10.3f}s")
+    print(f"{'  packing the shared catalog':<36}{pack:>10.3f}s")
+    print(f"{'  worker merge, sort and md5, total':<36}{work:>10.3f}s")
+    print(f"{'  pool overhead':<36}{pool - pack - work / min(cores, args.workers, args.collections):>10.3f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
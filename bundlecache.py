@@ -0,0 +1,167 @@
+"""
+An in-memory cache of loaded bundles, for processes that check many delta bundles against the same previous bundles.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+import bundleloader
+import localclient
+import pds4
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 0
+
+
+@dataclass
+class CacheEntry:
+    fullbundle: pds4.FullBundle
+    signature: str
+    size: int
+    checked: float
+    directories: Dict[str, int]
+
+
+class BundleCache:
+    """
+    Keeps loaded bundles in memory, evicting the least recently used bundle once the memory budget is exceeded.
+
+    The memory used by a bundle is estimated from the size of the labels and inventories that were parsed to load it.
+    A cached bundle is reloaded if any of its labels or inventories have been added, removed or modified since it was
+    loaded. By default this is checked on every lookup, which takes a walk and a stat of the whole bundle.
+
+    With a check_interval, a lookup instead only compares the modification times of the bundle's directories, which
+    change when a file is added, removed or renamed, and the full check only runs when one of them has changed or
+    check_interval seconds have passed since the last one. Files that are modified in place leave their directory's
+    time alone, so until the next full check a stale bundle may be returned.
+    """
+    def __init__(self, memory_budget: int, check_interval: float = CHECK_INTERVAL):
+        self.memory_budget = memory_budget
+        self.check_interval = check_interval
+        self.entries: "collections.OrderedDict[str, CacheEntry]" = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.path_locks: Dict[str, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str) -> pds4.FullBundle:
+        """
+        Retrieves the bundle at the given path, loading it if it is not cached or has changed since it was loaded.
+        """
+        key = os.path.realpath(path)
+        with self._path_lock(key):
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry is not None and self._is_current(key, entry):
+                with self.lock:
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                    self.hits += 1
+                logger.info(f"Using cached bundle: {key}")
+                return entry.fullbundle
+
+            directories = directory_times(path) if self.check_interval > 0 else {}
+            fullbundle = bundleloader.load_local_bundle(path)
+            signature, size = bundle_signature(fullbundle)
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = CacheEntry(fullbundle, signature, size, time.monotonic(), directories)
+                self.entries.move_to_end(key)
+                self._evict(key)
+            return fullbundle
+
+    def invalidate(self, path: str) -> None:
+        """Removes the bundle at the given path from the cache"""
+        with self.lock:
+            self.entries.pop(os.path.realpath(path), None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "bundles": list(self.entries.keys()),
+                "size": sum(x.size for x in self.entries.values()),
+                "memory_budget": self.memory_budget,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _is_current(self, key: str, entry: CacheEntry) -> bool:
+        now = time.monotonic()
+        directories = entry.directories
+        if self.check_interval > 0:
+            directories_changed = not directories_unchanged(entry.directories)
+            if not directories_changed and now - entry.checked < self.check_interval:
+                return True
+            # The directory times are taken before the signature, so that a change made in between is seen next time
+            if directories_changed:
+                directories = directory_times(entry.fullbundle.path)
+        signature, _ = bundle_signature(entry.fullbundle)
+        if signature != entry.signature:
+            logger.info(f"Cached bundle has changed on disk, reloading: {key}")
+            return False
+        entry.checked = now
+        entry.directories = directories
+        return True
+
+    def _evict(self, keep: str) -> None:
+        total = sum(x.size for x in self.entries.values())
+        for key in list(self.entries.keys()):
+            if total <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            logger.info(f"Evicting cached bundle: {key}")
+            total -= self.entries.pop(key).size
+
+    def _path_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.path_locks.setdefault(key, threading.Lock())
+
+
+def directory_times(path: str) -> Dict[str, int]:
+    """The modification time of every directory below a bundle directory, including itself"""
+    times = {}
+    for dirpath, _, _ in os.walk(path):
+        try:
+            times[dirpath] = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            pass
+    return times
+
+
+def directories_unchanged(times: Dict[str, int]) -> bool:
+    """Determines if none of the given directories have been modified or removed since their times were taken"""
+    for dirpath, mtime in times.items():
+        try:
+            if os.stat(dirpath).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def bundle_signature(fullbundle: pds4.FullBundle) -> Tuple[str, int]:
+    """
+    Summarizes the labels and inventories below a bundle directory by their paths, sizes and modification times.
+    Returns the signature and the total size of the files.
+    """
+    scan = localclient.scan_directory(fullbundle.path, with_stats=True)
+    filepaths = set(scan.labels + scan.superseded_labels)
+    filepaths.update(c.inventory_path for c in fullbundle.collections if c.inventory_path)
+
+    digest = hashlib.md5()
+    size = 0
+    for filepath in sorted(filepaths):
+        stat = scan.stats.get(filepath)
+        if stat is None:
+            digest.update(f"{filepath}:missing\n".encode("utf-8"))
+            continue
+        size += stat.st_size
+        digest.update(f"{filepath}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest(), size
@@ -1,38 +1,148 @@
 import os.path
+from typing import Dict, List, Tuple
 
+import archiveclient
+import fingerprint
+import labelsniff
 import localclient
 import logging
 import pds4
+import throttle
+from progress import Progress
+from sampling import Sampler
 
 logger = logging.getLogger(__name__)
 
+PRODUCTS = "products"
 
-def load_local_bundle(path: str) -> pds4.FullBundle:
+
+def load_local_bundle(path: str, prune_superseded: bool = False, sampler: Sampler = None) -> pds4.FullBundle:
     """
-    Loads a bundle located at the given path on the filesystsm
+    Loads a bundle located at the given path on the filesystsm. The path may also be a tar or zip archive containing
+    the bundle, or a bundle fingerprint exported by fingerprint.py. If prune_superseded is set, SUPERSEDED directories
+    are not scanned, and the bundle will not include any previously superseded products.
+
+    If a sampler is given, only a sample of the basic product labels in each top-level directory is loaded. All bundle
+    and collection labels are still loaded.
+
+    The LIDVID index of the bundle is built as it is loaded.
     """
+    if fingerprint.is_fingerprint(path):
+        return _index(fingerprint.load_fingerprint(path))
+    if archiveclient.is_archive(path):
+        return _index(load_archive_bundle(path, sampler))
     logger.info(f'Loading bundle: {path}')
-    filepaths = localclient.get_file_paths(path)
-    label_paths = [x for x in filepaths if x.endswith(".xml")]
-
-    collections = [localclient.fetchcollection(path)
-                   for path in label_paths if is_collection(path) and not is_superseded(path)]
-    bundles = [localclient.fetchbundle(path)
-               for path in label_paths if is_bundle(path) and not is_superseded(path)]
-    products = [localclient.fetchproduct(path) for path in label_paths if is_basic(path) and not is_superseded(path)]
-
-    superseded_collections = [localclient.fetchcollection(path)
-                              for path in label_paths if is_collection(path) and is_superseded(path)]
-    superseded_bundles = [localclient.fetchbundle(path)
-                          for path in label_paths if is_bundle(path) and is_superseded(path)]
-    superseded_products = [localclient.fetchproduct(path)
-                           for path in label_paths if is_basic(path) and is_superseded(path)]
-
-    if len(bundles) == 0:
+    scan = localclient.scan_directory(path, prune_superseded=prune_superseded)
+    return _index(_load_bundle(path, sniff_labels(path, scan.labels + scan.superseded_labels), sampler=sampler))
+
+
+def _index(fullbundle: pds4.FullBundle) -> pds4.FullBundle:
+    index = fullbundle.lidvid_index()
+    logger.info(f"Indexed {len(index.labels)} product labels and {len(index.members) + len(index.secondary_members)} inventory entries")
+    return fullbundle
+
+
+def load_archive_bundle(archive_path: str, sampler: Sampler = None) -> pds4.FullBundle:
+    """
+    Loads a bundle from a tar or zip archive without extracting it. The files of the returned bundle have virtual
+    paths below the archive path, and are described by the source map of the bundle.
+    """
+    logger.info(f'Loading bundle from archive: {archive_path}')
+    archive = archiveclient.DeltaArchive(archive_path)
+    sources = archive.load()
+    if not archiveclient.archives(sources):
+        # Everything was read into memory, so nothing will be streamed from the archive later
+        archive.close()
+    opener = archiveclient.make_opener(sources)
+    labels = sniff_labels(archive_path, [x for x in sources.keys() if x.endswith(".xml")], opener)
+    bundle_labels = [x for x, kind in labels if kind == labelsniff.BUNDLE and not is_superseded(x)]
+    path = os.path.dirname(bundle_labels[0]) if bundle_labels else archive_path
+    fullbundle = _load_bundle(path, labels, opener, sampler)
+    fullbundle.sources = sources
+    return fullbundle
+
+
+def _load_bundle(path: str, labels: List[Tuple[str, str]], opener=throttle.open_file, sampler: Sampler = None) -> pds4.FullBundle:
+    """
+    Parses each label as the kind of product it was classified as by sniff_labels. A missing bundle label is reported
+    before any label is parsed.
+    """
+    collections, bundles, products = [], [], []
+    superseded_collections, superseded_bundles, superseded_products = [], [], []
+    if not any(kind == labelsniff.BUNDLE and not is_superseded(x) for x, kind in labels):
         raise Exception(f"Could not find bundle product in: {path}")
+    if sampler is not None:
+        labels = _sample_labels(path, labels, sampler)
+    progress = Progress(logger, f"Loading labels from {path}", len(labels))
+    for label_path, kind in labels:
+        progress.step()
+        superseded = is_superseded(label_path)
+        if kind == labelsniff.COLLECTION:
+            (superseded_collections if superseded else collections).append(localclient.fetchcollection(label_path, opener))
+        elif kind == labelsniff.BUNDLE:
+            (superseded_bundles if superseded else bundles).append(localclient.fetchbundle(label_path, opener))
+        else:
+            (superseded_products if superseded else products).append(localclient.fetchproduct(label_path, opener))
+
+    progress.done()
     return pds4.FullBundle(path, bundles, superseded_bundles, collections, superseded_collections, products, superseded_products)
 
 
+def sniff_labels(path: str, label_paths: List[str], opener=throttle.open_file) -> List[Tuple[str, str]]:
+    """
+    Classifies each label by sniffing its root element, returning (label path, kind) pairs. XML files that are not
+    PDS4 labels are skipped, but a PDS4 label of a product type that cannot be loaded is an error. Labels whose root
+    element is not near their start are classified by their names, and labels whose names do not match their product
+    type are reported, and classified as the type they declare.
+    """
+    labels = []
+    progress = Progress(logger, f"Sniffing labels in {path}", len(label_paths))
+    for label_path in label_paths:
+        progress.step()
+        sniff = labelsniff.sniff_label(label_path, opener)
+        named = labelsniff.COLLECTION if is_collection(label_path) else labelsniff.BUNDLE if is_bundle(label_path) else labelsniff.BASIC
+        kind = sniff.kind()
+        if kind is None and sniff.pds4 and sniff.root is not None:
+            raise Exception(f"Unknown product type: {label_path} has root element {sniff.root}")
+        if kind is None and sniff.root is not None:
+            logger.warning(f"Skipping {label_path}, which is not a PDS4 label: root element {sniff.root}")
+            continue
+        if kind is None:
+            logger.debug("Could not find the root element of %s, classifying it by name", label_path)
+            kind = named
+        elif kind != named:
+            logger.warning(f"Label {label_path} is named as a {named} label, but is a {sniff.root}")
+        labels.append((label_path, kind))
+    progress.done()
+    return labels
+
+
+def _sample_labels(path: str, labels: List[Tuple[str, str]], sampler: Sampler) -> List[Tuple[str, str]]:
+    """
+    Keeps the bundle and collection labels, and a sample of the current basic product labels of each top-level
+    directory, in their original order
+    """
+    strata: Dict[str, List[str]] = {}
+    for label_path, kind in labels:
+        if kind == labelsniff.BASIC and not is_superseded(label_path):
+            strata.setdefault(os.path.relpath(label_path, path).split(os.sep)[0], []).append(label_path)
+    sampled = set(x for stratum, members in strata.items() for x in sampler.sample(PRODUCTS, stratum, members))
+    logger.info(f"Sampled {sampler.describe(PRODUCTS)} from {len(strata)} directories of {path}")
+    return [(x, kind) for x, kind in labels if x in sampled or kind != labelsniff.BASIC or is_superseded(x)]
+
+
+def load_local_product(path: str) -> pds4.Pds4Product:
+    """
+    Loads a single product from the label at the given path, using the same classification as load_local_bundle
+    """
+    kind = labelsniff.sniff_label(path).kind() or (labelsniff.COLLECTION if is_collection(path) else labelsniff.BUNDLE if is_bundle(path) else None)
+    if kind == labelsniff.COLLECTION:
+        return localclient.fetchcollection(path)
+    if kind == labelsniff.BUNDLE:
+        return localclient.fetchbundle(path)
+    return localclient.fetchproduct(path)
+
+
 def is_basic(filepath: str) -> bool:
     """
     Determines if the product at the given path is a basic (non-collection or bundle) product.
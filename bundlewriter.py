@@ -0,0 +1,363 @@
+"""
+Destinations for the files produced by an integration.
+
+Integration only ever copies a file from an input bundle to a new path, or writes newly generated contents to a new
+path. The writers in this module decide what that means: the directory writer puts files on the filesystem, and the
+virtual writer only records where each file would have come from, so that an integrated bundle can be used as the
+input to another integration without ever being written out.
+
+Input bundles can themselves be virtual. Their files are described by a source map, which maps each virtual path to
+the path of a real file, the generated contents of the file, or an object that can be opened to stream the file (such
+as a member of an archive).
+"""
+import abc
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import shutil
+import sys
+import tarfile
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Union, IO, List, Optional
+
+import throttle
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+# Completed background copies are forgotten once this many are pending
+PURGE_PENDING = 1024
+
+class StreamSource(abc.ABC):
+    """A file that can only be read by streaming it, such as a member of an archive"""
+    @abc.abstractmethod
+    def open(self) -> IO[bytes]:
+        """Opens the file for reading"""
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        """The size of the file in bytes"""
+
+
+Source = Union[str, bytes, StreamSource]
+
+
+@dataclass
+class OutputRecord:
+    """How an output file was produced: copied from a source path, or written with contents that had the given md5"""
+    source: Optional[str] = None
+    checksum: Optional[str] = None
+
+
+class BundleWriter(abc.ABC):
+    dry = False
+    record: Optional[Dict[str, OutputRecord]] = None
+    # Whether operations on different output paths may be carried out from several threads at once
+    thread_safe = False
+
+    def __init__(self, sources: Dict[str, Source] = None):
+        self.sources = dict(sources) if sources else {}
+
+    def start_recording(self) -> None:
+        """
+        Keeps a record of how every output file is produced from now on, so that the output can be verified once the
+        integration is complete. Later operations on the same output path replace earlier ones.
+        """
+        self.record = {}
+
+    def add_sources(self, sources: Dict[str, Source]) -> None:
+        """Registers the source map of a virtual input bundle"""
+        if sources:
+            self.sources.update(sources)
+
+    def resolve(self, path: str) -> Source:
+        """Finds the real file or generated contents behind a path in an input bundle"""
+        return self.sources.get(path, path)
+
+    def read(self, path: str) -> bytes:
+        """Reads a file from an input bundle"""
+        return _read_source(self.resolve(path))
+
+    def exists(self, path: str) -> bool:
+        """Determines if a file exists in an input bundle"""
+        source = self.resolve(path)
+        return not isinstance(source, str) or os.path.exists(source)
+
+    @abc.abstractmethod
+    def copy(self, src_path: str, dest_path: str) -> None:
+        """Copies a file from an input bundle to the output"""
+
+    @abc.abstractmethod
+    def write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        """Writes generated contents to the output"""
+
+    @abc.abstractmethod
+    def read_output(self, dest_path: str) -> bytes:
+        """Reads back a file that was previously written to the output"""
+
+    def finish(self) -> None:
+        """Called once every file has been sent to the writer"""
+        pass
+
+    def defer(self, operation: str, arguments: Dict) -> bool:
+        """
+        Offers an operation that produces output files, such as a collection merge, to be carried out later by the
+        writer rather than now by the caller. The arguments list the output paths under "outputs". Returns False if
+        the caller should carry out the operation itself.
+        """
+        return False
+
+    def _record_copy(self, src_path: str, dest_path: str) -> None:
+        if self.record is not None:
+            self.record[dest_path] = OutputRecord(source=src_path)
+
+    def _record_write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        if self.record is not None:
+            self.record[dest_path] = OutputRecord(checksum=hashlib.md5(_encode(contents)).hexdigest())
+
+
+class DirectoryWriter(BundleWriter):
+    """
+    Writes the integrated bundle to a directory on the filesystem. In dry mode, operations are only logged.
+
+    If an I/O control is installed (see throttle.py), copies run in the background on its workers, within its bandwidth
+    and open file limits. Later operations on the same output path wait for an earlier copy to it, and finish waits
+    for every copy.
+    """
+    thread_safe = True
+
+    def __init__(self, dry: bool = False, sources: Dict[str, Source] = None):
+        super().__init__(sources)
+        self.dry = dry
+        self.pending: Dict[str, concurrent.futures.Future] = {}
+        self.purge_at = PURGE_PENDING
+        self.lock = threading.Lock()
+
+    def copy(self, src_path: str, dest_path: str) -> None:
+        logger.debug('%s -> %s', src_path, dest_path)
+        self._record_copy(src_path, dest_path)
+        if not self.dry:
+            source = self.resolve(src_path)
+            control = throttle.current()
+            if control is None:
+                _makedirs(dest_path)
+                _copy_source(source, dest_path)
+            else:
+                self._wait(dest_path)
+                future = control.submit(source_size(source), lambda: _copy_source(source, dest_path, control))
+                with self.lock:
+                    self.pending[dest_path] = future
+                    purge = len(self.pending) >= self.purge_at
+                if purge:
+                    self._purge()
+
+    def write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        self._record_write(dest_path, contents)
+        if not self.dry:
+            self._wait(dest_path)
+            control = throttle.current()
+            contents = _encode(contents)
+            _makedirs(dest_path)
+            with (control.hold_files() if control else contextlib.nullcontext()), open(dest_path, "wb") as f:
+                if control:
+                    control.charge(len(contents))
+                f.write(contents)
+        else:
+            logger.info(f"Skipped: Writing {dest_path}")
+
+    def read_output(self, dest_path: str) -> bytes:
+        self._wait(dest_path)
+        with open(dest_path, "rb") as f:
+            return f.read()
+
+    def finish(self) -> None:
+        self._purge()
+        if self.pending:
+            logger.info(f"Waiting for {len(self.pending)} copies to complete")
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for future in concurrent.futures.as_completed(pending.values()):
+                future.result()
+        control = throttle.current()
+        if control is not None and not self.dry:
+            logger.info(f"I/O: {control.summary()}")
+
+    def _purge(self) -> None:
+        """Forgets the copies that have completed, raising the error of any that failed"""
+        with self.lock:
+            done = [(dest_path, future) for dest_path, future in self.pending.items() if future.done()]
+            for dest_path, future in done:
+                del self.pending[dest_path]
+            self.purge_at = max(PURGE_PENDING, 2 * len(self.pending))
+        for dest_path, future in done:
+            future.result()
+
+    def _wait(self, dest_path: str) -> None:
+        with self.lock:
+            future = self.pending.pop(dest_path, None)
+        if future is not None:
+            future.result()
+
+
+class VirtualWriter(BundleWriter):
+    """
+    Records the integrated bundle in memory. Copied files are recorded by the path of their real source, so only
+    generated files occupy memory. The resulting file map can be used as the source map of a virtual bundle.
+    """
+    def __init__(self, sources: Dict[str, Source] = None):
+        super().__init__(sources)
+        self.files: Dict[str, Source] = {}
+
+    def copy(self, src_path: str, dest_path: str) -> None:
+        logger.debug('%s -> %s (virtual)', src_path, dest_path)
+        self._record_copy(src_path, dest_path)
+        self.files[dest_path] = self.resolve(src_path)
+
+    def write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        self._record_write(dest_path, contents)
+        self.files[dest_path] = _encode(contents)
+
+    def read_output(self, dest_path: str) -> bytes:
+        return _read_source(self.files[dest_path])
+
+
+class TarWriter(VirtualWriter):
+    """
+    Writes the integrated bundle as a tar archive, laid out exactly as the directory writer would lay out the
+    directory. Output files are recorded until the integration finishes, since later steps of an integration may
+    replace files written by earlier ones. The archive is then streamed in one pass, so it may be written to a pipe.
+    Only generated files are held in memory; every other file is streamed from its source.
+
+    The archive is compressed if its name ends with .gz, .tgz, .bz2 or .xz. Use - to write to stdout. Output paths are
+    placed in the archive relative to the merged bundle directory, which defaults to the archive path itself.
+    """
+    def __init__(self, tar_path: str, merged_bundle_directory: str = None, sources: Dict[str, Source] = None):
+        super().__init__(sources)
+        self.tar_path = tar_path
+        self.merged_bundle_directory = merged_bundle_directory or tar_path
+
+    def finish(self) -> None:
+        logger.info(f"Writing {len(self.files)} files to tar archive {self.tar_path}")
+        if self.tar_path == "-":
+            tar = tarfile.open(fileobj=sys.stdout.buffer, mode="w|")
+        else:
+            tar = tarfile.open(self.tar_path, mode=f"w|{_compression(self.tar_path)}")
+        with tar:
+            directories = set()
+            for dest_path, source in self.files.items():
+                arcname = os.path.relpath(dest_path, self.merged_bundle_directory)
+                for directory in _parents(arcname):
+                    if directory not in directories:
+                        directories.add(directory)
+                        tar.addfile(_tarinfo(directory, tarfile.DIRTYPE, 0o755))
+                if isinstance(source, str):
+                    tarinfo = tar.gettarinfo(source, arcname)
+                    with open(source, "rb") as f:
+                        tar.addfile(tarinfo, f)
+                elif isinstance(source, bytes):
+                    tarinfo = _tarinfo(arcname, tarfile.REGTYPE, 0o644, len(source))
+                    tar.addfile(tarinfo, io.BytesIO(source))
+                else:
+                    tarinfo = _tarinfo(arcname, tarfile.REGTYPE, 0o644, source.size())
+                    with source.open() as f:
+                        tar.addfile(tarinfo, f)
+                logger.debug('%s -> %s:%s', dest_path, self.tar_path, arcname)
+
+
+def _compression(tar_path: str) -> str:
+    if tar_path.endswith(".gz") or tar_path.endswith(".tgz"):
+        return "gz"
+    if tar_path.endswith(".bz2"):
+        return "bz2"
+    if tar_path.endswith(".xz"):
+        return "xz"
+    return ""
+
+
+def _parents(arcname: str) -> List[str]:
+    parents = []
+    directory = os.path.dirname(arcname)
+    while directory:
+        parents.insert(0, directory)
+        directory = os.path.dirname(directory)
+    return parents
+
+
+def _tarinfo(name: str, type: bytes, mode: int, size: int = 0) -> tarfile.TarInfo:
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.type = type
+    tarinfo.mode = mode
+    tarinfo.size = size
+    tarinfo.mtime = int(time.time())
+    return tarinfo
+
+
+def _copy_source(source: Source, dest_path: str, control: "throttle.IOControl" = None) -> None:
+    if control is None:
+        if isinstance(source, bytes):
+            with open(dest_path, "wb") as f:
+                f.write(source)
+        elif isinstance(source, str):
+            shutil.copy(source, dest_path)
+        else:
+            with source.open() as infile, open(dest_path, "wb") as outfile:
+                shutil.copyfileobj(infile, outfile)
+        return
+    _makedirs(dest_path)
+    with control.hold_files(2):
+        if isinstance(source, bytes):
+            with open(dest_path, "wb") as f:
+                control.charge(len(source))
+                f.write(source)
+            return
+        with (open(source, "rb") if isinstance(source, str) else source.open()) as infile, open(dest_path, "wb") as outfile:
+            control.copy_stream(infile, outfile)
+    if isinstance(source, str):
+        shutil.copymode(source, dest_path)
+
+
+def source_size(source: Source) -> int:
+    """The size in bytes of a source"""
+    if isinstance(source, bytes):
+        return len(source)
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return source.size()
+
+
+def source_checksum(source: Source) -> str:
+    """The md5 checksum of a source, read in chunks"""
+    if isinstance(source, bytes):
+        return hashlib.md5(source).hexdigest()
+    digest = hashlib.md5()
+    with (open(source, "rb") if isinstance(source, str) else source.open()) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_source(source: Source) -> bytes:
+    if isinstance(source, bytes):
+        return source
+    control = throttle.current()
+    with (control.hold_files() if control else contextlib.nullcontext()):
+        with (open(source, "rb") if isinstance(source, str) else source.open()) as f:
+            contents = f.read()
+    if control:
+        control.charge(len(contents))
+    return contents
+
+
+def _encode(contents: Union[str, bytes]) -> bytes:
+    return contents.encode("utf-8") if isinstance(contents, str) else contents
+
+
+def _makedirs(dest_path: str) -> None:
+    dirname = os.path.dirname(dest_path)
+    os.makedirs(dirname, exist_ok=True)
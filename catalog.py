@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+A catalog of every version of every product in a bundle, including the versions under SUPERSEDED directories.
+
+The catalog is an SQLite database that maps each LIDVID to the path of its label, the checksum of the label, its data
+files, the collection version that lists it and the bundle version that introduced it. Paths are relative to the bundle
+directory, so the same catalog follows the bundle from one integrated version to the next. Integration updates the
+catalog incrementally, so history lookups do not need to parse the SUPERSEDED directories.
+
+    $ catalog.py CATALOG build bundle_directory
+    $ catalog.py CATALOG history urn:nasa:pds:bundle:collection:product
+    $ catalog.py CATALOG show urn:nasa:pds:bundle:collection:product::1.0
+    $ catalog.py CATALOG introduced urn:nasa:pds:bundle::2.0
+    $ catalog.py CATALOG audit bundle_directory
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import bundlewriter
+import pds4
+import superseder
+import validator
+from lids import LidVid
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    lidvid TEXT PRIMARY KEY,
+    lid TEXT NOT NULL,
+    major INTEGER NOT NULL,
+    minor INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    label_path TEXT NOT NULL,
+    checksum TEXT,
+    collection TEXT,
+    bundle TEXT,
+    superseded INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_lid ON products (lid, major, minor);
+CREATE INDEX IF NOT EXISTS products_collection ON products (collection);
+CREATE INDEX IF NOT EXISTS products_bundle ON products (bundle);
+CREATE TABLE IF NOT EXISTS files (
+    lidvid TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (lidvid, path)
+);
+"""
+
+UPSERT = """
+INSERT INTO products (lidvid, lid, major, minor, kind, label_path, checksum, collection, bundle, superseded)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (lidvid) DO UPDATE SET
+    label_path = excluded.label_path,
+    checksum = excluded.checksum,
+    collection = COALESCE(excluded.collection, products.collection),
+    bundle = COALESCE(excluded.bundle, products.bundle),
+    superseded = excluded.superseded
+"""
+
+SELECT_CHUNK = 500
+
+
+@dataclass
+class CatalogEntry:
+    lidvid: str
+    kind: str
+    label_path: str
+    checksum: Optional[str]
+    collection: Optional[str]
+    bundle: Optional[str]
+    superseded: bool
+    files: List[str]
+
+
+class Catalog:
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get(self, lidvid: str) -> Optional[CatalogEntry]:
+        """Looks up a single version of a product"""
+        rows = self._select("WHERE lidvid = ?", (str(lidvid),))
+        return rows[0] if rows else None
+
+    def history(self, lid: str) -> List[CatalogEntry]:
+        """Lists every version of a product, oldest first"""
+        return self._select("WHERE lid = ? ORDER BY major, minor", (str(lid),))
+
+    def introduced_in(self, bundle_lidvid: str) -> List[CatalogEntry]:
+        """Lists the product versions that were introduced by a version of the bundle"""
+        return self._select("WHERE bundle = ? ORDER BY kind, lidvid", (str(bundle_lidvid),))
+
+    def members(self, collection_lidvid: str) -> List[CatalogEntry]:
+        """Lists the product versions that were first listed in the inventory of a version of a collection"""
+        return self._select("WHERE collection = ? ORDER BY lidvid", (str(collection_lidvid),))
+
+    def entries(self) -> List[CatalogEntry]:
+        return self._select("ORDER BY lid, major, minor", ())
+
+    def index_bundle(self, fullbundle: pds4.FullBundle) -> None:
+        """
+        Adds every product of a loaded bundle to the catalog. The collection of a product is the oldest collection
+        version whose inventory lists it. The bundle of a collection is only known if a bundle label references it by
+        LIDVID, and is otherwise left for integration to fill in.
+        """
+        logger.info(f"Indexing {fullbundle.path} into catalog {self.path}")
+        bundles = sorted(fullbundle.bundles + fullbundle.superseded_bundles, key=lambda x: x.lidvid().vid)
+        collections = sorted(fullbundle.collections + fullbundle.superseded_collections, key=lambda x: x.lidvid().vid)
+
+        bundle_of = {}
+        for bundle in bundles:
+            for entry in bundle.label.bundle_member_entries or []:
+                if entry.lidvid_reference:
+                    bundle_of.setdefault(entry.lidvid_reference, str(bundle.lidvid()))
+        collection_of = {}
+        for collection in collections:
+            if collection.inventory:
+                for lidvid in collection.inventory.products():
+                    collection_of.setdefault(str(lidvid), str(collection.lidvid()))
+
+        sources = fullbundle.sources or {}
+        with self.connection:
+            for p in bundles:
+                self._upsert(p, fullbundle.path, "bundle", None, str(p.lidvid()), _label_checksum(p, sources))
+            for p in collections:
+                self._upsert(p, fullbundle.path, "collection", None, bundle_of.get(str(p.lidvid())), _label_checksum(p, sources))
+            for p in fullbundle.products + fullbundle.superseded_products:
+                collection = collection_of.get(str(p.lidvid()))
+                self._upsert(p, fullbundle.path, "product", collection, bundle_of.get(collection), _label_checksum(p, sources))
+
+    def record_integration(self, previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle,
+                           merged_bundle_directory: str, writer: bundlewriter.BundleWriter = None) -> None:
+        """
+        Updates the catalog after a delta bundle has been integrated: superseded products are moved to their
+        SUPERSEDED paths, and the products of the delta bundle are added. The previous bundle is indexed first if the
+        catalog does not know it yet. If a writer is given, the checksums of regenerated collection labels are taken
+        from its output.
+        """
+        if self.get(previous_fullbundle.bundles[0].lidvid()) is None:
+            self.index_bundle(previous_fullbundle)
+
+        logger.info(f"Recording integration of {delta_fullbundle.path} in catalog {self.path}")
+        delta_bundle_lidvid = str(delta_fullbundle.bundles[0].lidvid())
+        collection_of = dict((str(lidvid), str(c.lidvid())) for c in delta_fullbundle.collections
+                             for lidvid in c.inventory.products())
+
+        def relocate(p: pds4.Pds4Product, base: str, superseded=False) -> pds4.Pds4Product:
+            return superseder.relocate_product(p, base, merged_bundle_directory, superseded)
+
+        with self.connection:
+            for previous_products, delta_products in ((previous_fullbundle.bundles, delta_fullbundle.bundles),
+                                                      (previous_fullbundle.collections, delta_fullbundle.collections),
+                                                      (previous_fullbundle.products, delta_fullbundle.products)):
+                _, to_supersede, _ = superseder.find_products_to_supersede(previous_products, delta_products)
+                for p in to_supersede:
+                    self._move(relocate(p, previous_fullbundle.path, True), merged_bundle_directory)
+
+            delta_sources = delta_fullbundle.sources or {}
+            for p in delta_fullbundle.bundles:
+                checksum = None
+                if writer is not None and not writer.dry:
+                    # The bundle label may have been edited, e.g. to add missing collections in JAXA mode
+                    checksum = hashlib.md5(writer.read_output(relocate(p, delta_fullbundle.path).label_path)).hexdigest()
+                self._upsert(relocate(p, delta_fullbundle.path), merged_bundle_directory, "bundle", None, delta_bundle_lidvid,
+                             checksum or _label_checksum(p, delta_sources))
+            for p in delta_fullbundle.collections:
+                merged = relocate(p, delta_fullbundle.path)
+                checksum = None
+                if writer is not None and not writer.dry:
+                    checksum = hashlib.md5(writer.read_output(merged.label_path)).hexdigest()
+                self._upsert(merged, merged_bundle_directory, "collection", None, delta_bundle_lidvid, checksum)
+            for p in delta_fullbundle.products:
+                self._upsert(relocate(p, delta_fullbundle.path), merged_bundle_directory, "product",
+                             collection_of.get(str(p.lidvid())), delta_bundle_lidvid, _label_checksum(p, delta_sources))
+
+    def audit(self, bundle_directory: str) -> List[validator.ValidationError]:
+        """
+        Checks that every cataloged file exists below the bundle directory, and that every label still has its
+        cataloged checksum
+        """
+        errors = []
+        for entry in self.entries():
+            label_path = os.path.join(bundle_directory, entry.label_path)
+            if not os.path.isfile(label_path):
+                errors.append(validator.ValidationError(f"Label of {entry.lidvid} is missing: {label_path}", "catalog_file_missing"))
+                continue
+            if entry.checksum:
+                with open(label_path, "rb") as f:
+                    checksum = hashlib.md5(f.read()).hexdigest()
+                if checksum != entry.checksum:
+                    errors.append(validator.ValidationError(f"Label of {entry.lidvid} has checksum {checksum}, "
+                                                            f"but the catalog has {entry.checksum}: {label_path}", "catalog_checksum_mismatch"))
+            for path in entry.files:
+                if not os.path.isfile(os.path.join(bundle_directory, path)):
+                    errors.append(validator.ValidationError(f"File of {entry.lidvid} is missing: {path}", "catalog_file_missing"))
+        return errors
+
+    def _upsert(self, p: pds4.Pds4Product, base: str, kind: str, collection: Optional[str], bundle: Optional[str],
+                checksum: Optional[str]) -> None:
+        lidvid = p.lidvid()
+        self.connection.execute(UPSERT, (
+            str(lidvid), str(lidvid.lid), lidvid.vid.major, lidvid.vid.minor, kind,
+            os.path.relpath(p.label_path, base), checksum, collection, bundle,
+            int("SUPERSEDED" in p.label_path)))
+        self._set_files(str(lidvid), _product_files(p), base)
+
+    def _move(self, p: pds4.Pds4Product, base: str) -> None:
+        lidvid = str(p.lidvid())
+        self.connection.execute("UPDATE products SET label_path = ?, superseded = 1 WHERE lidvid = ?",
+                                (os.path.relpath(p.label_path, base), lidvid))
+        self._set_files(lidvid, _product_files(p), base)
+
+    def _set_files(self, lidvid: str, paths: Iterable[str], base: str) -> None:
+        self.connection.execute("DELETE FROM files WHERE lidvid = ?", (lidvid,))
+        self.connection.executemany("INSERT OR IGNORE INTO files (lidvid, path) VALUES (?, ?)",
+                                    ((lidvid, os.path.relpath(x, base)) for x in paths))
+
+    def _select(self, where: str, parameters: tuple) -> List[CatalogEntry]:
+        rows = self.connection.execute(
+            "SELECT lidvid, kind, label_path, checksum, collection, bundle, superseded FROM products " + where,
+            parameters).fetchall()
+        files: Dict[str, List[str]] = dict((row[0], []) for row in rows)
+        lidvids = list(files.keys())
+        # Looked up through the primary key of the files table, in chunks that stay below SQLite's parameter limit
+        for start in range(0, len(lidvids), SELECT_CHUNK):
+            chunk = lidvids[start:start + SELECT_CHUNK]
+            query = self.connection.execute(
+                f"SELECT lidvid, path FROM files WHERE lidvid IN ({','.join('?' * len(chunk))}) ORDER BY lidvid, path", chunk)
+            for lidvid, path in query:
+                files[lidvid].append(path)
+        return [CatalogEntry(lidvid, kind, label_path, checksum, collection, bundle, bool(superseded), files[lidvid])
+                for lidvid, kind, label_path, checksum, collection, bundle, superseded in rows]
+
+
+def _label_checksum(p: pds4.Pds4Product, sources: Dict[str, bundlewriter.Source]) -> Optional[str]:
+    """
+    The md5 checksum of the raw bytes of a label, as audit computes it. The checksum in the parsed label is computed
+    from the decoded text instead, which differs for labels with CRLF line endings.
+    """
+    source = sources.get(p.label_path, p.label_path)
+    if isinstance(source, str) and not os.path.isfile(source):
+        return None
+    return bundlewriter.source_checksum(source)
+
+
+def _product_files(p: pds4.Pds4Product) -> List[str]:
+    """The files of a product other than its label"""
+    if isinstance(p, pds4.CollectionProduct):
+        return [p.inventory_path] if p.inventory_path else []
+    if isinstance(p, pds4.BundleProduct):
+        return [p.readme_path] if p.readme_path else []
+    if isinstance(p, pds4.BasicProduct):
+        return p.data_paths or []
+    return []
+
+
+def report(entries: List[CatalogEntry]) -> None:
+    for entry in entries:
+        logger.info(f"{entry.lidvid} ({entry.kind}{', superseded' if entry.superseded else ''}): {entry.label_path} "
+                    f"checksum={entry.checksum} collection={entry.collection} bundle={entry.bundle}")
+        for path in entry.files:
+            logger.info(f"    {path}")
+
+
+def main() -> int:
+    import bundleloader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("catalog", type=str)
+    parser.add_argument("command", choices=["build", "history", "show", "introduced", "members", "audit"])
+    parser.add_argument("argument", type=str, help="A bundle directory for build and audit, otherwise a LID or LIDVID")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    catalog = Catalog(args.catalog)
+    try:
+        if args.command == "build":
+            catalog.index_bundle(bundleloader.load_local_bundle(args.argument))
+        elif args.command == "history":
+            report(catalog.history(args.argument))
+        elif args.command == "show":
+            entry = catalog.get(str(LidVid.parse(args.argument)))
+            if entry is None:
+                logger.error(f"Not in catalog: {args.argument}")
+                return 1
+            report([entry])
+        elif args.command == "introduced":
+            report(catalog.introduced_in(args.argument))
+        elif args.command == "members":
+            report(catalog.members(args.argument))
+        else:
+            errors = catalog.audit(args.argument)
+            logger.info(f"Audit found {len(errors)} problems")
+            return 1 if errors else 0
+    finally:
+        catalog.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
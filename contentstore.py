@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Content-addressed storage for integrated bundles.
+
+Every file of an integrated bundle is stored once, under its md5 checksum, in a store directory. The bundle directory
+itself is made of links into the store, so keeping many versions of a bundle costs roughly one copy of the bundle plus
+the new files of each delta.
+
+Each bundle written into the store has a manifest listing the checksum of each of its files. A stored file is
+referenced once by each manifest that lists it, and garbage collection removes the files that are no longer
+referenced by the manifest of any bundle that still exists.
+
+    $ contentstore.py STORE gc
+    $ contentstore.py STORE stats
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+from typing import Dict, IO, Tuple, Union, Optional
+
+import bundlewriter
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ContentStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.manifests_path = os.path.join(path, "manifests")
+        self.tmp_path = os.path.join(path, "tmp")
+        for directory in (self.objects_path, self.manifests_path, self.tmp_path):
+            os.makedirs(directory, exist_ok=True)
+        self.inodes: Optional[Dict[Tuple[int, int], str]] = None
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def add_stream(self, stream: IO[bytes]) -> str:
+        """
+        Adds the contents of a stream to the store, hashing it while it is copied. Returns the md5 checksum.
+        """
+        digest = hashlib.md5()
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_path)
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    outfile.write(chunk)
+            return self._commit(tmp_path, digest.hexdigest())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def add_bytes(self, contents: bytes) -> str:
+        digest = hashlib.md5(contents).hexdigest()
+        if not os.path.exists(self.object_path(digest)):
+            fd, tmp_path = tempfile.mkstemp(dir=self.tmp_path)
+            with os.fdopen(fd, "wb") as outfile:
+                outfile.write(contents)
+            self._commit(tmp_path, digest)
+        return digest
+
+    def add_file(self, path: str) -> str:
+        """
+        Adds a file to the store. Files that are already links into the store are recognized without being hashed.
+        """
+        digest = self.lookup(path)
+        if digest:
+            return digest
+        with open(path, "rb") as f:
+            return self.add_stream(f)
+
+    def lookup(self, path: str) -> Optional[str]:
+        """
+        Finds the checksum of a file that is a hard or symbolic link to a stored file, without reading it
+        """
+        if os.path.islink(path):
+            target = os.path.realpath(path)
+            if os.path.dirname(os.path.dirname(target)) == os.path.realpath(self.objects_path):
+                return os.path.basename(target)
+        stat = os.stat(path)
+        if stat.st_nlink > 1:
+            if self.inodes is None:
+                self.inodes = dict(((s.st_dev, s.st_ino), digest) for digest, s in self.objects())
+            return self.inodes.get((stat.st_dev, stat.st_ino))
+        return None
+
+    def link(self, digest: str, dest_path: str, symlink: bool = False) -> None:
+        """
+        Materializes a stored file at the destination path, replacing anything that is already there. Falls back to a
+        symbolic link if a hard link cannot be made, e.g. because the store is on another filesystem.
+        """
+        object_path = self.object_path(digest)
+        tmp_dest = f"{dest_path}.madi-tmp"
+        if os.path.lexists(tmp_dest):
+            os.remove(tmp_dest)
+        if symlink:
+            os.symlink(os.path.abspath(object_path), tmp_dest)
+        else:
+            try:
+                os.link(object_path, tmp_dest)
+            except OSError:
+                os.symlink(os.path.abspath(object_path), tmp_dest)
+        os.replace(tmp_dest, dest_path)
+
+    def write_manifest(self, bundle_path: str, files: Dict[str, str]) -> None:
+        """
+        Records the checksum of every file of a bundle, as paths relative to the bundle directory
+        """
+        bundle_path = os.path.realpath(bundle_path)
+        manifest_path = os.path.join(self.manifests_path, hashlib.md5(bundle_path.encode("utf-8")).hexdigest() + ".md5")
+        with open(manifest_path, "w") as f:
+            f.write(f"# {bundle_path}\n")
+            for relpath, digest in sorted(files.items()):
+                f.write(f"{digest}  {relpath}\n")
+        logger.info(f"Wrote content store manifest for {bundle_path} with {len(files)} files")
+
+    def refcounts(self, remove_missing: bool = False) -> Dict[str, int]:
+        """
+        Counts the manifests that reference each stored file. Manifests of bundles that no longer exist are ignored,
+        and deleted if remove_missing is set.
+        """
+        counts = dict((digest, 0) for digest, _ in self.objects())
+        for filename in os.listdir(self.manifests_path):
+            manifest_path = os.path.join(self.manifests_path, filename)
+            with open(manifest_path) as f:
+                bundle_path = f.readline()[2:].rstrip("\n")
+                if not os.path.isdir(bundle_path):
+                    logger.info(f"Bundle no longer exists: {bundle_path}")
+                    if remove_missing:
+                        os.remove(manifest_path)
+                    continue
+                for digest in set(line.split("  ", 1)[0] for line in f):
+                    counts[digest] = counts.get(digest, 0) + 1
+        return counts
+
+    def gc(self, dry: bool = False) -> Tuple[int, int]:
+        """
+        Removes stored files that are not referenced by any existing bundle. Files that still have hard links outside
+        of the store are kept. Returns the number of files and bytes removed.
+        """
+        counts = self.refcounts(remove_missing=not dry)
+        removed, removed_bytes = 0, 0
+        for digest, stat in self.objects():
+            if counts.get(digest, 0) == 0 and stat.st_nlink <= 1:
+                logger.debug("Removing unreferenced object %s", digest)
+                removed += 1
+                removed_bytes += stat.st_size
+                if not dry:
+                    os.remove(self.object_path(digest))
+        logger.info(f"{'Would remove' if dry else 'Removed'} {removed} unreferenced files ({removed_bytes} bytes)")
+        return removed, removed_bytes
+
+    def _commit(self, tmp_path: str, digest: str) -> str:
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+        return digest
+
+    def objects(self):
+        """Lists the checksum and stat result of every stored file"""
+        with os.scandir(self.objects_path) as prefixes:
+            for prefix in prefixes:
+                if prefix.is_dir():
+                    with os.scandir(prefix.path) as entries:
+                        for entry in entries:
+                            yield entry.name, entry.stat()
+
+
+class ContentStoreWriter(bundlewriter.DirectoryWriter):
+    """
+    Writes the integrated bundle as links into a content store. New files are hashed while they are copied into the
+    store. Files of the previous bundle that are already links into the store are linked again without being read.
+    """
+    thread_safe = False
+
+    def __init__(self, store: ContentStore, merged_bundle_directory: str, symlink: bool = False, dry: bool = False, sources: Dict[str, bundlewriter.Source] = None):
+        super().__init__(dry, sources)
+        self.store = store
+        self.merged_bundle_directory = merged_bundle_directory
+        self.symlink = symlink
+        self.files: Dict[str, str] = {}
+
+    def copy(self, src_path: str, dest_path: str) -> None:
+        logger.debug('%s -> %s (content store)', src_path, dest_path)
+        self._record_copy(src_path, dest_path)
+        if not self.dry:
+            source = self.resolve(src_path)
+            if isinstance(source, bytes):
+                digest = self.store.add_bytes(source)
+            elif isinstance(source, str):
+                digest = self.store.add_file(source)
+            else:
+                with source.open() as f:
+                    digest = self.store.add_stream(f)
+            self._link(digest, dest_path)
+
+    def write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        self._record_write(dest_path, contents)
+        if not self.dry:
+            self._link(self.store.add_bytes(contents.encode("utf-8") if isinstance(contents, str) else contents), dest_path)
+        else:
+            logger.info(f"Skipped: Writing {dest_path}")
+
+    def finish(self) -> None:
+        if not self.dry:
+            self.store.write_manifest(self.merged_bundle_directory, self.files)
+
+    def _link(self, digest: str, dest_path: str) -> None:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        self.store.link(digest, dest_path, self.symlink)
+        self.files[os.path.relpath(dest_path, self.merged_bundle_directory)] = digest
+
+
+def default_store_path(merged_bundle_directory: str) -> str:
+    """The default location of the store, next to the integrated bundle"""
+    return os.path.join(os.path.dirname(os.path.abspath(merged_bundle_directory)), ".madi-store")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store", type=str)
+    parser.add_argument("command", choices=["gc", "stats"])
+    parser.add_argument("-D", "--dry", action="store_true")
+    parser.add_argument("-d", "--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    store = ContentStore(args.store)
+    if args.command == "gc":
+        store.gc(args.dry)
+    else:
+        counts = store.refcounts()
+        total = sum(stat.st_size for _, stat in store.objects())
+        logger.info(f"{len(counts)} stored files ({total} bytes), "
+                    f"{len([x for x in counts.values() if x == 0])} unreferenced, "
+                    f"{len(os.listdir(store.manifests_path))} bundle manifests")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
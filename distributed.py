@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Distributes the file operations of an integration across worker processes through a queue directory on shared storage.
+
+The coordinator (main.py with --queue) checks readiness and plans the integration as usual, but instead of writing the
+integrated bundle it writes the work to the queue directory: batches of file copies and generated files, and one task
+for each collection whose inventory has to be merged and whose label has to be rewritten. Workers on any host that
+mounts the queue directory, the bundles and the integrated bundle directory at the same paths claim tasks and carry
+them out:
+
+    $ distributed.py worker QUEUE
+    $ distributed.py status QUEUE
+
+The queue needs nothing but a filesystem with atomic renames. Its directories hold the tasks waiting to be claimed
+(tasks), the tasks that are being worked on (leases), and those that are done or have failed (done, failed). A worker
+claims a task by renaming it into leases, and renews its lease by touching the lease file while it works. A lease that
+has not been renewed for the lease time is expired, and is renamed back into tasks by the coordinator or any worker,
+so that the task is picked up again if its worker died. Every task writes its output files atomically, so a task that
+is carried out twice, because its lease expired while its worker was still busy, produces the same result.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple, Union
+
+import bundlewriter
+import localclient
+import superseder
+import validator
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60.0
+POLL_SECONDS = 0.5
+BATCH_SIZE = 256
+MAX_ATTEMPTS = 3
+
+COPY = "copy"
+WRITE = "write"
+
+Task = Dict[str, Union[str, int, list, dict]]
+
+
+class WorkQueue:
+    """A queue of integration tasks kept in a directory on shared storage"""
+    def __init__(self, path: str, lease_seconds: float = LEASE_SECONDS):
+        self.path = os.path.abspath(path)
+        self.lease_seconds = lease_seconds
+        self.tasks = os.path.join(self.path, "tasks")
+        self.leases = os.path.join(self.path, "leases")
+        self.done = os.path.join(self.path, "done")
+        self.failed = os.path.join(self.path, "failed")
+        self.payload = os.path.join(self.path, "payload")
+        self.job_path = os.path.join(self.path, "job.json")
+        self.sealed_path = os.path.join(self.path, "sealed")
+
+    def create(self, job: Dict) -> None:
+        """Sets up an empty queue for a new integration"""
+        if os.path.exists(self.job_path):
+            raise Exception(f"Queue directory is already in use: {self.path}")
+        for directory in (self.tasks, self.leases, self.done, self.failed, self.payload):
+            os.makedirs(directory, exist_ok=True)
+        _write_json(self.job_path, job)
+
+    def put(self, task_id: str, task: Task) -> None:
+        _write_json(os.path.join(self.tasks, task_id + ".json"), task)
+
+    def put_payload(self, name: str, contents: bytes) -> str:
+        path = os.path.join(self.payload, name)
+        _write_atomically(path, contents)
+        return path
+
+    def seal(self) -> None:
+        """Marks the queue as complete, so that workers stop once it is empty"""
+        _write_json(self.sealed_path, {"sealed": time.time()})
+
+    def sealed(self) -> bool:
+        return os.path.exists(self.sealed_path)
+
+    def claim(self) -> Optional[Tuple[str, Task]]:
+        """Claims the first task that is waiting, or returns None if there is none"""
+        for name in sorted(_listdir(self.tasks)):
+            task_path = os.path.join(self.tasks, name)
+            lease_path = os.path.join(self.leases, name)
+            try:
+                # The lease starts when the task is touched, since renaming it keeps its modification time
+                os.utime(task_path)
+                os.rename(task_path, lease_path)
+                with open(lease_path) as f:
+                    return name[:-len(".json")], json.load(f)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def renew(self, task_id: str) -> bool:
+        """Extends the lease on a task. Returns False if the lease was lost."""
+        try:
+            os.utime(os.path.join(self.leases, task_id + ".json"))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, task_id: str) -> bool:
+        """Records a claimed task as done. Returns False if the lease had expired and the task was reclaimed."""
+        return _move(os.path.join(self.leases, task_id + ".json"), os.path.join(self.done, task_id + ".json"))
+
+    def fail(self, task_id: str, task: Task, error: str) -> bool:
+        """
+        Returns a task that failed to the queue to be tried again, or records it as failed after MAX_ATTEMPTS. Returns
+        False if the lease had expired and the task was reclaimed, in which case the failure is dropped.
+        """
+        # The lease is taken out of the leases directory first, so that it cannot be reclaimed while the task is
+        # written back
+        lease_path = os.path.join(self.leases, task_id + ".json")
+        private_path = _temporary(lease_path)
+        if not _move(lease_path, private_path):
+            return False
+        task = dict(task, attempts=task.get("attempts", 0) + 1, error=error)
+        retry = task["attempts"] < MAX_ATTEMPTS
+        _write_json(os.path.join(self.tasks if retry else self.failed, task_id + ".json"), task)
+        os.remove(private_path)
+        return True
+
+    def reclaim_expired(self) -> int:
+        """Returns the tasks whose leases have expired to the queue. Returns the number of tasks reclaimed."""
+        reclaimed = 0
+        now = time.time()
+        for name in _listdir(self.leases):
+            lease_path = os.path.join(self.leases, name)
+            try:
+                expired = now - os.path.getmtime(lease_path) > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if expired and _move(lease_path, os.path.join(self.tasks, name)):
+                logger.warning(f"Reclaimed expired lease on task {name[:-len('.json')]}")
+                reclaimed += 1
+        return reclaimed
+
+    def counts(self) -> Dict[str, int]:
+        return dict((name, len(_listdir(os.path.join(self.path, name)))) for name in ("tasks", "leases", "done", "failed"))
+
+    def finished(self) -> bool:
+        counts = self.counts()
+        return self.sealed() and counts["tasks"] == 0 and counts["leases"] == 0
+
+    def failures(self) -> List[Tuple[str, Task]]:
+        failures = []
+        for name in sorted(_listdir(self.failed)):
+            with open(os.path.join(self.failed, name)) as f:
+                failures.append((name[:-len(".json")], json.load(f)))
+        return failures
+
+
+class QueueWriter(bundlewriter.VirtualWriter):
+    """
+    Plans an integration into a work queue. Output files are recorded until the integration finishes, since later
+    steps of an integration may replace files written by earlier ones, and collection merges are taken over as tasks of
+    their own. The recorded work is then written to the queue in batches.
+    """
+    def __init__(self, queue: WorkQueue, merged_bundle_directory: str, batch_size: int = BATCH_SIZE, sources: Dict[str, bundlewriter.Source] = None):
+        super().__init__(sources)
+        self.queue = queue
+        self.merged_bundle_directory = merged_bundle_directory
+        self.batch_size = batch_size
+        self.merges: List[Dict] = []
+
+    def defer(self, operation: str, arguments: Dict) -> bool:
+        if operation != superseder.MERGE_COLLECTION:
+            return False
+        for output in arguments["outputs"]:
+            self.files.pop(output, None)
+        self.merges.append(arguments)
+        return True
+
+    def finish(self) -> None:
+        self.queue.create({"merged_bundle_directory": os.path.abspath(self.merged_bundle_directory), "created": time.time()})
+        sequence = 0
+
+        def put(task: Task) -> None:
+            nonlocal sequence
+            self.queue.put(f"{sequence:08d}", task)
+            sequence += 1
+
+        # Merges come first, since they are the longest tasks
+        for merge in self.merges:
+            put({"kind": superseder.MERGE_COLLECTION, "arguments": dict((k, _absolute(v)) for k, v in merge.items())})
+
+        batch = []
+        for dest_path, source in self.files.items():
+            if isinstance(source, str):
+                batch.append({"op": COPY, "source": os.path.abspath(source), "dest": os.path.abspath(dest_path)})
+            else:
+                payload = self.queue.put_payload(f"{uuid.uuid4().hex}", bundlewriter._read_source(source))
+                batch.append({"op": WRITE, "source": payload, "dest": os.path.abspath(dest_path)})
+            if len(batch) >= self.batch_size:
+                put({"kind": "files", "operations": batch})
+                batch = []
+        if batch:
+            put({"kind": "files", "operations": batch})
+        self.queue.seal()
+        logger.info(f"Queued {sequence} tasks for {len(self.files)} files and {len(self.merges)} collection merges in {self.queue.path}")
+
+
+class AtomicWriter(bundlewriter.DirectoryWriter):
+    """Writes each output file to a temporary file first, so that a task carried out twice cannot corrupt its outputs"""
+    def copy(self, src_path: str, dest_path: str) -> None:
+        bundlewriter._makedirs(dest_path)
+        temporary_path = _temporary(dest_path)
+        shutil.copy(self.resolve(src_path), temporary_path)
+        os.replace(temporary_path, dest_path)
+
+    def write(self, dest_path: str, contents: Union[str, bytes]) -> None:
+        bundlewriter._makedirs(dest_path)
+        _write_atomically(dest_path, bundlewriter._encode(contents))
+
+
+def execute(task: Task) -> None:
+    """Carries out one task"""
+    writer = AtomicWriter()
+    if task["kind"] == superseder.MERGE_COLLECTION:
+        arguments = task["arguments"]
+        logger.info(f"Merging collection {arguments['delta_label_path']}")
+        superseder.generate_collection(localclient.fetchcollection(arguments["previous_label_path"]),
+                                       localclient.fetchcollection(arguments["delta_label_path"]),
+                                       arguments["previous_bundle_directory"], arguments["delta_bundle_directory"],
+                                       arguments["merged_bundle_directory"], writer)
+    elif task["kind"] == "files":
+        for operation in task["operations"]:
+            writer.copy(operation["source"], operation["dest"])
+    else:
+        raise Exception(f"Unknown task: {task['kind']}")
+
+
+def run_worker(queue_path: str, lease_seconds: float = LEASE_SECONDS, poll_seconds: float = POLL_SECONDS) -> int:
+    """
+    Claims and carries out tasks until the queue is sealed and empty. Returns the number of tasks carried out.
+    """
+    queue = WorkQueue(queue_path, lease_seconds)
+    worker = f"{os.uname().nodename}:{os.getpid()}"
+    logger.info(f"Worker {worker} started on {queue.path}")
+    count = 0
+    while True:
+        claimed = queue.claim() if os.path.exists(queue.job_path) else None
+        if claimed is None:
+            if queue.reclaim_expired():
+                continue
+            if os.path.exists(queue.job_path) and queue.finished():
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        task_id, task = claimed
+        logger.debug("Worker %s claimed task %s", worker, task_id)
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, task_id, stop), daemon=True)
+        heartbeat.start()
+        try:
+            execute(task)
+        except Exception as e:
+            logger.exception(f"Task {task_id} failed")
+            if not queue.fail(task_id, task, f"{worker}: {e}"):
+                logger.warning(f"Lease on task {task_id} expired before its failure was recorded")
+            continue
+        finally:
+            stop.set()
+            heartbeat.join()
+        if not queue.complete(task_id):
+            logger.warning(f"Lease on task {task_id} expired before it was completed")
+        count += 1
+    logger.info(f"Worker {worker} finished after {count} tasks")
+    return count
+
+
+def wait(queue: WorkQueue, local_workers: int = 0, poll_seconds: float = POLL_SECONDS) -> List[validator.ValidationError]:
+    """
+    Waits for the workers to empty the queue, reclaiming expired leases, and reports the tasks that failed. Local
+    worker processes may be started to help.
+    """
+    processes = [multiprocessing.Process(target=_local_worker, args=(queue.path, queue.lease_seconds, logging.getLogger().level), daemon=True)
+                 for _ in range(local_workers)]
+    for process in processes:
+        process.start()
+    logger.info(f"Waiting for workers to complete the tasks in {queue.path} ({local_workers} local workers)")
+    last_report = None
+    while not queue.finished():
+        queue.reclaim_expired()
+        counts = queue.counts()
+        if counts != last_report:
+            logger.info("Queue: " + ", ".join(f"{name}: {count}" for name, count in counts.items()))
+            last_report = counts
+        time.sleep(poll_seconds)
+    for process in processes:
+        process.join()
+    logger.info("Queue: " + ", ".join(f"{name}: {count}" for name, count in queue.counts().items()))
+    return [validator.ValidationError(f"Distributed task {task_id} failed after {task['attempts']} attempts: {task['error']}", "distributed_task_failed")
+            for task_id, task in queue.failures()]
+
+
+def _local_worker(queue_path: str, lease_seconds: float, level: int) -> None:
+    logging.basicConfig(format='%(asctime)s;%(levelname)s;%(name)s; %(message)s', level=level)
+    run_worker(queue_path, lease_seconds)
+
+
+def _heartbeat(queue: WorkQueue, task_id: str, stop: threading.Event) -> None:
+    while not stop.wait(queue.lease_seconds / 3):
+        if not queue.renew(task_id):
+            logger.warning(f"Lost the lease on task {task_id}")
+            return
+
+
+def _absolute(value):
+    if isinstance(value, str) and value:
+        return os.path.abspath(value)
+    if isinstance(value, (list, tuple)):
+        return [_absolute(x) for x in value]
+    return value
+
+
+def _listdir(path: str) -> List[str]:
+    try:
+        return [x for x in os.listdir(path) if x.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+
+def _move(src: str, dest: str) -> bool:
+    try:
+        os.rename(src, dest)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _temporary(path: str) -> str:
+    return f"{path}.tmp-{os.uname().nodename}-{os.getpid()}-{threading.get_ident()}"
+
+
+def _write_atomically(path: str, contents: bytes) -> None:
+    temporary_path = _temporary(path)
+    with open(temporary_path, "wb") as f:
+        f.write(contents)
+    os.replace(temporary_path, path)
+
+
+def _write_json(path: str, value) -> None:
+    _write_atomically(path, json.dumps(value).encode("utf-8"))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["worker", "status"])
+    parser.add_argument("queue", type=str)
+    parser.add_argument("--lease", type=float, default=LEASE_SECONDS, help="Seconds after which an unrenewed lease expires")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    if args.command == "worker":
+        run_worker(args.queue, args.lease)
+        return 0
+    queue = WorkQueue(args.queue, args.lease)
+    logger.info(("Sealed. " if queue.sealed() else "") + ", ".join(f"{name}: {count}" for name, count in queue.counts().items()))
+    for task_id, task in queue.failures():
+        logger.error(f"Task {task_id} failed: {task.get('error')}")
+    return 1 if queue.failures() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Exports a compact fingerprint of a bundle, which can be used in place of the previous bundle for a readiness check.
+
+The fingerprint holds only what the readiness checks need: the bundle and collection labels with their modification
+histories, the collection inventories, and the label and data file names of each product. It is a gzip compressed
+JSON document, and loading it takes time proportional to its size rather than to the size of the bundle.
+
+A fingerprint cannot be used to integrate a delta bundle, since it does not contain any of the bundle's files.
+
+    $ fingerprint.py previous_bundle_directory previous_bundle.madifp
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+from typing import Optional
+
+import labeltypes
+import pds4
+from lids import LidVid
+
+logger = logging.getLogger(__name__)
+
+FORMAT = "madi-fingerprint"
+VERSION = 1
+
+
+def is_fingerprint(path: str) -> bool:
+    """
+    Determines if the file at the given path is a bundle fingerprint. The format key is written first, so a
+    fingerprint can be recognized from its first few bytes.
+    """
+    if not os.path.isfile(path):
+        return False
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return f.read(64).startswith(f'{{"format":"{FORMAT}"')
+    except (OSError, EOFError):
+        return False
+
+
+def export_fingerprint(fullbundle: pds4.FullBundle, fingerprint_path: str) -> None:
+    """
+    Writes the fingerprint of a loaded bundle
+    """
+    def relpath(path: Optional[str]) -> Optional[str]:
+        return os.path.relpath(path, fullbundle.path) if path else None
+
+    document = {
+        "format": FORMAT,
+        "version": VERSION,
+        "path": fullbundle.path,
+        "bundles": [{
+            "label": relpath(b.label_path),
+            "readme": relpath(b.readme_path),
+            "checksum": b.label.checksum,
+            "identification_area": _identification_area_to_dict(b.label.identification_area),
+            "bundle_member_entries": [[e.member_status, e.reference_type, e.lid_reference, e.lidvid_reference]
+                                      for e in b.label.bundle_member_entries or []],
+            "file_areas": [f.file_name for f in b.label.file_areas or []]
+        } for b in fullbundle.bundles],
+        "collections": [{
+            "label": relpath(c.label_path),
+            "inventory_path": relpath(c.inventory_path),
+            "checksum": c.label.checksum,
+            "identification_area": _identification_area_to_dict(c.label.identification_area),
+            "file_areas": [f.file_name for f in c.label.file_areas or []],
+            "inventory": [f"{x.status},{x.lidvid}" for x in c.inventory.items.values()]
+        } for c in fullbundle.collections],
+        "products": [[str(p.lidvid()), relpath(p.label_path), [relpath(x) for x in p.data_paths]]
+                     for p in fullbundle.products]
+    }
+    with gzip.open(fingerprint_path, "wt", encoding="utf-8") as f:
+        json.dump(document, f, separators=(",", ":"))
+    logger.info(f"Wrote fingerprint of {fullbundle.path} to {fingerprint_path}: {len(fullbundle.bundles)} bundles, "
+                f"{len(fullbundle.collections)} collections, {len(fullbundle.products)} products")
+
+
+def load_fingerprint(fingerprint_path: str) -> pds4.FullBundle:
+    """
+    Loads a fingerprint as a bundle. File paths are placed below the fingerprint path, so they keep their original
+    names. The bundle has no superseded products, since the readiness checks do not use them.
+    """
+    logger.info(f"Loading bundle fingerprint: {fingerprint_path}")
+    with gzip.open(fingerprint_path, "rt", encoding="utf-8") as f:
+        document = json.load(f)
+    if document.get("format") != FORMAT or document.get("version") != VERSION:
+        raise Exception(f"Unsupported fingerprint format in {fingerprint_path}")
+    logger.info(f"Fingerprint was created from: {document['path']}")
+
+    def abspath(path: Optional[str]) -> Optional[str]:
+        return os.path.join(fingerprint_path, path) if path else None
+
+    bundles = [pds4.BundleProduct(
+        labeltypes.ProductLabel(
+            checksum=b["checksum"],
+            identification_area=_identification_area_from_dict(b["identification_area"]),
+            bundle_member_entries=[labeltypes.BundleMemberEntry(*e) for e in b["bundle_member_entries"]],
+            file_areas=[labeltypes.FileArea(x) for x in b["file_areas"]]),
+        label_path=abspath(b["label"]),
+        readme_path=abspath(b["readme"])) for b in document["bundles"]]
+
+    collections = [pds4.CollectionProduct(
+        labeltypes.ProductLabel(
+            checksum=c["checksum"],
+            identification_area=_identification_area_from_dict(c["identification_area"]),
+            file_areas=[labeltypes.FileArea(x) for x in c["file_areas"]]),
+        pds4.CollectionInventory.from_csv("\r\n".join(c["inventory"])),
+        label_path=abspath(c["label"]),
+        inventory_path=abspath(c["inventory_path"])) for c in document["collections"]]
+
+    products = []
+    for lidvid, label_path, data_paths in document["products"]:
+        label = labeltypes.ProductLabel(identification_area=labeltypes.IdentificationArea(LidVid.parse(lidvid), None, None))
+        products.append(pds4.BasicProduct(label, label_path=abspath(label_path), data_paths=[abspath(x) for x in data_paths]))
+
+    return pds4.FullBundle(fingerprint_path, bundles, [], collections, [], products, [])
+
+
+def _identification_area_to_dict(identification_area: labeltypes.IdentificationArea) -> dict:
+    history = identification_area.modification_history
+    return {
+        "lidvid": str(identification_area.lidvid),
+        "collection_id": identification_area.collection_id,
+        "modification_history": [[d.version_id, d.modification_date, d.description]
+                                 for d in history.modification_details] if history else None
+    }
+
+
+def _identification_area_from_dict(d: dict) -> labeltypes.IdentificationArea:
+    history = d["modification_history"]
+    return labeltypes.IdentificationArea(
+        lidvid=LidVid.parse(d["lidvid"]),
+        collection_id=d["collection_id"],
+        modification_history=labeltypes.ModificationHistory([labeltypes.ModificationDetail(*x) for x in history]) if history is not None else None
+    )
+
+
+def main() -> None:
+    import bundleloader
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bundle_directory", type=str)
+    parser.add_argument("fingerprint", type=str)
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    export_fingerprint(bundleloader.load_local_bundle(args.bundle_directory, prune_superseded=True), args.fingerprint)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
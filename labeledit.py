@@ -1,4 +1,5 @@
 
+import io
 from typing import Iterable
 
 from lxml import etree
@@ -18,7 +19,14 @@ NSMAP = dict([ns(n) for n in DICTIONARIES])
 
 
 def inject_bundle_member_entries(labelpath: str, entries_to_add: Iterable[BundleMemberEntry]):
-    xmldoc: etree = etree.parse(labelpath)
+    with open(labelpath, "rb") as infile:
+        contents = add_bundle_member_entries(infile.read(), entries_to_add)
+    with open(labelpath, "w") as outfile:
+        outfile.write(contents)
+
+
+def add_bundle_member_entries(label_contents: bytes, entries_to_add: Iterable[BundleMemberEntry]) -> str:
+    xmldoc: etree = etree.parse(io.BytesIO(label_contents))
     find_bundle = etree.ETXPath("//{%s}Product_Bundle" % NSMAP["pds"])
     bundle_member_entries = find_bundle(xmldoc)[0]
 
@@ -27,8 +35,7 @@ def inject_bundle_member_entries(labelpath: str, entries_to_add: Iterable[Bundle
         bundle_member_entries.append(_bundle_member_entry_to_element(entry_to_add))
 
     etree.indent(xmldoc, space="    ")
-    with open(labelpath, "w") as outfile:
-        outfile.write(etree.tostring(xmldoc, pretty_print=True, method="xml", encoding="unicode"))
+    return etree.tostring(xmldoc, pretty_print=True, method="xml", encoding="unicode")
 
 
 def _bundle_member_entry_to_element(entry: BundleMemberEntry):
@@ -45,14 +52,20 @@ def _bundle_member_entry_to_element(entry: BundleMemberEntry):
 
 
 def update_collection_inventory(labelpath: str, destpath: str, record_count: int, file_size: int, checksum: str):
-    xmldoc: etree = etree.parse(labelpath)
+    with open(labelpath, "rb") as infile:
+        contents = patch_collection_inventory(infile.read(), record_count, file_size, checksum)
+    with open(destpath, "w") as outfile:
+        outfile.write(contents)
+
+
+def patch_collection_inventory(label_contents: bytes, record_count: int, file_size: int, checksum: str) -> str:
+    xmldoc: etree = etree.parse(io.BytesIO(label_contents))
     _patch_element(xmldoc, "//pds:records", str(record_count))
     _patch_element(xmldoc, "//pds:file_size", str(file_size))
     logger.info(f"Patching checksum: {checksum}")
     _patch_element(xmldoc, "//pds:md5_checksum", checksum)
     etree.indent(xmldoc, space="    ")
-    with open(destpath, "w") as outfile:
-        outfile.write(etree.tostring(xmldoc, pretty_print=True, method="xml", encoding="unicode"))
+    return etree.tostring(xmldoc, pretty_print=True, method="xml", encoding="unicode")
 
 
 def _patch_element(xmldoc: etree, path: str, value: str):
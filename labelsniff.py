@@ -0,0 +1,66 @@
+"""
+Classifies labels by reading only the first few kilobytes of each file.
+
+A PDS4 label names its product type in its root element, e.g. Product_Collection, which comes at the top of the
+file. Sniffing it with a regular expression costs a small fraction of parsing the label, so that labels can be routed
+to the right parser, or skipped, before any of them is parsed.
+"""
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+import throttle
+
+logger = logging.getLogger(__name__)
+
+SNIFF_SIZE = 4096
+
+BUNDLE = "bundle"
+COLLECTION = "collection"
+BASIC = "basic"
+
+# The root elements of the product types that product.extract_label understands
+PRODUCT_KINDS = {
+    "Product_Bundle": BUNDLE,
+    "Product_Collection": COLLECTION,
+    "Product_Observational": BASIC,
+    "Product_Ancillary": BASIC,
+    "Product_Context": BASIC,
+    "Product_XML_Schema": BASIC,
+    "Product_Document": BASIC,
+}
+
+PDS4_NAMESPACE = "http://pds.nasa.gov/pds4/"
+
+# Skips the XML declaration, processing instructions, comments and a doctype to find the first start tag
+_ROOT = re.compile(r"\A(?:\s|<\?.*?\?>|<!--.*?-->|<!DOCTYPE[^>]*>)*<(?:[\w.-]+:)?([\w.-]+)", re.DOTALL)
+
+
+@dataclass(frozen=True)
+class Sniff:
+    path: str
+    root: Optional[str]
+    pds4: bool = False
+
+    def kind(self) -> Optional[str]:
+        """The kind of product, or None if the root element is not that of a known product type"""
+        return PRODUCT_KINDS.get(self.root)
+
+
+def sniff_text(path: str, head: str) -> Sniff:
+    """
+    Classifies a label from the text at its start. The label is taken to be a PDS4 label if its root element is a
+    product or it uses the PDS4 namespace, even if its product type is not one that can be loaded.
+    """
+    head = head.lstrip("\ufeff")
+    root = _ROOT.match(head)
+    if root is None:
+        return Sniff(path, None, pds4=PDS4_NAMESPACE in head)
+    return Sniff(path, root.group(1), pds4=root.group(1).startswith("Product_") or PDS4_NAMESPACE in head)
+
+
+def sniff_label(path: str, opener=throttle.open_file, size: int = SNIFF_SIZE) -> Sniff:
+    """Classifies the label at the given path by reading at most size characters of it"""
+    with opener(path) as f:
+        return sniff_text(path, f.read(size))
@@ -1,13 +1,16 @@
+import concurrent.futures
 import hashlib
-import itertools
 import os
 import logging
-from typing import Iterable
+from dataclasses import dataclass, field
+from typing import Iterator, List, Dict, Tuple
 
 import bs4
 
 import paths
+import throttle
 import product
+import urls
 from labeltypes import ProductLabel
 
 from pds4 import CollectionProduct, BundleProduct, BasicProduct, CollectionInventory
@@ -15,34 +18,34 @@ from pds4 import CollectionProduct, BundleProduct, BasicProduct, CollectionInven
 logger = logging.getLogger(__name__)
 
 
-def fetchcollection(path: str) -> CollectionProduct:
+def fetchcollection(path: str, opener=throttle.open_file) -> CollectionProduct:
     """Retrieves a collection product located at the specified path"""
-    logger.debug(f"Parsing collection: {path}")
-    collection_label = fetchlabel(path)
+    logger.debug("Parsing collection: %s", path)
+    collection_label = fetchlabel(path, opener)
     inventory_path = os.path.join(os.path.dirname(path), collection_label.file_areas[0].file_name)
     if "SUPERSEDED" in path:
-        logger.debug(f"Skipping inventory for superseded product: {inventory_path}")
+        logger.debug("Skipping inventory for superseded product: %s", inventory_path)
         inventory = None
     else:
-        with open(inventory_path, newline="") as f:
-            logger.debug(f"Parsing collection inventory: {inventory_path}")
+        with opener(inventory_path, newline="") as f:
+            logger.debug("Parsing collection inventory: %s", inventory_path)
             inventory = CollectionInventory.from_csv(f.read())
 
     return CollectionProduct(collection_label, inventory, label_path=path, inventory_path=inventory_path)
 
 
-def fetchbundle(path: str) -> BundleProduct:
+def fetchbundle(path: str, opener=throttle.open_file) -> BundleProduct:
     """Retrieves a bundle product located at the specified path"""
-    bundle_label = fetchlabel(path)
+    bundle_label = fetchlabel(path, opener)
     dirname = os.path.dirname(path)
     readme_path = os.path.join(dirname, bundle_label.file_areas[0].file_name) if bundle_label.file_areas else None
 
     return BundleProduct(bundle_label, label_path=path, readme_path=readme_path)
 
 
-def fetchproduct(path: str) -> BasicProduct:
+def fetchproduct(path: str, opener=throttle.open_file) -> BasicProduct:
     """Retrieves a basic product located at the specified path"""
-    product_label = fetchlabel(path)
+    product_label = fetchlabel(path, opener)
     dirname = os.path.dirname(path)
     data_paths = paths.rebase_filenames(dirname, [f.file_name for f in product_label.file_areas]) if product_label.file_areas else []
     document_paths = paths.rebase_filenames(dirname, product_label.document.filenames()) if product_label.document else []
@@ -50,17 +53,102 @@ def fetchproduct(path: str) -> BasicProduct:
     return BasicProduct(product_label, label_path=path, data_paths=data_paths + document_paths)
 
 
-def fetchlabel(path: str) -> ProductLabel:
+def fetchlabel(path: str, opener=throttle.open_file) -> ProductLabel:
     """Retrieves a product label located at the specified path"""
-    with open(path) as f:
+    with opener(path) as f:
         text = f.read()
         checksum = hashlib.md5(text.encode('utf-8')).hexdigest()
         soup = bs4.BeautifulSoup(text, "lxml-xml")
         return product.extract_label(soup, checksum, path)
 
 
-def get_file_paths(path: str) -> Iterable[str]:
-    """Retrieves every file path located below a directory."""
-    return itertools.chain.from_iterable(
-        (os.path.join(dirpath, filename) for filename in filenames)
-        for dirpath, _, filenames in os.walk(path))
+SCAN_WORKERS = 8
+
+
+@dataclass
+class ScanResult:
+    """The files below a bundle directory, classified by what they are used for"""
+    labels: List[str] = field(default_factory=list)
+    superseded_labels: List[str] = field(default_factory=list)
+    inventories: List[str] = field(default_factory=list)
+    data: List[str] = field(default_factory=list)
+    superseded_files: List[str] = field(default_factory=list)
+    ignored: List[str] = field(default_factory=list)
+    pruned: List[str] = field(default_factory=list)
+    stats: Dict[str, os.stat_result] = field(default_factory=dict)
+
+
+def scan_directory(path: str, workers: int = SCAN_WORKERS, prune_superseded: bool = False, with_stats: bool = False) -> ScanResult:
+    """
+    Lists and classifies every file below a directory in a single pass. Subdirectories are listed concurrently,
+    which hides the latency of each directory listing on network filesystems.
+
+    Labels are .xml files. Inventories are other files whose names start with "collection". Files that are inside a
+    SUPERSEDED directory are kept separately, and SUPERSEDED directories are skipped entirely if prune_superseded is
+    set. When with_stats is set, the stat result of each file is kept so that it does not need to be fetched again.
+    """
+    result = ScanResult()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_list_directory, path, with_stats)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                for filepath, stat in files:
+                    _classify(result, filepath)
+                    if stat is not None:
+                        result.stats[filepath] = stat
+                for subdirectory in subdirectories:
+                    if prune_superseded and os.path.basename(subdirectory) == "SUPERSEDED":
+                        result.pruned.append(subdirectory)
+                    else:
+                        pending.add(executor.submit(_list_directory, subdirectory, with_stats))
+
+    for paths_list in (result.labels, result.superseded_labels, result.inventories, result.data,
+                       result.superseded_files, result.ignored, result.pruned):
+        paths_list.sort()
+    return result
+
+
+def scan_groups(path: str, workers: int = SCAN_WORKERS) -> Iterator[Tuple[str, ScanResult]]:
+    """
+    Scans a bundle directory one top-level directory at a time, so that a bundle can be processed one collection at a
+    time without listing all of it up front. The first result covers only the files directly inside the bundle
+    directory; each following result covers everything below one of its subdirectories.
+    """
+    files, subdirectories = _list_directory(path, False)
+    root = ScanResult()
+    for filepath, _ in files:
+        _classify(root, filepath)
+    for paths_list in (root.labels, root.superseded_labels, root.inventories, root.data, root.superseded_files, root.ignored):
+        paths_list.sort()
+    yield path, root
+    for subdirectory in sorted(subdirectories):
+        yield subdirectory, scan_directory(subdirectory, workers)
+
+
+def _list_directory(path: str, with_stats: bool) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
+    files = []
+    subdirectories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            else:
+                files.append((entry.path, entry.stat() if with_stats else None))
+    return files, subdirectories
+
+
+def _classify(result: ScanResult, filepath: str) -> None:
+    filename = os.path.basename(filepath)
+    superseded = "SUPERSEDED" in filepath
+    if urls.is_ignored(filename):
+        result.ignored.append(filepath)
+    elif filename.endswith(".xml"):
+        (result.superseded_labels if superseded else result.labels).append(filepath)
+    elif superseded:
+        result.superseded_files.append(filepath)
+    elif filename.startswith("collection"):
+        result.inventories.append(filepath)
+    else:
+        result.data.append(filepath)
@@ -1,16 +1,29 @@
 #!/usr/bin/env python3
 import itertools
 import operator
+import os
 import sys
 import argparse
+from typing import Optional
 
+import archiveclient
 import bundleloader
+import distributed
+import fingerprint
 import localclient
+import throttle
 from ready import check_ready,report_errors
 
 import logging
 
-from superseder import supersede
+from bundlewriter import BundleWriter, DirectoryWriter, TarWriter
+from catalog import Catalog
+from contentstore import ContentStore, ContentStoreWriter, default_store_path
+from rules import RuleRunner
+from sampling import Sampler
+from selfcheck import verify_integration
+from streaming import stream_supersede
+from superseder import Composition, supersede
 from validator import ValidationError
 
 logger = logging.getLogger(__name__)
@@ -19,33 +32,134 @@ logger = logging.getLogger(__name__)
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("previous_bundle_directory", type=str)
-    parser.add_argument("delta_bundle_directory", type=str)
+    parser.add_argument("delta_bundle_directory", type=str, nargs="+")
     parser.add_argument("-j", "--jaxa", action="store_true")
     parser.add_argument("-s", "--supersede", type=str)
     parser.add_argument("-d", "--debug", action="store_true")
     parser.add_argument("-l", "--logfile", type=str)
     parser.add_argument("-D", "--dry", action="store_true")
+    parser.add_argument("-t", "--tar", type=str)
+    parser.add_argument("-c", "--content-store", type=str, nargs="?", const="")
+    parser.add_argument("-C", "--catalog", type=str)
+    parser.add_argument("-x", "--validate-schemas", action="store_true")
+    parser.add_argument("--schema-dir", type=str)
+    parser.add_argument("--rules", type=str, help="Comma-separated rule names or error types to run")
+    parser.add_argument("--skip-rules", type=str, help="Comma-separated rule names or error types to skip")
+    parser.add_argument("-S", "--stream", action="store_true", help="Integrate without loading the previous bundle into memory. The readiness check that runs first "
+                        "still loads it, or the fingerprint given with --check-against")
+    parser.add_argument("--check-against", type=str, help="Check readiness against this bundle or fingerprint instead of the previous bundle")
+    parser.add_argument("-V", "--verify", action="store_true", help="Verify the integrated bundle once it has been written")
+    parser.add_argument("-q", "--quick", type=float, metavar="RATE", help="Only check a sample of the products at this rate, e.g. 0.05")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the sample of a quick check")
+    parser.add_argument("--bandwidth", type=str, help="Maximum bytes per second read and written, e.g. 50M")
+    parser.add_argument("--max-open-files", type=int, help="Maximum number of files open at the same time")
+    parser.add_argument("--io-workers", type=int, help="Maximum number of concurrent copies; the number used adapts to the measured throughput")
+    parser.add_argument("--io-latency", type=float, help="Target latency in seconds of a single copy; concurrency is reduced above it")
+    parser.add_argument("--merge-workers", type=int, default=1, help="Number of processes that merge collection inventories")
+    parser.add_argument("--phase-workers", type=int, default=1, help="Number of threads that run independent integration phases at the same time")
+    parser.add_argument("-Q", "--queue", type=str, help="Queue the integration in this directory for distributed workers")
+    parser.add_argument("--local-workers", type=int, default=0, help="Number of local worker processes to start for a queued integration")
+    parser.add_argument("--lease", type=float, default=distributed.LEASE_SECONDS, help="Seconds after which a worker's unrenewed lease expires")
 
     args = parser.parse_args()
+    try:
+        sampler = Sampler(args.quick, args.seed) if args.quick is not None else None
+        runner = RuleRunner(_split(args.rules), _split(args.skip_rules), sampler)
+        control = _make_io_control(args)
+    except Exception as e:
+        parser.error(str(e))
+    if sampler and (args.supersede or args.tar or len(args.delta_bundle_directory) > 1):
+        parser.error("A quick check only loads a sample of the delta bundle, and cannot be used to integrate it or to check a chain of delta bundles")
+    if (args.supersede or args.tar) and fingerprint.is_fingerprint(args.previous_bundle_directory):
+        parser.error("A bundle fingerprint can only be used to check readiness, not to integrate a delta bundle")
+    if args.verify and (args.tar or args.dry or not args.supersede):
+        parser.error("Verification needs an integrated bundle directory (-s), and cannot be used with -t or -D")
+    if args.queue and (not args.supersede or args.tar or args.dry or args.stream or args.verify or args.catalog or args.content_store is not None
+                       or len(args.delta_bundle_directory) > 1 or not all(os.path.isdir(x) for x in [args.previous_bundle_directory] + args.delta_bundle_directory)):
+        parser.error("A queued integration needs an integrated bundle directory (-s), a previous bundle directory and a single delta bundle directory, "
+                     "and cannot be combined with -t, -D, -S, -V, -C or -c")
+    if (args.supersede or args.tar) and any(archiveclient.is_compressed_tar(x) for x in args.delta_bundle_directory):
+        parser.error("A compressed tar archive can be checked, but not integrated; use an uncompressed tar or zip archive, or extract it first")
+    if args.stream and (len(args.delta_bundle_directory) > 1 or args.catalog or not os.path.isdir(args.previous_bundle_directory)):
+        parser.error("Streaming integration needs a previous bundle directory and a single delta bundle, and cannot update a catalog")
 
     logging.basicConfig(
         filename=args.logfile,
         format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
         level=logging.DEBUG if args.debug else logging.INFO)
     logger.info(f'Previous Bundle Directory: {args.previous_bundle_directory}')
-    logger.info(f'Delta Bundle Directory: {args.delta_bundle_directory}')
+    for delta_bundle_directory in args.delta_bundle_directory:
+        logger.info(f'Delta Bundle Directory: {delta_bundle_directory}')
     if args.supersede:
         logger.info(f'Merged Bundle Directory: {args.supersede}')
+    if args.tar:
+        logger.info(f'Merged Bundle Archive: {args.tar}')
+    if args.catalog:
+        logger.info(f'Version History Catalog: {args.catalog}')
+    if args.queue:
+        logger.info(f'Work Queue: {args.queue}')
+    if control is not None:
+        logger.info(f'I/O Limits: bandwidth {args.bandwidth or "unlimited"}, open files {args.max_open_files or "unlimited"}, '
+                    f'up to {args.io_workers or 1} concurrent copies')
+        throttle.install(control)
 
-    previous_fullbundle = bundleloader.load_local_bundle(args.previous_bundle_directory)
-    delta_fullbundle = bundleloader.load_local_bundle(args.delta_bundle_directory)
+    if args.check_against:
+        logger.info(f'Checking Readiness Against: {args.check_against}')
+    previous_fullbundle = bundleloader.load_local_bundle(args.check_against or args.previous_bundle_directory, prune_superseded=args.stream)
+    delta_fullbundles = [bundleloader.load_local_bundle(x, prune_superseded=sampler is not None, sampler=sampler) for x in args.delta_bundle_directory]
+    delta_fullbundle = delta_fullbundles if len(delta_fullbundles) > 1 else delta_fullbundles[0]
 
-    issues = check_ready(previous_fullbundle, delta_fullbundle, args.jaxa)
+    # A chain of deltas is composed once, for both the readiness check and the integration
+    composition = Composition(previous_fullbundle, delta_fullbundles, args.jaxa, args.merge_workers) if len(delta_fullbundles) > 1 else None
+    issues = check_ready(previous_fullbundle, delta_fullbundle, args.jaxa, args.validate_schemas or args.schema_dir is not None, args.schema_dir, runner,
+                         composition)
     errors = [x for x in issues if x.severity == "error"]
-    if not len(errors) and args.supersede:
-        supersede(previous_fullbundle, delta_fullbundle, args.supersede, args.dry, args.jaxa)
+    if args.stream:
+        previous_fullbundle = None
+    elif args.check_against and not len(errors) and (args.supersede or args.tar):
+        previous_fullbundle = bundleloader.load_local_bundle(args.previous_bundle_directory)
+        composition = None
+    catalog = Catalog(args.catalog) if args.catalog and not len(errors) else None
+    if not len(errors) and (args.tar or args.supersede):
+        merged_bundle_directory = args.tar or args.supersede
+        writer = _make_writer(args)
+        if args.verify:
+            writer.start_recording()
+        if args.stream:
+            stream_supersede(args.previous_bundle_directory, delta_fullbundle, merged_bundle_directory, args.dry, args.jaxa, writer)
+        else:
+            supersede(previous_fullbundle, delta_fullbundle, merged_bundle_directory, args.dry, args.jaxa, writer, catalog, args.merge_workers,
+                      args.phase_workers, composition)
+        if args.verify:
+            issues.extend(verify_integration(writer, args.previous_bundle_directory))
+        if args.queue:
+            issues.extend(distributed.wait(writer.queue, args.local_workers))
+    for fullbundle in delta_fullbundles:
+        archiveclient.close_archives(fullbundle.sources)
 
-    report_errors(issues, previous_fullbundle.path, delta_fullbundle.path)
+    report_errors(issues, args.previous_bundle_directory, delta_fullbundles[-1].path, runner)
+
+
+def _make_writer(args) -> BundleWriter:
+    if args.queue:
+        return distributed.QueueWriter(distributed.WorkQueue(args.queue, args.lease), args.supersede)
+    if args.tar and not args.dry:
+        return TarWriter(args.tar)
+    if args.supersede and args.content_store is not None:
+        store = ContentStore(args.content_store or default_store_path(args.supersede))
+        logger.info(f'Content Store: {store.path}')
+        return ContentStoreWriter(store, args.supersede, dry=args.dry)
+    return DirectoryWriter(args.dry)
+
+
+def _make_io_control(args) -> Optional[throttle.IOControl]:
+    if not (args.bandwidth or args.max_open_files or args.io_workers or args.io_latency):
+        return None
+    return throttle.IOControl(throttle.parse_size(args.bandwidth) if args.bandwidth else None, args.max_open_files, args.io_workers or 1, args.io_latency)
+
+
+def _split(names: str) -> list[str]:
+    return [x.strip() for x in names.split(",") if x.strip()] if names else []
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Generates a delta bundle from the archived bundle and a complete new version of it.
+
+Products are matched by LID. A product goes in the delta bundle when its LID is new or its LIDVID differs from that of
+the archived product. Collections that gain products go in with delta-only inventories, listing just the products of
+the delta, and with labels patched to describe those inventories. New collections go in whole. The bundle label and
+readme of the new version are always included, so that the delta bundle passes the readiness check against the
+archived bundle.
+
+A product whose version is unchanged is compared with the archived product by label checksum and by the sizes of its
+data files, and the data files of equal size are then hashed on a pool of threads. A product that changed without a
+new version is reported, and left out of the delta bundle. Files that are the same file on disk, or that have
+different sizes, are never read, so an unchanged bundle costs little more than a stat of each data file.
+
+    $ makedelta.py previous_bundle_directory new_bundle_directory delta_bundle_directory
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+import os
+import sys
+from typing import Dict, List, Tuple
+
+import bundleloader
+import bundlewriter
+import labeledit
+import pds4
+import validator
+from bundlewriter import BundleWriter, DirectoryWriter
+from lids import Lid
+from paths import relocate_path
+from ready import check_ready, report_errors
+
+logger = logging.getLogger(__name__)
+
+HASH_WORKERS = 4
+
+
+def make_delta(previous_fullbundle: pds4.FullBundle, new_fullbundle: pds4.FullBundle, delta_bundle_directory: str,
+               writer: BundleWriter, hash_workers: int = HASH_WORKERS, size_only: bool = False) -> List[validator.ValidationError]:
+    """
+    Writes the delta bundle that turns the previous bundle into the new one. Returns the products that changed without
+    a new version as errors.
+    """
+    writer.add_sources(new_fullbundle.sources)
+    writer.add_sources(previous_fullbundle.sources)
+    previous_products: Dict[Lid, pds4.BasicProduct] = dict((p.lidvid().lid, p) for p in previous_fullbundle.products)
+
+    changed = []
+    unchanged = []
+    errors = []
+    for product in new_fullbundle.products:
+        previous_product = previous_products.get(product.lidvid().lid)
+        if previous_product is None or previous_product.lidvid() != product.lidvid():
+            changed.append(product)
+        elif previous_product.label.checksum != product.label.checksum:
+            errors.append(_changed_without_version(product, "label"))
+        else:
+            unchanged.append((previous_product, product))
+    errors.extend(compare_data(unchanged, writer, hash_workers, size_only))
+    logger.info(f"{len(changed)} new or changed products, {len(unchanged)} unchanged products")
+
+    def copy(path: str):
+        writer.copy(path, relocate_path(path, new_fullbundle.path, delta_bundle_directory))
+
+    for product in changed:
+        copy(product.label_path)
+        for data_path in product.data_paths:
+            copy(data_path)
+
+    previous_collections = dict((c.lidvid().lid, c) for c in previous_fullbundle.collections)
+    for collection in new_fullbundle.collections:
+        previous_collection = previous_collections.get(collection.lidvid().lid)
+        if previous_collection is None:
+            logger.info(f"New collection {collection.lidvid()}")
+            copy(collection.label_path)
+            copy(collection.inventory_path)
+            continue
+        previous_members = previous_collection.inventory.products()
+        items = [x for x in collection.inventory.items.values() if x.lidvid not in previous_members]
+        if not items and collection.lidvid() == previous_collection.lidvid():
+            continue
+        logger.info(f"Collection {collection.lidvid()} gains {len(items)} products")
+        write_delta_collection(collection, items, new_fullbundle.path, delta_bundle_directory, writer)
+
+    for bundle in new_fullbundle.bundles:
+        copy(bundle.label_path)
+        if bundle.readme_path:
+            copy(bundle.readme_path)
+    writer.finish()
+    return errors
+
+
+def write_delta_collection(collection: pds4.CollectionProduct, items: List[pds4.InventoryItem], new_bundle_directory: str,
+                           delta_bundle_directory: str, writer: BundleWriter) -> None:
+    """Writes a collection with an inventory that lists only the given items, patching its label to match"""
+    inventory_contents = pds4.CollectionInventory(items).to_csv() + "\r\n"
+    checksum = hashlib.md5(inventory_contents.encode('utf-8')).hexdigest()
+    writer.write(relocate_path(collection.inventory_path, new_bundle_directory, delta_bundle_directory), inventory_contents)
+    label_contents = labeledit.patch_collection_inventory(writer.read(collection.label_path), len(items), len(inventory_contents), checksum)
+    writer.write(relocate_path(collection.label_path, new_bundle_directory, delta_bundle_directory), label_contents)
+
+
+def compare_data(pairs: List[Tuple[pds4.BasicProduct, pds4.BasicProduct]], writer: BundleWriter, hash_workers: int = HASH_WORKERS,
+                 size_only: bool = False) -> List[validator.ValidationError]:
+    """
+    Compares the data files of products whose labels are unchanged, given as (previous, new) pairs. File names and
+    sizes are compared first, and only the files that could still be equal are hashed.
+    """
+    errors = []
+    to_hash: List[Tuple[pds4.BasicProduct, str, str]] = []
+    for previous_product, product in pairs:
+        previous_files = dict((os.path.basename(x), x) for x in previous_product.data_paths)
+        files = dict((os.path.basename(x), x) for x in product.data_paths)
+        if previous_files.keys() != files.keys():
+            errors.append(_changed_without_version(product, "data file names"))
+            continue
+        candidates = []
+        for name, path in files.items():
+            previous_source, source = writer.resolve(previous_files[name]), writer.resolve(path)
+            if _same_file(previous_source, source):
+                continue
+            if bundlewriter.source_size(previous_source) != bundlewriter.source_size(source):
+                errors.append(_changed_without_version(product, f"size of {name}"))
+                candidates = []
+                break
+            candidates.append((product, previous_source, source))
+        if not size_only:
+            to_hash.extend(candidates)
+
+    if to_hash:
+        logger.info(f"Hashing {len(to_hash)} pairs of data files of equal size")
+        reported = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, hash_workers)) as executor:
+            futures = [(product, executor.submit(bundlewriter.source_checksum, previous_source), executor.submit(bundlewriter.source_checksum, source))
+                       for product, previous_source, source in to_hash]
+            for product, previous_checksum, checksum in futures:
+                if previous_checksum.result() != checksum.result() and product.label_path not in reported:
+                    reported.add(product.label_path)
+                    errors.append(_changed_without_version(product, "data checksum"))
+    return errors
+
+
+def _same_file(previous_source: bundlewriter.Source, source: bundlewriter.Source) -> bool:
+    if not (isinstance(previous_source, str) and isinstance(source, str)):
+        return False
+    try:
+        return os.path.samefile(previous_source, source)
+    except OSError:
+        return False
+
+
+def _changed_without_version(product: pds4.BasicProduct, what: str) -> validator.ValidationError:
+    return validator.ValidationError(f"The {what} of {product.lidvid()} changed, but its version did not: {product.label_path}",
+                                     "product_changed_without_new_version")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("previous_bundle_directory", type=str)
+    parser.add_argument("new_bundle_directory", type=str)
+    parser.add_argument("delta_bundle_directory", type=str)
+    parser.add_argument("-j", "--jaxa", action="store_true")
+    parser.add_argument("-w", "--hash-workers", type=int, default=HASH_WORKERS, help="Number of threads that hash data files")
+    parser.add_argument("--size-only", action="store_true", help="Compare data files of unchanged products by size, without hashing them")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    args = parser.parse_args()
+    if os.path.exists(args.delta_bundle_directory) and os.listdir(args.delta_bundle_directory):
+        parser.error(f"The delta bundle directory is not empty: {args.delta_bundle_directory}")
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+    logger.info(f'Previous Bundle Directory: {args.previous_bundle_directory}')
+    logger.info(f'New Bundle Directory: {args.new_bundle_directory}')
+    logger.info(f'Delta Bundle Directory: {args.delta_bundle_directory}')
+
+    previous_fullbundle = bundleloader.load_local_bundle(args.previous_bundle_directory, prune_superseded=True)
+    new_fullbundle = bundleloader.load_local_bundle(args.new_bundle_directory, prune_superseded=True)
+    issues = make_delta(previous_fullbundle, new_fullbundle, args.delta_bundle_directory, DirectoryWriter(), args.hash_workers, args.size_only)
+    if not any(x.severity == "error" for x in issues):
+        issues.extend(check_ready(previous_fullbundle, bundleloader.load_local_bundle(args.delta_bundle_directory), args.jaxa))
+    report_errors(issues, args.previous_bundle_directory, args.delta_bundle_directory)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
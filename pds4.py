@@ -1,11 +1,11 @@
 from dataclasses import dataclass
-from typing import List, Iterable
+from typing import List, Iterable, Dict, Optional, Set, Union
 import itertools
 import csv
 
 import labeltypes
 
-from lids import LidVid
+from lids import Lid, LidVid
 
 
 class Pds4Product:
@@ -100,4 +100,37 @@ class FullBundle:
     collections: List[CollectionProduct]
     superseded_collections: List[CollectionProduct]
     products: List[BasicProduct]
-    superseded_products: List[BasicProduct]
\ No newline at end of file
+    superseded_products: List[BasicProduct]
+    sources: Dict[str, Union[str, bytes]] = None
+    index: Optional["LidvidIndex"] = None
+
+    def lidvid_index(self) -> "LidvidIndex":
+        """Returns the LIDVID index of the bundle, building it the first time it is needed"""
+        if self.index is None:
+            self.index = LidvidIndex(self)
+        return self.index
+
+
+class LidvidIndex:
+    """
+    Indexes the LIDVIDs of a bundle in one pass over its basic product labels (current and superseded) and the rows
+    of its current collection inventories. Primary inventory members are indexed by the collection that lists them,
+    and by their LID, so that a product listed by two collections can be found.
+    """
+    def __init__(self, fullbundle: FullBundle):
+        self.labels: Dict[LidVid, str] = {}
+        self.members: Dict[LidVid, Lid] = {}
+        self.secondary_members: Set[LidVid] = set()
+        self.collections_by_lid: Dict[Lid, Set[Lid]] = {}
+        for product in itertools.chain(fullbundle.products, fullbundle.superseded_products):
+            self.labels[product.lidvid()] = product.label_path
+        for collection in fullbundle.collections:
+            if collection.inventory is None:
+                continue
+            collection_lid = collection.lidvid().lid
+            for item in collection.inventory.items.values():
+                if item.status.upper() == "P":
+                    self.members[item.lidvid] = collection_lid
+                    self.collections_by_lid.setdefault(item.lidvid.lid, set()).add(collection_lid)
+                else:
+                    self.secondary_members.add(item.lidvid)
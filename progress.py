@@ -0,0 +1,34 @@
+"""
+Progress reporting for loops over many products.
+
+Messages about individual products are logged at DEBUG level. At INFO level, long-running loops instead report their
+progress periodically, and a summary once they are complete.
+"""
+import logging
+import time
+
+
+class Progress:
+    def __init__(self, logger: logging.Logger, description: str, total: int = None, interval: float = 10.0):
+        self.logger = logger
+        self.description = description
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start = time.monotonic()
+        self.last_report = self.start
+
+    def step(self, count: int = 1) -> None:
+        """Records that some items have been processed, and logs the progress if enough time has passed"""
+        self.count += count
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            if self.total:
+                self.logger.info("%s: %d/%d (%.0f%%)", self.description, self.count, self.total, 100.0 * self.count / self.total)
+            else:
+                self.logger.info("%s: %d", self.description, self.count)
+
+    def done(self) -> None:
+        """Logs a summary once every item has been processed"""
+        self.logger.info("%s: %d complete in %.1fs", self.description, self.count, time.monotonic() - self.start)
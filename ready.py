@@ -1,16 +1,48 @@
 import itertools
 import operator
 import typing
-from typing import List
+from typing import List, Union
 
 import pds4
+import rules
+import superseder
 import validator
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def check_ready(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> list[validator.ValidationError]:
+def check_ready(previous_fullbundle: pds4.FullBundle, delta_fullbundle: Union[pds4.FullBundle, List[pds4.FullBundle]], jaxa: bool,
+                validate_schemas: bool = False, schema_directory: str = None, runner: rules.RuleRunner = None,
+                composition: superseder.Composition = None) -> list[validator.ValidationError]:
+    """
+    Checks the readiness of a delta bundle. When given an ordered list of delta bundles, each delta is checked against
+    the result of integrating the ones before it, as composed by the given composition. Checking stops at the first
+    delta bundle that has errors, since the deltas after it cannot be checked against a result that could not be
+    integrated.
+
+    If validate_schemas is set, the label_schemas rule is enabled, so that the labels of each delta bundle are also
+    validated against their XML schemas.
+    """
+    if not isinstance(delta_fullbundle, list):
+        return check_single_ready(previous_fullbundle, delta_fullbundle, jaxa, validate_schemas, schema_directory, runner)
+
+    composition = composition or superseder.Composition(previous_fullbundle, delta_fullbundle, jaxa)
+    errors = []
+    for index, next_fullbundle in enumerate(delta_fullbundle):
+        previous_fullbundle = composition.previous(index)
+        delta_errors = check_single_ready(previous_fullbundle, next_fullbundle, jaxa, validate_schemas, schema_directory, runner)
+        errors.extend(delta_errors)
+        if any(e.severity == "error" for e in delta_errors):
+            remaining = [x.path for x in delta_fullbundle[index + 1:]]
+            if remaining:
+                logger.error(f"Delta bundle {next_fullbundle.path} is not ready. Skipping checks for: {remaining}")
+            break
+    return errors
+
+
+def check_single_ready(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool,
+                       validate_schemas: bool = False, schema_directory: str = None, runner: rules.RuleRunner = None) -> list[validator.ValidationError]:
     previous_bundle_directory = previous_fullbundle.path
     delta_bundle_directory = delta_fullbundle.path
 
@@ -22,18 +54,23 @@ def check_ready(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.Ful
     for bundle in delta_fullbundle.bundles:
         logger.info(f'Delta bundle checksum: {bundle.label.checksum}')
 
-    errors = do_checkready(previous_fullbundle, delta_fullbundle, jaxa)
+    runner = runner or rules.RuleRunner()
+    if validate_schemas:
+        runner.enable("label_schemas", schema_directory=schema_directory)
+    errors = do_checkready(previous_fullbundle, delta_fullbundle, jaxa, runner)
     logger.info(f"Checking readiness of delta bundle {delta_bundle_directory} against {previous_bundle_directory} - Complete")
     return errors
 
 
-def report_errors(errors: list[validator.ValidationError], previous_bundle_directory, delta_bundle_directory):
+def report_errors(errors: list[validator.ValidationError], previous_bundle_directory, delta_bundle_directory, runner: rules.RuleRunner = None):
+
+    if runner is not None:
+        logger.info(f"Rule timings:\n{runner.report()}")
+    if runner is not None and runner.sampler is not None:
+        logger.info(f"Quick check:\n{runner.sampling_report()}")
 
     if len(errors) > 0:
-        summary_lines = "\n".join(
-            f"  {severity} - {error_type}: {len(list(v))}" for ((severity, error_type), v) in itertools.groupby(errors, operator.attrgetter("severity", "error_type"))
-        )
-        logger.info(f"Error summary:\n{summary_lines}\nTotal: {len(errors)}")
+        logger.info(f"Error summary:\n{summarize_errors(errors)}\nTotal: {len(errors)}")
 
         if any(e.severity == "error" for e in errors):
             raise Exception("Validation errors encountered")
@@ -41,24 +78,19 @@ def report_errors(errors: list[validator.ValidationError], previous_bundle_direc
         logger.info("No errors encountered")
 
 
-def do_checkready(previous_fullbundle: pds4.FullBundle,
-                  delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
-    errors = []
-    errors.extend(validator.check_bundle_against_previous(previous_fullbundle.bundles[0], delta_fullbundle.bundles[0], jaxa, previous_fullbundle.collections))
-    errors.extend(validator.check_bundle_against_collections(delta_fullbundle.bundles[0], delta_fullbundle.collections))
-
-    for collection in delta_fullbundle.collections + previous_fullbundle.collections:
-        errors.extend(validator.check_vid_presence(collection.inventory.products()))
+def summarize_errors(errors: list[validator.ValidationError]) -> str:
+    """
+    Produces one line per severity and error type, with the number of times it was encountered
+    """
+    return "\n".join(
+        f"  {severity} - {error_type}: {len(list(v))}" for ((severity, error_type), v) in itertools.groupby(errors, operator.attrgetter("severity", "error_type"))
+    )
 
-    if not any(e.severity == "error" for e in errors):
-        for delta_collection in delta_fullbundle.collections:
-            new_collection_lid = delta_collection.label.identification_area.lidvid.lid
-            previous_collections = [x for x in previous_fullbundle.collections if
-                                    x.label.identification_area.lidvid.lid == new_collection_lid]
-            if previous_collections:
-                previous_collection = previous_collections[0]
-                errors.extend(validator.check_collection_against_previous(previous_collection, delta_collection))
 
-        errors.extend(validator.check_filename_consistency(previous_fullbundle.products, delta_fullbundle.products))
-
-    return errors
+def do_checkready(previous_fullbundle: pds4.FullBundle,
+                  delta_fullbundle: pds4.FullBundle, jaxa: bool, runner: rules.RuleRunner = None) -> List[validator.ValidationError]:
+    """
+    Runs the registered readiness rules. By default every rule is run; a runner may be supplied to select rules and to
+    collect their timings.
+    """
+    return (runner or rules.RuleRunner()).run(previous_fullbundle, delta_fullbundle, jaxa)
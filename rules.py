@@ -0,0 +1,286 @@
+"""
+A registry of the readiness checks, and a runner that executes them.
+
+Each rule declares the parts of the previous and delta bundles that it reads, a cost class and the error types it can
+report. The runner executes the selected rules cheapest first and times each one. Rules can be selected or skipped by
+name or by error type, e.g. to leave out the product-level checks for a quick pre-check.
+
+Some rules compare products that only make sense to compare once the bundle-level checks pass. These rules are marked
+as requiring a clean result, and are skipped if one of the rules that do not require a clean result reported an error.
+Errors from rules that require a clean result do not cause the others to be skipped.
+
+A rule can also be opt-in, such as the XML schema validation, which fetches and compiles schemas. An opt-in rule only
+runs when it is enabled on the runner, or named by the rules to include. Its errors do not cause other rules to be
+skipped.
+
+For a quick check, the runner can be given a sampler. Rules that check individual products or inventory entries then
+only check a sample of them, and the report extrapolates the number of problems they found to the whole bundle. The
+bundle- and collection-level rules always run in full.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import bundleloader
+import pds4
+import schemacheck
+import validator
+from sampling import Sampler
+
+logger = logging.getLogger(__name__)
+
+# Cost classes, cheapest first. The cost of a rule grows with the number of bundles, collections or products it reads.
+BUNDLE = "bundle"
+COLLECTION = "collection"
+PRODUCT = "product"
+COSTS = (BUNDLE, COLLECTION, PRODUCT)
+
+RuleFunction = Callable[[pds4.FullBundle, pds4.FullBundle, bool], Iterable[validator.ValidationError]]
+
+
+@dataclass
+class Rule:
+    name: str
+    function: RuleFunction
+    cost: str
+    inputs: Tuple[str, ...]
+    error_types: Tuple[str, ...]
+    requires_clean: bool = False
+    description: str = ""
+    sample: str = None
+    quick: bool = True
+    opt_in: bool = False
+    options: Tuple[str, ...] = ()
+
+
+@dataclass
+class RuleTiming:
+    name: str
+    cost: str
+    seconds: float = 0.0
+    errors: int = 0
+    warnings: int = 0
+    status: str = "run"
+
+
+RULES: Dict[str, Rule] = {}
+
+
+def rule(name: str, cost: str, inputs: Tuple[str, ...], error_types: Tuple[str, ...], requires_clean: bool = False, sample: str = None,
+         quick: bool = True, opt_in: bool = False, options: Tuple[str, ...] = ()):
+    """
+    Registers a readiness check. The decorated function takes the previous bundle, the delta bundle and the JAXA flag.
+
+    A rule that can be sampled names the sampler population its problem counts are extrapolated from, and also takes
+    the sampler (or None) as a keyword argument. A rule that would give wrong results on a sample of the delta bundle
+    is marked as not quick, and is skipped in a quick check. A rule that takes settings from the runner names them in
+    options, and receives each one as a keyword argument.
+    """
+    if cost not in COSTS:
+        raise Exception(f"Unknown cost class for rule {name}: {cost}")
+
+    def register(function: RuleFunction) -> RuleFunction:
+        RULES[name] = Rule(name, function, cost, inputs, error_types, requires_clean, (function.__doc__ or "").strip(), sample, quick,
+                           opt_in, options)
+        return function
+    return register
+
+
+class RuleRunner:
+    """
+    Runs the registered rules. If include is given, only the rules it names, or that can report an error type it
+    names, are run. Rules named by exclude, or whose error types are all excluded, are not run. Errors of excluded
+    types are also removed from the results of rules that still run.
+
+    Timings are accumulated across runs, so a single runner can be used for a chain of delta bundles. If a sampler is
+    given, the rules that can be sampled only check a sample of their products or inventory entries.
+    """
+    def __init__(self, include: Iterable[str] = (), exclude: Iterable[str] = (), sampler: Sampler = None):
+        self.include = set(include)
+        self.exclude = set(exclude)
+        self.sampler = sampler
+        self.enabled = set()
+        self.options: Dict[str, object] = {}
+        unknown = (self.include | self.exclude) - set(RULES.keys()) - set(t for r in RULES.values() for t in r.error_types)
+        if unknown:
+            raise Exception(f"Unknown rules or error types: {sorted(unknown)}")
+        self.timings: Dict[str, RuleTiming] = {}
+
+    def enable(self, name: str, **options) -> None:
+        """Enables an opt-in rule, with the options that it takes"""
+        if name not in RULES:
+            raise Exception(f"Unknown rule: {name}")
+        self.enabled.add(name)
+        self.options.update(options)
+
+    def selected(self, r: Rule) -> bool:
+        named = r.name in self.include or bool(self.include.intersection(r.error_types))
+        if (self.include and not named) or (r.opt_in and r.name not in self.enabled and not named):
+            return False
+        return r.name not in self.exclude and not self.exclude.issuperset(r.error_types)
+
+    def rules(self) -> List[Rule]:
+        """The registered rules in the order they are run: cheapest first, and rules requiring a clean result last"""
+        order = list(RULES.keys())
+        return sorted(RULES.values(), key=lambda r: (r.requires_clean, COSTS.index(r.cost), order.index(r.name)))
+
+    def run(self, previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool,
+            results: Dict[str, List[validator.ValidationError]] = None) -> List[validator.ValidationError]:
+        """
+        Runs the selected rules. If results is given, the errors of a rule that has an entry in it are taken from there
+        instead of running the rule again, and the errors of the rules that do run are added to it. The caller removes
+        the entries of rules whose inputs have changed.
+        """
+        errors = []
+        baseline_errors = []
+        for r in self.rules():
+            timing = self.timings.setdefault(r.name, RuleTiming(r.name, r.cost, status="skipped"))
+            if not self.selected(r):
+                timing.status = "not enabled" if r.opt_in and r.name not in self.enabled else "excluded"
+                continue
+            if self.sampler is not None and not r.quick:
+                timing.status = "not quick"
+                continue
+            if r.requires_clean and any(e.severity == "error" for e in baseline_errors):
+                logger.info(f"Skipping rule {r.name} because of earlier errors")
+                continue
+
+            if results is not None and r.name in results:
+                rule_errors = results[r.name]
+                timing.status = "cached"
+            else:
+                logger.debug("Running rule %s", r.name)
+                start = time.perf_counter()
+                kwargs = {"sampler": self.sampler} if r.sample else {}
+                kwargs.update((option, self.options.get(option)) for option in r.options)
+                rule_errors = [e for e in r.function(previous_fullbundle, delta_fullbundle, jaxa, **kwargs) if e.error_type not in self.exclude]
+                timing.seconds += time.perf_counter() - start
+                timing.errors += len([e for e in rule_errors if e.severity == "error"])
+                timing.warnings += len([e for e in rule_errors if e.severity == "warning"])
+                timing.status = "run"
+                if results is not None:
+                    results[r.name] = rule_errors
+            errors.extend(rule_errors)
+            if not r.requires_clean and not r.opt_in:
+                baseline_errors.extend(rule_errors)
+        return errors
+
+    def report(self) -> str:
+        """Produces a table of the rules with their cost class, time taken and the number of problems they found"""
+        lines = [f"  {'rule':<30} {'cost':<10} {'seconds':>8} {'errors':>7} {'warnings':>8}  status"]
+        for r in self.rules():
+            t = self.timings.get(r.name)
+            if t is not None:
+                lines.append(f"  {t.name:<30} {t.cost:<10} {t.seconds:>8.3f} {t.errors:>7} {t.warnings:>8}  {t.status}")
+        return "\n".join(lines)
+
+    def sampling_report(self) -> str:
+        """
+        Describes the sample checked by each sampled rule, with its problem counts extrapolated to the whole bundle
+        """
+        lines = [f"  Product-level checks sampled at {self.sampler.rate:.1%} with seed {self.sampler.seed}"]
+        for r in self.rules():
+            t = self.timings.get(r.name)
+            if r.sample and t is not None and t.status == "run":
+                scale = self.sampler.scale(r.sample)
+                lines.append(f"  {t.name:<30} checked {self.sampler.describe(r.sample)}; "
+                             f"errors: {t.errors} (~{round(t.errors * scale)} extrapolated), "
+                             f"warnings: {t.warnings} (~{round(t.warnings * scale)} extrapolated)")
+        return "\n".join(lines)
+
+
+INVENTORY_ENTRIES = "inventory entries"
+
+MODIFICATION_HISTORY_ERRORS = ("missing_modification_history", "missing_current_modification_detail",
+                               "not_enough_modification_details", "mismatched_modification_detail",
+                               "incorrect_modification_detail_count_for_superseding_product",
+                               "incorrect_modification_detail_count_for_non_superseding_product")
+
+
+@rule("bundle_against_previous", BUNDLE, ("previous.bundles", "previous.collections", "delta.bundles"),
+      ("non_lidvid_reference", "incorrectly_incremented_lidvid", "collection_missing_from_previous_bundle",
+       "collection_missing_from_delta_bundle", "patched_lid_reference_with_collection_lidvid",
+       "unpatchable_lid_reference") + MODIFICATION_HISTORY_ERRORS)
+def check_bundle_against_previous(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
+    """Compares the delta bundle label to the previous bundle label"""
+    return validator.check_bundle_against_previous(previous_fullbundle.bundles[0], delta_fullbundle.bundles[0], jaxa, previous_fullbundle.collections)
+
+
+@rule("bundle_against_collections", BUNDLE, ("delta.bundles", "delta.collections"),
+      ("collection_not_declared", "declared collection not found"))
+def check_bundle_against_collections(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
+    """Checks that the delta bundle label declares exactly the collections in the delta bundle"""
+    return validator.check_bundle_against_collections(delta_fullbundle.bundles[0], delta_fullbundle.collections)
+
+
+@rule("vid_presence", COLLECTION, ("delta.inventories", "previous.inventories"), ("missing_vid_From_lidvid",), sample=INVENTORY_ENTRIES)
+def check_vid_presence(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool,
+                       sampler: Sampler = None) -> List[validator.ValidationError]:
+    """Checks that every inventory entry has a VID"""
+    errors = []
+    for collection in delta_fullbundle.collections + previous_fullbundle.collections:
+        lidvids = collection.inventory.products()
+        if sampler is not None:
+            lidvids = sampler.sample(INVENTORY_ENTRIES, collection.label_path, lidvids)
+        errors.extend(validator.check_vid_presence(lidvids))
+    return errors
+
+
+@rule("collection_against_previous", COLLECTION, ("previous.collections", "previous.inventories", "delta.collections", "delta.inventories"),
+      ("incorrectly_incremented_lidvid", "duplicate_products") + MODIFICATION_HISTORY_ERRORS, requires_clean=True)
+def check_collections_against_previous(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
+    """Compares each delta collection label and inventory to the previous version of the collection"""
+    errors = []
+    for delta_collection in delta_fullbundle.collections:
+        new_collection_lid = delta_collection.label.identification_area.lidvid.lid
+        previous_collections = [x for x in previous_fullbundle.collections if
+                                x.label.identification_area.lidvid.lid == new_collection_lid]
+        if previous_collections:
+            previous_collection = previous_collections[0]
+            errors.extend(validator.check_collection_against_previous(previous_collection, delta_collection))
+    return errors
+
+
+@rule("filename_consistency", PRODUCT, ("previous.products", "delta.products"),
+      ("previous_product_missing", "product_filename_version_differs", "product_inconsistent_filenames",
+       "data_filename_version_differs", "data_inconsistent_filename"), requires_clean=True, sample=bundleloader.PRODUCTS)
+def check_filename_consistency(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool,
+                               sampler: Sampler = None) -> List[validator.ValidationError]:
+    """
+    Checks that the file names of each delta product match the previous version of the product. In a quick check the
+    delta bundle is loaded with the sampler, so its products are already a sample.
+    """
+    return validator.check_filename_consistency(previous_fullbundle.products, delta_fullbundle.products)
+
+
+@rule("labels_in_inventories", PRODUCT, ("delta.products", "delta.inventories"), ("product_not_in_inventory",), requires_clean=True,
+      sample=bundleloader.PRODUCTS)
+def check_labels_in_inventories(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool,
+                                sampler: Sampler = None) -> List[validator.ValidationError]:
+    """Checks that every delta product label is listed by a delta collection inventory"""
+    return validator.check_labels_in_inventories(delta_fullbundle.products, delta_fullbundle.lidvid_index())
+
+
+@rule("inventory_labels", PRODUCT, ("delta.inventories", "delta.products", "previous.products"), ("inventory_entry_without_label",), requires_clean=True,
+      quick=False)
+def check_inventory_labels(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
+    """Checks that every product listed by a delta collection inventory has a label in one of the bundles"""
+    return validator.check_inventory_labels(delta_fullbundle.lidvid_index(), previous_fullbundle.lidvid_index())
+
+
+@rule("lid_in_one_collection", COLLECTION, ("delta.inventories", "previous.inventories"), ("lid_in_multiple_collections",), requires_clean=True)
+def check_lid_collections(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool) -> List[validator.ValidationError]:
+    """Checks that no delta product is listed by more than one collection"""
+    return validator.check_lid_collections(delta_fullbundle.lidvid_index(), previous_fullbundle.lidvid_index())
+
+
+@rule("label_schemas", PRODUCT, ("delta.labels",), schemacheck.ERROR_TYPES, opt_in=True, options=("schema_directory",),
+      sample=bundleloader.PRODUCTS)
+def check_label_schemas(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool, sampler: Sampler = None,
+                        schema_directory: str = None) -> List[validator.ValidationError]:
+    """
+    Validates every delta label against the XML schemas it references. In a quick check the delta bundle is loaded
+    with the sampler, so its products are already a sample.
+    """
+    return schemacheck.check_bundle_schemas(delta_fullbundle, schema_directory)
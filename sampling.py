@@ -0,0 +1,42 @@
+"""
+Seeded, stratified random sampling for quick readiness checks.
+
+Items are sampled separately within each stratum (normally a collection) at the same rate, so every collection is
+represented in the sample. The sample only depends on the seed and the items themselves, so a quick check can be
+repeated exactly.
+"""
+import math
+import random
+from typing import Dict, List, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+class Sampler:
+    def __init__(self, rate: float, seed: int = 0):
+        if not 0 < rate <= 1:
+            raise Exception(f"Sampling rate must be greater than 0 and at most 1: {rate}")
+        self.rate = rate
+        self.seed = seed
+        self.population: Dict[str, int] = {}
+        self.sampled: Dict[str, int] = {}
+
+    def sample(self, name: str, stratum: str, items: Sequence[T]) -> List[T]:
+        """
+        Selects a sample of the items in one stratum. At least one item is selected from every non-empty stratum. The
+        name identifies what is being sampled, and the totals for each name are kept for extrapolation.
+        """
+        ordered = sorted(items, key=str)
+        count = min(len(ordered), max(1, math.ceil(self.rate * len(ordered)))) if ordered else 0
+        chosen = random.Random(f"{self.seed}:{name}:{stratum}").sample(ordered, count)
+        self.population[name] = self.population.get(name, 0) + len(ordered)
+        self.sampled[name] = self.sampled.get(name, 0) + count
+        return chosen
+
+    def scale(self, name: str) -> float:
+        """The factor that extrapolates a count over the sample of the given name to its whole population"""
+        sampled = self.sampled.get(name, 0)
+        return self.population.get(name, 0) / sampled if sampled else 1.0
+
+    def describe(self, name: str) -> str:
+        return f"{self.sampled.get(name, 0)}/{self.population.get(name, 0)} {name}"
@@ -0,0 +1,129 @@
+"""
+Checks that labels are well-formed XML and conform to the XML schemas they reference, using lxml.
+
+Each label names its schemas in xsi:schemaLocation. Compiling a schema is much slower than validating a label against
+it, so each distinct set of schemas is compiled once per process and cached. Labels are validated across a process
+pool.
+
+Schemas are usually referenced by URL. If a schema directory is given, a schema is loaded from the file in that
+directory with the same name as the end of its URL, so that labels can be validated without network access. A label
+whose schemas cannot be loaded is reported as an error, since it has not been validated.
+"""
+import concurrent.futures
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from lxml import etree
+
+import pds4
+import validator
+from progress import Progress
+
+logger = logging.getLogger(__name__)
+
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+ERROR_TYPES = ("label_not_well_formed", "schema_location_missing", "schema_unavailable", "label_schema_violation")
+CHUNK_SIZE = 64
+
+SchemaLocations = Tuple[Tuple[str, str], ...]
+Problem = Tuple[str, str, str]
+
+_schemas: Dict[SchemaLocations, Union[etree.XMLSchema, str]] = {}
+_schema_directory: Optional[str] = None
+
+
+def check_bundle_schemas(fullbundle: pds4.FullBundle, schema_directory: str = None, workers: int = None) -> List[validator.ValidationError]:
+    """
+    Validates every label of a loaded bundle against its schemas
+    """
+    products = fullbundle.bundles + fullbundle.collections + fullbundle.products
+    return check_labels([p.label_path for p in products], fullbundle.sources, schema_directory, workers)
+
+
+def check_labels(label_paths: List[str], sources: Dict = None, schema_directory: str = None, workers: int = None) -> List[validator.ValidationError]:
+    """
+    Validates the given labels across a process pool. Labels that are held in memory by the source map, e.g. labels
+    read from an archive, are sent to the workers by value.
+    """
+    logger.info(f"Validating {len(label_paths)} labels against their schemas")
+    sources = sources or {}
+    labels = [(path, sources[path] if isinstance(sources.get(path), bytes) else None) for path in label_paths]
+    chunks = [labels[i:i + CHUNK_SIZE] for i in range(0, len(labels), CHUNK_SIZE)]
+
+    errors = []
+    progress = Progress(logger, "Validating labels against schemas", len(labels))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_initialize, initargs=(schema_directory,)) as executor:
+        for chunk, problems in zip(chunks, executor.map(_validate_chunk, chunks)):
+            progress.step(len(chunk))
+            errors.extend(validator.ValidationError(message, error_type, severity) for message, error_type, severity in problems)
+    progress.done()
+    return errors
+
+
+def validate_label(label_path: str, contents: bytes = None) -> List[Problem]:
+    """
+    Validates a single label in the current process. Returns (message, error_type, severity) tuples, which can be
+    sent back from a worker process.
+    """
+    try:
+        document = etree.fromstring(contents) if contents is not None else etree.parse(label_path).getroot()
+    except (etree.XMLSyntaxError, OSError) as e:
+        return [(f"Label is not well-formed XML: {label_path}: {e}", "label_not_well_formed", "error")]
+
+    locations = schema_locations(document)
+    if not locations:
+        return [(f"Label does not reference a schema in xsi:schemaLocation: {label_path}", "schema_location_missing", "warning")]
+
+    schema = _schema(locations)
+    if isinstance(schema, str):
+        # A label that cannot be validated must not pass as valid
+        hint = "" if _schema_directory else " (use a schema directory to validate without network access)"
+        return [(f"Could not load schemas for {label_path}: {schema}{hint}", "schema_unavailable", "error")]
+    if schema.validate(document):
+        return []
+    return [(f"Label does not conform to its schema: {label_path}:{e.line}: {e.message}", "label_schema_violation", "error")
+            for e in schema.error_log]
+
+
+def schema_locations(document: etree._Element) -> SchemaLocations:
+    """Reads the namespace and location pairs from the xsi:schemaLocation attribute of the root element"""
+    tokens = (document.get(f"{{{XSI_NAMESPACE}}}schemaLocation") or "").split()
+    return tuple(zip(tokens[0::2], tokens[1::2]))
+
+
+def _schema(locations: SchemaLocations) -> Union[etree.XMLSchema, str]:
+    """
+    Compiles the schemas for a set of locations, or returns the reason they could not be compiled. Both outcomes are
+    cached for the lifetime of the process.
+    """
+    if locations not in _schemas:
+        try:
+            if len(locations) == 1:
+                _schemas[locations] = etree.XMLSchema(etree.parse(_resolve(locations[0][1])))
+            else:
+                imports = "".join(f'<xs:import namespace="{namespace}" schemaLocation="{_resolve(location)}"/>'
+                                  for namespace, location in locations)
+                _schemas[locations] = etree.XMLSchema(etree.fromstring(
+                    f'<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">{imports}</xs:schema>'))
+            logger.debug("Compiled schemas: %s", locations)
+        except (etree.XMLSchemaParseError, etree.XMLSyntaxError, OSError) as e:
+            _schemas[locations] = str(e)
+    return _schemas[locations]
+
+
+def _resolve(location: str) -> str:
+    if _schema_directory:
+        local_path = os.path.join(_schema_directory, location.rstrip("/").rsplit("/", 1)[-1])
+        if os.path.isfile(local_path):
+            return os.path.abspath(local_path)
+    return location
+
+
+def _initialize(schema_directory: Optional[str]) -> None:
+    global _schema_directory
+    _schema_directory = schema_directory
+
+
+def _validate_chunk(labels: Iterable[Tuple[str, Optional[bytes]]]) -> List[Problem]:
+    return [problem for label_path, contents in labels for problem in validate_label(label_path, contents)]
@@ -0,0 +1,132 @@
+"""
+Verifies an integrated bundle using the record of how each of its files was produced.
+
+Reloading and re-checking a whole integrated bundle re-reads the entire archive. The writer already knows which files
+it copied and which it generated, so verification can be limited to what the delta bundle changed:
+
+* every output file is checked to exist, and copied files to have the size of their source
+* generated files, and files copied from outside the previous bundle, are hashed and compared to what was written
+* generated labels, and labels copied from outside the previous bundle, are parsed again
+* the bundle label must declare exactly the current collections, each rewritten or new collection label must agree
+  with its inventory, and each new product must be listed in the inventory of its collection
+"""
+import logging
+import os
+from typing import Dict, List, Optional
+
+from lxml import etree
+
+import bundleloader
+import bundlewriter
+import labeledit
+import localclient
+import pds4
+import validator
+from progress import Progress
+
+logger = logging.getLogger(__name__)
+
+
+def verify_integration(writer: bundlewriter.BundleWriter, previous_bundle_directory: str) -> List[validator.ValidationError]:
+    """
+    Verifies the output of a writer that recorded an integration. Files that were copied from the previous bundle are
+    only checked for their size; everything else is treated as new.
+    """
+    if writer.record is None:
+        raise Exception("The writer did not record the integration")
+    logger.info(f"Verifying {len(writer.record)} integrated files")
+    previous_root = os.path.realpath(previous_bundle_directory) + os.sep
+
+    def is_new(record: bundlewriter.OutputRecord) -> bool:
+        if record.source is None:
+            return True
+        source = writer.resolve(record.source)
+        return not (isinstance(source, str) and os.path.realpath(source).startswith(previous_root))
+
+    errors = []
+    new_labels = []
+    progress = Progress(logger, "Verifying integrated files", len(writer.record))
+    for dest_path, record in writer.record.items():
+        progress.step()
+        if not os.path.isfile(dest_path):
+            errors.append(validator.ValidationError(f"Integrated file is missing: {dest_path}", "integrated_file_missing"))
+            continue
+        new = is_new(record)
+        if record.source is not None:
+            expected_size = bundlewriter.source_size(writer.resolve(record.source))
+            if os.path.getsize(dest_path) != expected_size:
+                errors.append(validator.ValidationError(f"Integrated file {dest_path} has size {os.path.getsize(dest_path)}, "
+                                                        f"but its source {record.source} has size {expected_size}", "integrated_file_size_mismatch"))
+                continue
+            if new and not dest_path.endswith(".xml"):
+                expected_checksum = bundlewriter.source_checksum(writer.resolve(record.source))
+                if bundlewriter.source_checksum(dest_path) != expected_checksum:
+                    errors.append(validator.ValidationError(f"Integrated file {dest_path} differs from its source {record.source}", "integrated_file_checksum_mismatch"))
+        elif bundlewriter.source_checksum(dest_path) != record.checksum:
+            errors.append(validator.ValidationError(f"Integrated file {dest_path} differs from the contents that were written", "integrated_file_checksum_mismatch"))
+        if new and dest_path.endswith(".xml") and not bundleloader.is_superseded(dest_path):
+            new_labels.append(dest_path)
+    progress.done()
+
+    errors.extend(_verify_labels(writer.record, new_labels))
+    return errors
+
+
+def _verify_labels(output: Dict[str, bundlewriter.OutputRecord], new_labels: List[str]) -> List[validator.ValidationError]:
+    """
+    Parses the new and rewritten labels, and checks that the bundle label, collection labels and inventories agree
+    """
+    logger.info(f"Parsing {len(new_labels)} new or rewritten labels")
+    errors = []
+    products: Dict[str, pds4.Pds4Product] = {}
+    for label_path in new_labels:
+        try:
+            products[label_path] = bundleloader.load_local_product(label_path)
+        except Exception as e:
+            errors.append(validator.ValidationError(f"Could not parse integrated label {label_path}: {e}", "integrated_label_unparseable"))
+
+    # Collection labels that were passed through unchanged are only needed for their LIDVIDs
+    collections = [products[p] if p in products else pds4.Pds4Product(localclient.fetchlabel(p), label_path=p)
+                   for p in output.keys() if p.endswith(".xml") and bundleloader.is_collection(p)
+                   and not bundleloader.is_superseded(p) and (p in products or p not in new_labels)]
+    bundles = [p for path, p in products.items() if bundleloader.is_bundle(path)]
+    if len(bundles) != 1:
+        errors.append(validator.ValidationError(f"Expected one new bundle label, found {len(bundles)}", "integrated_bundle_label_missing"))
+    else:
+        errors.extend(validator.check_bundle_against_collections(bundles[0], collections))
+
+    for label_path, collection in products.items():
+        if isinstance(collection, pds4.CollectionProduct):
+            errors.extend(_verify_inventory(collection, rewritten=output[label_path].source is None))
+
+    inventoried = set(lidvid for c in products.values() if isinstance(c, pds4.CollectionProduct) for lidvid in c.inventory.products())
+    for label_path, product in products.items():
+        if isinstance(product, pds4.BasicProduct) and product.lidvid() not in inventoried:
+            errors.append(validator.ValidationError(f"New product {product.lidvid()} is not listed in the inventory of a new or updated collection", "integrated_product_not_inventoried"))
+    return errors
+
+
+def _verify_inventory(collection: pds4.CollectionProduct, rewritten: bool) -> List[validator.ValidationError]:
+    """
+    Checks that the record count, size and checksum in a collection label describe its inventory. Mismatches in labels
+    that were copied from the delta bundle are only warnings, since integration did not produce them.
+    """
+    severity = "error" if rewritten else "warning"
+    xmldoc = etree.parse(collection.label_path)
+
+    def value(path: str) -> Optional[str]:
+        elements = xmldoc.xpath(path, namespaces=labeledit.NSMAP)
+        return elements[0].text.strip() if elements and elements[0].text else None
+
+    errors = []
+    actual = {
+        "records": str(len(collection.inventory.products())),
+        "file_size": str(os.path.getsize(collection.inventory_path)),
+        "md5_checksum": bundlewriter.source_checksum(collection.inventory_path)
+    }
+    for name, actual_value in actual.items():
+        declared = value(f"//pds:File_Area_Inventory//pds:{name}")
+        if declared is not None and declared != actual_value:
+            errors.append(validator.ValidationError(f"Collection label {collection.label_path} declares {name} {declared}, "
+                                                    f"but its inventory has {actual_value}", "integrated_inventory_mismatch", severity))
+    return errors
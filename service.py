@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Runs MADI as a long-running service that accepts readiness check and integration jobs over a local HTTP API.
+
+Previous bundles are kept in memory between jobs, so a readiness check against a bundle that has already been loaded
+only needs to load and check the delta bundle.
+
+API:
+    POST /jobs       Submit a job. The body is a JSON object:
+                         {"action": "check" or "integrate",
+                          "previous": previous_bundle_directory,
+                          "deltas": [delta_bundle_directory, ...],
+                          "output": merged_bundle_directory (integrate only),
+                          "jaxa": false, "dry": false}
+                     Responds with the job id, or 503 if the job queue is full.
+    GET /jobs/<id>   Retrieve the status and results of a job.
+    GET /status      Retrieve the state of the job queue and the bundle cache.
+"""
+import argparse
+import http.server
+import itertools
+import json
+import logging
+import os
+import queue
+import socketserver
+import sys
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import archiveclient
+import bundlecache
+import bundleloader
+from ready import check_ready, summarize_errors
+from superseder import Composition, supersede
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Job:
+    id: int
+    action: str
+    previous: str
+    deltas: List[str]
+    output: Optional[str] = None
+    jaxa: bool = False
+    dry: bool = False
+    status: str = "queued"
+    errors: List[dict] = field(default_factory=list)
+    summary: str = ""
+    integrated: bool = False
+    failure: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "previous": self.previous,
+            "deltas": self.deltas,
+            "output": self.output,
+            "status": self.status,
+            "errors": self.errors,
+            "summary": self.summary,
+            "integrated": self.integrated,
+            "failure": self.failure
+        }
+
+
+class JobRunner:
+    """
+    Holds the bounded job queue and the worker threads that process it. Finished jobs are kept so that their
+    results can be retrieved, up to a fixed number of jobs.
+    """
+    def __init__(self, cache: bundlecache.BundleCache, workers: int, queue_size: int, history_size: int = 1000):
+        self.cache = cache
+        self.queue: "queue.Queue[Job]" = queue.Queue(maxsize=queue_size)
+        self.jobs: Dict[int, Job] = {}
+        self.history_size = history_size
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, name=f"worker-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, request: dict) -> Optional[Job]:
+        """
+        Queues a job for processing. Returns None if the queue is full.
+        """
+        action = request.get("action")
+        if action not in ("check", "integrate"):
+            raise ValueError(f"Unsupported action: {action}")
+        deltas = request.get("deltas") or ([request["delta"]] if request.get("delta") else [])
+        if not request.get("previous") or not deltas:
+            raise ValueError("Both a previous bundle and at least one delta bundle are required")
+        if action == "integrate" and not request.get("output"):
+            raise ValueError("An output directory is required to integrate")
+
+        with self.lock:
+            job = Job(next(self.ids), action, request["previous"], list(deltas), request.get("output"),
+                      bool(request.get("jaxa")), bool(request.get("dry")))
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            return None
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history_size:
+                del self.jobs[next(iter(self.jobs))]
+        return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            statuses = [x.status for x in self.jobs.values()]
+        return {
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "workers": len(self.threads),
+            "jobs": dict((status, statuses.count(status)) for status in set(statuses))
+        }
+
+    def _work(self) -> None:
+        while True:
+            job = self.queue.get()
+            try:
+                self.run(job)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job: Job) -> None:
+        job.status = "running"
+        logger.info(f"Starting job {job.id}: {job.action} {job.deltas} against {job.previous}")
+        delta_fullbundles = []
+        try:
+            previous_fullbundle = self.cache.get(job.previous)
+            delta_fullbundles = [bundleloader.load_local_bundle(x) for x in job.deltas]
+            delta_fullbundle = delta_fullbundles if len(delta_fullbundles) > 1 else delta_fullbundles[0]
+
+            composition = Composition(previous_fullbundle, delta_fullbundles, job.jaxa) if len(delta_fullbundles) > 1 else None
+            issues = check_ready(previous_fullbundle, delta_fullbundle, job.jaxa, composition=composition)
+            job.errors = [{"severity": x.severity, "error_type": x.error_type, "message": x.message} for x in issues]
+            job.summary = summarize_errors(issues)
+            if job.action == "integrate" and not any(x.severity == "error" for x in issues):
+                supersede(previous_fullbundle, delta_fullbundle, job.output, job.dry, job.jaxa, composition=composition)
+                job.integrated = True
+            job.status = "done"
+        except Exception as e:
+            logger.exception(f"Job {job.id} failed")
+            job.failure = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+        finally:
+            for fullbundle in delta_fullbundles:
+                archiveclient.close_archives(fullbundle.sources)
+        logger.info(f"Finished job {job.id}: {job.status}")
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    runner: JobRunner = None
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._respond(200, {"queue": self.runner.stats(), "cache": self.runner.cache.stats()})
+        elif self.path.startswith("/jobs/"):
+            try:
+                job = self.runner.get(int(self.path[len("/jobs/"):]))
+            except ValueError:
+                job = None
+            if job:
+                self._respond(200, job.to_dict())
+            else:
+                self._respond(404, {"error": f"No such job: {self.path}"})
+        else:
+            self._respond(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._respond(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = self.runner.submit(json.loads(self.rfile.read(length) or b"{}"))
+        except (ValueError, KeyError) as e:
+            self._respond(400, {"error": str(e)})
+            return
+        if job is None:
+            self._respond(503, {"error": "Job queue is full"})
+        else:
+            self._respond(202, job.to_dict())
+
+    def _respond(self, status: int, body: dict):
+        contents = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(runner: JobRunner, host: str = "127.0.0.1", port: int = 8750, socket_path: str = None) -> socketserver.BaseServer:
+    """
+    Creates an HTTP server for the job runner, listening on either a local TCP port or a unix socket
+    """
+    handler = type("BoundRequestHandler", (RequestHandler,), {"runner": runner})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8750)
+    parser.add_argument("-H", "--host", type=str, default="127.0.0.1")
+    parser.add_argument("-u", "--socket", type=str)
+    parser.add_argument("-w", "--workers", type=int, default=2)
+    parser.add_argument("-q", "--queue-size", type=int, default=16)
+    parser.add_argument("-m", "--cache-memory", type=int, default=4096,
+                        help="Approximate memory budget for cached bundles, in MB")
+    parser.add_argument("-i", "--check-interval", type=float, default=bundlecache.CHECK_INTERVAL,
+                        help="By default, every label and inventory of a cached bundle is checked for changes on every job, "
+                             "which stats the whole bundle each time. With a number of seconds, jobs only compare directory "
+                             "modification times, which notice files that are added, removed or renamed, and every file is checked "
+                             "at most this often. A file modified in place may then go unnoticed until the next full check")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(threadName)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+
+    cache = bundlecache.BundleCache(args.cache_memory * 1024 * 1024, args.check_interval)
+    runner = JobRunner(cache, args.workers, args.queue_size)
+    server = make_server(runner, args.host, args.port, args.socket)
+    logger.info(f"Listening on {args.socket if args.socket else f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+A compact, read-only catalog of collection inventories in shared memory, for the processes that merge them.
+
+Sending CollectionProduct objects to a process pool pickles their inventories into every task, which for a large
+collection costs more than the merge done in parallel. A SharedCatalog packs the inventory rows into a single
+multiprocessing.shared_memory block instead. Merge workers attach to the block by name and read the inventories they
+are given by index, without copying the rest.
+
+The block is a header followed by an array of 64-bit integers and a table of UTF-8 strings:
+
+* string offsets: the start of each inventory in the string table, followed by the end of the last one
+
+Each inventory is stored as a single string of status,lidvid rows, formatted as they are written to an inventory file
+and separated by CRLF, so that a worker decodes it in one step and can merge the rows as strings.
+"""
+import logging
+import struct
+from multiprocessing import shared_memory
+from typing import Iterable, List
+
+import pds4
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x4d414449434154  # "MADICAT"
+VERSION = 3
+HEADER = struct.Struct("<4q")
+ITEM_SIZE = 8
+
+ROW_SEPARATOR = "\r\n"
+
+
+class SharedCatalog:
+    """
+    A catalog in shared memory. The process that creates it owns the block and must unlink it when the workers are
+    done with it; attaching processes only close it. Can be used as a context manager, which does both as
+    appropriate.
+    """
+    def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+        self.memory = memory
+        self.owner = owner
+        self.name = memory.name
+        self.buffer = buffer = memory.buf.toreadonly()
+        magic, version, inventory_count, blob_size = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise Exception(f"Shared memory block {memory.name} does not hold a catalog")
+
+        offset = HEADER.size
+        self.string_offsets = buffer[offset:offset + (inventory_count + 1) * ITEM_SIZE].cast("q")
+        offset += (inventory_count + 1) * ITEM_SIZE
+        self.blob = buffer[offset:offset + blob_size]
+        self.inventory_count = inventory_count
+
+    @staticmethod
+    def create(collections: Iterable[pds4.CollectionProduct]) -> "SharedCatalog":
+        """Packs the inventories of the given collections into a new shared memory block, in the given order"""
+        strings = [ROW_SEPARATOR.join(f"{x.status},{x.lidvid}" for x in c.inventory.items.values()).encode("utf-8")
+                   for c in collections]
+        string_offsets = [0]
+        for value in strings:
+            string_offsets.append(string_offsets[-1] + len(value))
+        blob = b"".join(strings)
+        size = HEADER.size + len(string_offsets) * ITEM_SIZE + len(blob)
+
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        try:
+            HEADER.pack_into(memory.buf, 0, MAGIC, VERSION, len(strings), len(blob))
+            offset = HEADER.size
+            memory.buf[offset:offset + len(string_offsets) * ITEM_SIZE].cast("q")[:] = _int64s(string_offsets)
+            offset += len(string_offsets) * ITEM_SIZE
+            memory.buf[offset:offset + len(blob)] = blob
+        except BaseException:
+            memory.close()
+            memory.unlink()
+            raise
+        logger.debug("Created shared catalog %s of %d inventories in %d bytes", memory.name, len(strings), size)
+        return SharedCatalog(memory, owner=True)
+
+    @staticmethod
+    def attach(name: str) -> "SharedCatalog":
+        """Attaches to a catalog created by another process"""
+        # Pool workers share the resource tracker of the process that started them, which already tracks the block,
+        # so it is neither unregistered here nor unlinked when a worker exits
+        memory = shared_memory.SharedMemory(name=name)
+        return SharedCatalog(memory, owner=False)
+
+    def inventory_rows(self, index: int) -> List[str]:
+        """The status,lidvid rows of an inventory, in the order they were loaded"""
+        if not 0 <= index < self.inventory_count:
+            raise IndexError(index)
+        rows = bytes(self.blob[self.string_offsets[index]:self.string_offsets[index + 1]]).decode("utf-8")
+        return rows.split(ROW_SEPARATOR) if rows else []
+
+    def size(self) -> int:
+        return self.memory.size
+
+    def close(self) -> None:
+        for view in (self.string_offsets, self.blob, self.buffer):
+            view.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self) -> "SharedCatalog":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _int64s(values: List[int]) -> memoryview:
+    return memoryview(struct.pack(f"<{len(values)}q", *values)).cast("q")
@@ -0,0 +1,133 @@
+"""
+Integrates a delta bundle into a previous bundle that is too large to be loaded into memory.
+
+The delta bundle is loaded as usual, but the previous bundle never is. It is scanned one top-level directory (normally
+one collection) at a time, and each of its labels is parsed, copied to its place in the integrated bundle and then
+forgotten. Whether a previous product is kept or superseded is decided from the LIDs in the delta bundle. The memory
+used by the integration therefore grows with the size of the delta bundle and of the largest collection inventory,
+rather than with the size of the previous bundle. This does not cover the readiness check that precedes it, which
+loads the previous bundle, or a fingerprint of it, in full.
+
+The integrated bundle is the same as the one produced by superseder.supersede for a single delta bundle.
+"""
+import collections
+import logging
+from typing import List
+
+import archiveclient
+import bundleloader
+import bundlewriter
+import labelsniff
+import localclient
+import paths
+import pds4
+import superseder
+from progress import Progress
+
+logger = logging.getLogger(__name__)
+
+
+def stream_supersede(previous_bundle_directory: str, delta_fullbundle: pds4.FullBundle, merged_bundle_directory: str,
+                     dry: bool, jaxa: bool, writer: bundlewriter.BundleWriter = None) -> None:
+    """
+    Merges a delta bundle into the previous bundle directory, streaming the previous bundle from disk
+    """
+    archiveclient.check_integrable(delta_fullbundle.sources)
+    writer = writer or bundlewriter.DirectoryWriter(dry)
+    delta_bundle_directory = delta_fullbundle.path
+    writer.add_sources(delta_fullbundle.sources)
+    logger.info(f"Streaming integration of {previous_bundle_directory} "
+                f"with delta data from {delta_bundle_directory} into {merged_bundle_directory}")
+
+    delta_bundle_lids = set(x.lidvid().lid for x in delta_fullbundle.bundles)
+    delta_collections = dict((x.lidvid().lid, x) for x in delta_fullbundle.collections)
+    delta_product_lids = set(x.lidvid().lid for x in delta_fullbundle.products)
+
+    # The delta bundle is copied first, since the merged collection labels replace the copied delta labels
+    for p in delta_fullbundle.collections + delta_fullbundle.bundles + delta_fullbundle.products:
+        copy_product(p, delta_bundle_directory, merged_bundle_directory, writer)
+
+    previous_bundles: List[pds4.BundleProduct] = []
+    previous_collections: List[pds4.CollectionProduct] = []
+    counts = collections.Counter()
+    progress = Progress(logger, f"Streaming products from {previous_bundle_directory}")
+    for directory, scan in localclient.scan_groups(previous_bundle_directory):
+        logger.debug("Streaming products below %s", directory)
+        for label_path, kind in bundleloader.sniff_labels(directory, scan.labels):
+            progress.step()
+            if kind == labelsniff.COLLECTION:
+                collection = localclient.fetchcollection(label_path)
+                delta_collection = delta_collections.get(collection.lidvid().lid)
+                copy_product(collection, previous_bundle_directory, merged_bundle_directory, writer, superseded=delta_collection is not None)
+                if delta_collection is not None:
+                    superseder.generate_collection(collection, delta_collection, previous_bundle_directory,
+                                                   delta_bundle_directory, merged_bundle_directory, writer)
+                counts["collections superseded" if delta_collection is not None else "collections kept"] += 1
+                collection.inventory = None
+                previous_collections.append(collection)
+            elif kind == labelsniff.BUNDLE:
+                bundle = localclient.fetchbundle(label_path)
+                superseded = bundle.lidvid().lid in delta_bundle_lids
+                copy_label(bundle, previous_bundle_directory, merged_bundle_directory, writer, superseded)
+                copy_file(bundle.readme_path, bundle, previous_bundle_directory, merged_bundle_directory, writer, superseded=True)
+                counts["bundles superseded" if superseded else "bundles kept"] += 1
+                previous_bundles.append(bundle)
+            else:
+                product = localclient.fetchproduct(label_path)
+                superseded = product.lidvid().lid in delta_product_lids
+                copy_product(product, previous_bundle_directory, merged_bundle_directory, writer, superseded)
+                counts["products superseded" if superseded else "products kept"] += 1
+
+        for label_path, kind in bundleloader.sniff_labels(directory, scan.superseded_labels):
+            progress.step()
+            if kind == labelsniff.COLLECTION:
+                copy_product(localclient.fetchcollection(label_path), previous_bundle_directory, merged_bundle_directory, writer)
+            elif kind == labelsniff.BUNDLE:
+                copy_product(localclient.fetchbundle(label_path), previous_bundle_directory, merged_bundle_directory, writer)
+            else:
+                product = localclient.fetchproduct(label_path)
+                copy_label(product, previous_bundle_directory, merged_bundle_directory, writer)
+                for data_path in product.data_paths:
+                    if writer.exists(data_path):
+                        copy_file(data_path, product, previous_bundle_directory, merged_bundle_directory, writer)
+            counts["previously superseded"] += 1
+
+        if directory == previous_bundle_directory and not previous_bundles:
+            raise Exception(f"Could not find bundle product in: {previous_bundle_directory}")
+    progress.done()
+    logger.info("Previous bundle: " + ", ".join(f"{label}: {count}" for label, count in sorted(counts.items())))
+
+    if jaxa:
+        missing_collections = superseder.get_missing_collections(previous_bundles, delta_fullbundle.bundles, previous_collections)
+        if len(missing_collections):
+            superseder.add_missing_collections(delta_fullbundle.bundles, missing_collections, delta_bundle_directory, merged_bundle_directory, writer)
+
+    writer.finish()
+    logger.info(f"Streaming integration of {previous_bundle_directory} "
+                f"with delta data from {delta_bundle_directory} into {merged_bundle_directory} -- Complete")
+
+
+def copy_product(p: pds4.Pds4Product, old_base: str, new_base: str, writer: bundlewriter.BundleWriter, superseded=False) -> None:
+    """
+    Copies the label of a product and the files that belong to it: the data files of a basic product, the inventory of
+    a collection or the readme of a bundle
+    """
+    copy_label(p, old_base, new_base, writer, superseded)
+    if isinstance(p, pds4.BasicProduct):
+        for data_path in p.data_paths:
+            copy_file(data_path, p, old_base, new_base, writer, superseded)
+    elif isinstance(p, pds4.CollectionProduct):
+        copy_file(p.inventory_path, p, old_base, new_base, writer, superseded)
+    elif isinstance(p, pds4.BundleProduct):
+        copy_file(p.readme_path, p, old_base, new_base, writer, superseded)
+
+
+def copy_label(p: pds4.Pds4Product, old_base: str, new_base: str, writer: bundlewriter.BundleWriter, superseded=False) -> None:
+    copy_file(p.label_path, p, old_base, new_base, writer, superseded)
+
+
+def copy_file(path: str, p: pds4.Pds4Product, old_base: str, new_base: str, writer: bundlewriter.BundleWriter, superseded=False) -> None:
+    """Copies one file of a product to the place it has in the integrated bundle"""
+    if path:
+        new_path = paths.relocate_path(paths.generate_product_path(path, superseded=superseded, vid=p.lidvid().vid), old_base, new_base)
+        superseder.copy_to_path(path, new_path, writer)
@@ -1,3 +1,5 @@
+import concurrent.futures
+import dataclasses
 import hashlib
 import itertools
 
@@ -6,19 +8,37 @@ import labeledit
 import lids
 import logging
 import os
-import shutil
 import xmlrpc.client
-from typing import List, Iterable, Tuple
+from typing import Callable, Dict, List, Iterable, Optional, Tuple, Union
 
+import archiveclient
+import bundlewriter
 import paths
 import pds4
 
 import re
 
+import taskgraph
 import validator
+from progress import Progress
+from sharedcatalog import SharedCatalog
 
 logger = logging.getLogger(__name__)
 
+# An operation that a writer may take over with BundleWriter.defer, with the arguments of generate_collection
+MERGE_COLLECTION = "merge_collection"
+
+# Label edits and merges hold the interpreter lock for most of their runtime, so more threads would not speed them up;
+# merges use processes of their own instead
+CPU_PHASE_WORKERS = 1
+
+# Below this many inventory rows in all, starting a pool of merge processes costs more than it saves, as measured with
+# benchmarks/merge_benchmark.py
+POOL_MIN_ROWS = 250000
+
+# The catalog of inventories that a merge worker process attached to
+_catalog: Optional[SharedCatalog] = None
+
 
 def get_missing_collections(previous_bundles: List[pds4.BundleProduct], delta_bundles: List[pds4.BundleProduct], previous_collections: List[pds4.CollectionProduct]) -> list[label.BundleMemberEntry]:
     if len(delta_bundles) > 1:
@@ -38,21 +58,159 @@ def get_missing_collections(previous_bundles: List[pds4.BundleProduct], delta_bu
     return []
 
 
-def add_missing_collections(bundles: List[pds4.BundleProduct], missing_collections: List[label.BundleMemberEntry], delta_bundle_directory: str, merged_bundle_directory: str, dry: bool):
+def add_missing_collections(bundles: List[pds4.BundleProduct], missing_collections: List[label.BundleMemberEntry], delta_bundle_directory: str, merged_bundle_directory: str, writer: bundlewriter.BundleWriter):
     for bundle in bundles:
         original_path = paths.generate_product_path(bundle.label_path)
         new_path = paths.relocate_path(original_path, delta_bundle_directory, merged_bundle_directory)
         logger.info(f"JAXA: Adding additional collections to bundle label at {new_path}")
-        if not dry:
-            labeledit.inject_bundle_member_entries(new_path, missing_collections)
+        if not writer.dry:
+            writer.write(new_path, labeledit.add_bundle_member_entries(writer.read_output(new_path), missing_collections))
 
 
-def supersede(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, merged_bundle_directory, dry: bool, jaxa: bool) -> None:
+class Composition:
+    """
+    The bundles that each of an ordered list of delta bundles is integrated with: the previous bundle for the first
+    delta, and the in-memory composition of the deltas before it for each later one. Bundles are composed when they are
+    first asked for and then kept, so that a chain checked for readiness and then integrated is only composed once.
+    """
+    def __init__(self, previous_fullbundle: pds4.FullBundle, delta_fullbundles: List[pds4.FullBundle], jaxa: bool,
+                 merge_workers: int = 1):
+        self.delta_fullbundles = delta_fullbundles
+        self.jaxa = jaxa
+        self.merge_workers = merge_workers
+        self.fullbundles = [previous_fullbundle]
+
+    def previous(self, index: int) -> pds4.FullBundle:
+        """The bundle that the delta bundle at index is integrated with"""
+        while len(self.fullbundles) <= index:
+            count = len(self.fullbundles)
+            self.fullbundles.append(compose(self.fullbundles[-1], self.delta_fullbundles[count - 1], self.jaxa, self.merge_workers))
+        return self.fullbundles[index]
+
+
+def supersede(previous_fullbundle: pds4.FullBundle, delta_fullbundle: Union[pds4.FullBundle, List[pds4.FullBundle]],
+              merged_bundle_directory, dry: bool, jaxa: bool, writer: bundlewriter.BundleWriter = None,
+              catalog: "catalog.Catalog" = None, merge_workers: int = 1, phase_workers: int = 1,
+              composition: Composition = None) -> None:
     """
     Merges the bundles together and supersedes any products that have a newer version.
+
+    When given an ordered list of delta bundles, each delta is applied to the result of the ones before it. The
+    intermediate bundles are only composed in memory, and only the final bundle is written. A composition of the same
+    bundles that was already used to check their readiness may be passed in, so that they are not composed again.
+
+    If a version-history catalog is given, it is updated with each delta bundle once the integration is complete.
+    Collection inventories are merged by up to merge_workers processes at a time, and the phases of the final
+    integration are run by up to phase_workers threads (see do_supersede).
+    """
+    delta_fullbundles = delta_fullbundle if isinstance(delta_fullbundle, list) else [delta_fullbundle]
+    for fullbundle in delta_fullbundles:
+        archiveclient.check_integrable(fullbundle.sources)
+    composition = composition or Composition(previous_fullbundle, delta_fullbundles, jaxa, merge_workers)
+    integrations = []
+    for index, intermediate_fullbundle in enumerate(delta_fullbundles[:-1]):
+        composed_fullbundle = composition.previous(index + 1)
+        composed_output = bundlewriter.VirtualWriter()
+        composed_output.files = composed_fullbundle.sources
+        integrations.append((composition.previous(index), intermediate_fullbundle, composed_fullbundle.path, composed_output))
+    previous_fullbundle = composition.previous(len(delta_fullbundles) - 1)
+
+    writer = writer or bundlewriter.DirectoryWriter(dry)
+    do_supersede(previous_fullbundle, delta_fullbundles[-1], merged_bundle_directory, jaxa, writer, merge_workers, phase_workers)
+    writer.finish()
+
+    if catalog is not None and not writer.dry:
+        for integration in integrations:
+            catalog.record_integration(*integration)
+        catalog.record_integration(previous_fullbundle, delta_fullbundles[-1], merged_bundle_directory, writer)
+
+
+def compose(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, jaxa: bool, merge_workers: int = 1) -> pds4.FullBundle:
+    """
+    Integrates a delta bundle in memory, and returns the resulting virtual bundle. The files of the virtual bundle are
+    described by its source map, so that it can be checked against or integrated with the next delta bundle.
     """
     previous_bundle_directory = previous_fullbundle.path
     delta_bundle_directory = delta_fullbundle.path
+    merged_bundle_directory = delta_bundle_directory.rstrip(os.sep) + ".merged"
+    logger.info(f"Composing {previous_bundle_directory} with {delta_bundle_directory} in memory")
+
+    writer = bundlewriter.VirtualWriter()
+    do_supersede(previous_fullbundle, delta_fullbundle, merged_bundle_directory, jaxa, writer, merge_workers)
+
+    previous_bundles_to_keep, previous_bundles_to_supersede, _ = find_products_to_supersede(previous_fullbundle.bundles,
+                                                                                         delta_fullbundle.bundles)
+    previous_collections_to_keep, previous_collections_to_supersede, _ = find_products_to_supersede(previous_fullbundle.collections,
+                                                                                                 delta_fullbundle.collections)
+    previous_products_to_keep, previous_products_to_supersede, _ = find_products_to_supersede(previous_fullbundle.products,
+                                                                                           delta_fullbundle.products)
+
+    def from_previous(products: Iterable[pds4.Pds4Product], superseded=False) -> List[pds4.Pds4Product]:
+        return [relocate_product(p, previous_bundle_directory, merged_bundle_directory, superseded) for p in products]
+
+    def from_delta(products: Iterable[pds4.Pds4Product]) -> List[pds4.Pds4Product]:
+        return [relocate_product(p, delta_bundle_directory, merged_bundle_directory) for p in products]
+
+    bundles = from_delta(delta_fullbundle.bundles)
+    if jaxa:
+        missing_collections = get_missing_collections(previous_fullbundle.bundles, delta_fullbundle.bundles, previous_fullbundle.collections)
+        for bundle in bundles:
+            bundle.label = dataclasses.replace(bundle.label, bundle_member_entries=bundle.label.bundle_member_entries + missing_collections)
+
+    previous_collections_by_lid = dict((x.lidvid().lid, x) for x in previous_collections_to_supersede)
+    collections = from_previous(previous_collections_to_keep) + from_delta(delta_fullbundle.collections)
+    for collection in collections:
+        previous_collection = previous_collections_by_lid.get(collection.lidvid().lid)
+        if previous_collection and isinstance(collection, pds4.CollectionProduct):
+            collection.inventory = merge_inventories(previous_collection, collection)
+
+    superseded_collections = from_previous(previous_fullbundle.superseded_collections) + from_previous(previous_collections_to_supersede, True)
+    for collection in superseded_collections:
+        collection.inventory = None
+
+    return pds4.FullBundle(
+        merged_bundle_directory,
+        bundles + from_previous(previous_bundles_to_keep),
+        from_previous(previous_fullbundle.superseded_bundles) + from_previous(previous_bundles_to_supersede, True),
+        collections,
+        superseded_collections,
+        from_previous(previous_products_to_keep) + from_delta(delta_fullbundle.products),
+        from_previous(previous_fullbundle.superseded_products) + from_previous(previous_products_to_supersede, True),
+        sources=writer.files)
+
+
+def relocate_product(p: pds4.Pds4Product, old_base: str, new_base: str, superseded=False) -> pds4.Pds4Product:
+    """
+    Creates a copy of a product with its files moved to the location they will have in a new bundle. This is the
+    same location that the copy functions below will place them in.
+    """
+    vid = p.lidvid().vid
+
+    def relocate(path: str) -> str:
+        return paths.relocate_path(paths.generate_product_path(path, superseded=superseded, vid=vid), old_base, new_base) if path else path
+
+    if isinstance(p, pds4.CollectionProduct):
+        return pds4.CollectionProduct(p.label, p.inventory, label_path=relocate(p.label_path), inventory_path=relocate(p.inventory_path))
+    if isinstance(p, pds4.BundleProduct):
+        return pds4.BundleProduct(p.label, label_path=relocate(p.label_path), readme_path=relocate(p.readme_path))
+    if isinstance(p, pds4.BasicProduct):
+        return pds4.BasicProduct(p.label, label_path=relocate(p.label_path), data_paths=[relocate(d) for d in p.data_paths])
+    return pds4.Pds4Product(p.label, label_path=relocate(p.label_path))
+
+
+def do_supersede(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullBundle, merged_bundle_directory,
+                 jaxa: bool, writer: bundlewriter.BundleWriter, merge_workers: int = 1, phase_workers: int = 1) -> None:
+    """
+    Merges a single delta bundle into the previous bundle, sending the results to the given writer.
+
+    The phases of the integration are declared as a task graph. With more than one phase worker, and a writer that
+    supports it, independent phases run at the same time: copies on a pool of phase_workers threads, and label edits
+    and collection merges on a thread of their own. Otherwise the phases run one after another.
+    """
+    previous_bundle_directory = previous_fullbundle.path
+    delta_bundle_directory = delta_fullbundle.path
+    writer.add_sources(previous_fullbundle.sources)
+    writer.add_sources(delta_fullbundle.sources)
 
     logger.info(f"Integrate {previous_bundle_directory} "
                 f"with delta data from {delta_bundle_directory} into {merged_bundle_directory}")
@@ -87,53 +245,69 @@ def supersede(previous_fullbundle: pds4.FullBundle, delta_fullbundle: pds4.FullB
                       merged_bundle_directory,
                       "Products")
 
-    do_copy_label(itertools.chain(previous_bundles_to_keep,
-                                  previous_collections_to_keep,
-                                  previous_products_to_keep,),
-                  previous_bundle_directory,
-                  merged_bundle_directory, dry)
-    do_copy_label(itertools.chain(previous_bundles_to_supersede,
-                                  previous_collections_to_supersede,
-                                  previous_products_to_supersede),
-                  previous_bundle_directory,
-                  merged_bundle_directory, dry, superseded=True)
-    do_copy_label(itertools.chain(delta_fullbundle.collections,
-                                  delta_fullbundle.bundles,
-                                  delta_fullbundle.products), delta_bundle_directory, merged_bundle_directory, dry)
+    # Every phase writes its own output files, except that the delta bundle and collection labels are copied first and
+    # then edited by the JAXA injection and the collection merges
+    graph = taskgraph.TaskGraph()
+    graph.add("copy previous labels", lambda: do_copy_label(itertools.chain(previous_bundles_to_keep,
+                                                                            previous_collections_to_keep,
+                                                                            previous_products_to_keep,),
+                                                            previous_bundle_directory,
+                                                            merged_bundle_directory, writer))
+    graph.add("copy superseded labels", lambda: do_copy_label(itertools.chain(previous_bundles_to_supersede,
+                                                                              previous_collections_to_supersede,
+                                                                              previous_products_to_supersede),
+                                                              previous_bundle_directory,
+                                                              merged_bundle_directory, writer, superseded=True))
+    delta_labels = graph.add("copy delta labels", lambda: do_copy_label(itertools.chain(delta_fullbundle.collections,
+                                                                                        delta_fullbundle.bundles,
+                                                                                        delta_fullbundle.products),
+                                                                        delta_bundle_directory, merged_bundle_directory, writer))
 
     # TODO update the bundle so that it includes collections that were not declared in the delta (for jaxa)
     if jaxa:
-        missing_collections = get_missing_collections(previous_fullbundle.bundles, delta_fullbundle.bundles, previous_fullbundle.collections)
-        if len(missing_collections):
-            add_missing_collections(delta_fullbundle.bundles, missing_collections, delta_bundle_directory, merged_bundle_directory, dry)
-
-    do_copy_data(previous_products_to_keep, previous_bundle_directory, merged_bundle_directory, dry)
-    do_copy_data(previous_products_to_supersede, previous_bundle_directory, merged_bundle_directory, dry, superseded=True)
-    do_copy_data(delta_fullbundle.products, delta_bundle_directory, merged_bundle_directory, dry)
-
-    do_copy_readme(previous_fullbundle.superseded_bundles, previous_bundle_directory, merged_bundle_directory, superseded=True)
-    do_copy_readme(previous_fullbundle.bundles, previous_bundle_directory, merged_bundle_directory, superseded=True)
-    do_copy_readme(delta_fullbundle.bundles, delta_bundle_directory, merged_bundle_directory)
-
-    do_copy_inventory(previous_collections_to_supersede, previous_bundle_directory, merged_bundle_directory, superseded=True, dry=dry)
-
-    copy_unmodified_collections(previous_collections_to_keep, previous_bundle_directory, merged_bundle_directory, dry)
-    copy_unmodified_collections(new_collections, delta_bundle_directory, merged_bundle_directory, dry)
-
-    generate_collections(previous_collections_to_supersede,
-                         delta_fullbundle.collections,
-                         previous_bundle_directory,
-                         delta_bundle_directory,
-                         merged_bundle_directory,
-                         dry)
-
-    copy_previously_superseded_products(
+        def inject_missing_collections():
+            missing_collections = get_missing_collections(previous_fullbundle.bundles, delta_fullbundle.bundles, previous_fullbundle.collections)
+            if len(missing_collections):
+                add_missing_collections(delta_fullbundle.bundles, missing_collections, delta_bundle_directory, merged_bundle_directory, writer)
+        graph.add("add missing collections", inject_missing_collections, taskgraph.CPU, after=[delta_labels])
+
+    graph.add("copy previous data", lambda: do_copy_data(previous_products_to_keep, previous_bundle_directory, merged_bundle_directory, writer))
+    graph.add("copy superseded data", lambda: do_copy_data(previous_products_to_supersede, previous_bundle_directory, merged_bundle_directory,
+                                                           writer, superseded=True))
+    graph.add("copy delta data", lambda: do_copy_data(delta_fullbundle.products, delta_bundle_directory, merged_bundle_directory, writer))
+
+    graph.add("copy readmes", lambda: (
+        do_copy_readme(previous_fullbundle.superseded_bundles, previous_bundle_directory, merged_bundle_directory, writer, superseded=True),
+        do_copy_readme(previous_fullbundle.bundles, previous_bundle_directory, merged_bundle_directory, writer, superseded=True),
+        do_copy_readme(delta_fullbundle.bundles, delta_bundle_directory, merged_bundle_directory, writer)))
+
+    graph.add("copy superseded inventories", lambda: do_copy_inventory(previous_collections_to_supersede, previous_bundle_directory,
+                                                                       merged_bundle_directory, writer, superseded=True))
+
+    graph.add("copy unmodified collections", lambda: (
+        copy_unmodified_collections(previous_collections_to_keep, previous_bundle_directory, merged_bundle_directory, writer),
+        copy_unmodified_collections(new_collections, delta_bundle_directory, merged_bundle_directory, writer)))
+
+    graph.add("merge collections", lambda: generate_collections(previous_collections_to_supersede,
+                                                                delta_fullbundle.collections,
+                                                                previous_bundle_directory,
+                                                                delta_bundle_directory,
+                                                                merged_bundle_directory,
+                                                                writer,
+                                                                merge_workers), taskgraph.CPU, after=[delta_labels])
+
+    graph.add("copy previously superseded products", lambda: copy_previously_superseded_products(
         previous_fullbundle.superseded_products,
         previous_fullbundle.superseded_collections,
         previous_fullbundle.superseded_bundles,
         previous_bundle_directory,
         merged_bundle_directory,
-        dry)
+        writer))
+
+    if phase_workers > 1 and not writer.thread_safe:
+        logger.info(f"Running integration phases one at a time, since {type(writer).__name__} does not support concurrent phases")
+    graph.run({taskgraph.IO: phase_workers, taskgraph.CPU: CPU_PHASE_WORKERS} if phase_workers > 1 and writer.thread_safe else None)
+    logger.info(f"Integration phases:\n{graph.report()}")
 
     logger.info(f"Integrate {previous_bundle_directory} "
                 f"with delta data from {delta_bundle_directory} into {merged_bundle_directory} -- Complete")
@@ -144,19 +318,68 @@ def generate_collections(previous_collections_to_supersede: List[pds4.Pds4Produc
                          previous_bundle_directory: str,
                          delta_bundle_directory: str,
                          merged_bundle_directory: str,
-                         dry: bool) -> None:
+                         writer: bundlewriter.BundleWriter,
+                         workers: int = 1) -> None:
     """
-    Matches up previous and delta collections and merges their inventories.
+    Matches up previous and delta collections and merges their inventories. With more than one worker, and enough
+    inventory rows to repay starting them, the collections are merged in a pool of processes. Their outputs are still written, and their log messages emitted, one collection
+    at a time in the original order. If any collection cannot be merged, the others are still merged before the
+    failures are raised.
     """
     logger.info(f"Merging collection inventories")
+    merges = []
     for previous_collection in previous_collections_to_supersede:
-        logger.info(f"Merging collection inventory: {previous_collection.lidvid()}")
         if isinstance(previous_collection, pds4.CollectionProduct):
             previous_collection_lid = previous_collection.lidvid().lid
             delta_collection = [x for x in delta_collections
                                 if x.lidvid().lid == previous_collection_lid][0]
+            if not writer.defer(MERGE_COLLECTION, {
+                    "previous_label_path": previous_collection.label_path,
+                    "delta_label_path": delta_collection.label_path,
+                    "previous_bundle_directory": previous_bundle_directory,
+                    "delta_bundle_directory": delta_bundle_directory,
+                    "merged_bundle_directory": merged_bundle_directory,
+                    "outputs": collection_output_paths(delta_collection, delta_bundle_directory, merged_bundle_directory)}):
+                merges.append((previous_collection, delta_collection))
+        else:
+            logger.info(f"Merging collection inventory: {previous_collection.lidvid()}")
+
+    rows = sum(len(p.inventory.items) + len(d.inventory.items) for p, d in merges)
+    if workers > 1 and len(merges) > 1 and rows < POOL_MIN_ROWS:
+        logger.info(f"Merging {len(merges)} collections in this process, as {rows} inventory rows are too few for a pool")
+    if workers <= 1 or len(merges) <= 1 or rows < POOL_MIN_ROWS:
+        for previous_collection, delta_collection in merges:
+            logger.info(f"Merging collection inventory: {previous_collection.lidvid()}")
             generate_collection(previous_collection, delta_collection, previous_bundle_directory, delta_bundle_directory,
-                                merged_bundle_directory, dry)
+                                merged_bundle_directory, writer)
+        return
+
+    # The inventories are shared with the worker processes through a catalog in shared memory, rather than pickled
+    # into each task
+    logger.info(f"Merging {len(merges)} collections with {min(workers, len(merges))} processes")
+    failures = []
+    with SharedCatalog.create(itertools.chain.from_iterable(merges)) as catalog, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(merges)), initializer=_init_merge_process,
+                                                   initargs=(logging.getLogger().getEffectiveLevel(), catalog.name)) as executor:
+        futures = [executor.submit(_merge_in_process,
+                                   _without_inventory(previous_collection), 2 * index,
+                                   _without_inventory(delta_collection), 2 * index + 1,
+                                   delta_bundle_directory, merged_bundle_directory,
+                                   None if writer.dry else writer.read(delta_collection.label_path))
+                   for index, (previous_collection, delta_collection) in enumerate(merges)]
+        for (previous_collection, delta_collection), future in zip(merges, futures):
+            try:
+                records, outputs = future.result()
+            except Exception as e:
+                logger.error(f"Could not merge collection {previous_collection.lidvid()} with {delta_collection.lidvid()}: {e}")
+                failures.append(str(delta_collection.lidvid()))
+                continue
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            for path, contents in outputs:
+                writer.write(path, contents)
+    if failures:
+        raise Exception(f"Could not merge collections: {failures}")
 
 
 def generate_collection(previous_collection: pds4.CollectionProduct,
@@ -164,34 +387,131 @@ def generate_collection(previous_collection: pds4.CollectionProduct,
                         previous_bundle_directory: str,
                         delta_bundle_directory: str,
                         merged_bundle_directory: str,
-                        dry: bool) -> None:
+                        writer: bundlewriter.BundleWriter) -> None:
     """
     Merges the inventories from the previous and delta collection and updates the label file with the new
     record count.
     """
-    inventory = pds4.CollectionInventory()
-    inventory.ingest_new_inventory(previous_collection.inventory)
-    inventory.ingest_new_inventory(delta_collection.inventory)
+    inventory_output, label_output = merge_collection(previous_collection, delta_collection, delta_bundle_directory, merged_bundle_directory)
+    writer.write(*inventory_output)
+    if not writer.dry:
+        writer.write(label_output[0], label_output[1](writer.read(delta_collection.label_path)))
+
+
+def merge_collection(previous_collection: pds4.CollectionProduct,
+                     delta_collection: pds4.CollectionProduct,
+                     delta_bundle_directory: str,
+                     merged_bundle_directory: str) -> Tuple[Tuple[str, str], Tuple[str, Callable[[bytes], str]]]:
+    """
+    Merges the inventories of a collection. Returns the path and contents of the merged inventory, and the path of the
+    merged label with a function that patches the delta collection label to describe the merged inventory.
+    """
+    inventory = merge_inventories(previous_collection, delta_collection)
     previous_count = len(previous_collection.inventory.products())
     delta_count = len(delta_collection.inventory.products())
     product_count = len(inventory.products())
     logger.info(f"Merged collection has {product_count} products after adding {delta_count} to {previous_count}")
-    inventory_path = paths.relocate_path(delta_collection.inventory_path,
-                                         delta_bundle_directory,
-                                         merged_bundle_directory)
-
-    inventory_contents = inventory.to_csv() + "\r\n"
-    if not dry:
-        logger.info(f"Writing merged inventory to {inventory_path}")
-        with open(inventory_path, 'w') as f:
-            f.write(inventory_contents)
-    else:
-        logger.info(f"Skipped: Writing merged inventory to {inventory_path}")
-
-    new_path = paths.relocate_path(delta_collection.label_path, delta_bundle_directory, merged_bundle_directory)
+    return _collection_outputs(inventory.to_csv() + "\r\n", product_count, delta_collection, delta_bundle_directory, merged_bundle_directory)
+
+
+def _collection_outputs(inventory_contents: str, product_count: int, delta_collection: pds4.CollectionProduct, delta_bundle_directory: str,
+                        merged_bundle_directory: str) -> Tuple[Tuple[str, str], Tuple[str, Callable[[bytes], str]]]:
+    new_path, inventory_path = collection_output_paths(delta_collection, delta_bundle_directory, merged_bundle_directory)
+    logger.info(f"Writing merged inventory to {inventory_path}")
+
     checksum = hashlib.md5(inventory_contents.encode('utf-8')).hexdigest()
-    if not dry:
-        labeledit.update_collection_inventory(delta_collection.label_path, new_path, product_count, len(inventory_contents), checksum)
+    return ((inventory_path, inventory_contents),
+            (new_path, lambda label_contents: labeledit.patch_collection_inventory(label_contents, product_count, len(inventory_contents), checksum)))
+
+
+class _RecordCollector(logging.Handler):
+    """Keeps the log records of a collection merge, so that they can be emitted by the parent process"""
+    def __init__(self):
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        # Records are pickled, so their message is formatted here
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _init_merge_process(level: int, catalog_name: str) -> None:
+    global _catalog
+    root = logging.getLogger()
+    root.handlers = []
+    root.setLevel(level)
+    _catalog = SharedCatalog.attach(catalog_name)
+
+
+def _without_inventory(collection: pds4.CollectionProduct) -> pds4.CollectionProduct:
+    return pds4.CollectionProduct(collection.label, None, label_path=collection.label_path, inventory_path=collection.inventory_path)
+
+
+def _merge_in_process(previous_collection: pds4.CollectionProduct, previous_index: int,
+                      delta_collection: pds4.CollectionProduct, delta_index: int,
+                      delta_bundle_directory: str, merged_bundle_directory: str,
+                      label_contents: Optional[bytes]) -> Tuple[List[logging.LogRecord], List[Tuple[str, str]]]:
+    """Merges one collection in a worker process, returning its log records and the files to write"""
+    collector = _RecordCollector()
+    root = logging.getLogger()
+    root.addHandler(collector)
+    try:
+        previous_rows = _catalog.inventory_rows(previous_index)
+        delta_rows = _catalog.inventory_rows(delta_index)
+        logger.info(f"Merging collection inventory: {previous_collection.lidvid()}")
+        rows = merge_inventory_rows(previous_rows, delta_rows)
+        logger.info(f"Merged collection has {len(rows)} products after adding {len(delta_rows)} to {len(previous_rows)}")
+        inventory_output, (label_path, patch) = _collection_outputs("\r\n".join(rows) + "\r\n", len(rows), delta_collection,
+                                                                    delta_bundle_directory, merged_bundle_directory)
+        outputs = [inventory_output]
+        if label_contents is not None:
+            outputs.append((label_path, patch(label_contents)))
+        return collector.records, outputs
+    finally:
+        root.removeHandler(collector)
+
+
+def collection_output_paths(delta_collection: pds4.CollectionProduct, delta_bundle_directory: str, merged_bundle_directory: str) -> Tuple[str, str]:
+    """The paths of the label and inventory written for a merged collection"""
+    return (paths.relocate_path(delta_collection.label_path, delta_bundle_directory, merged_bundle_directory),
+            paths.relocate_path(delta_collection.inventory_path, delta_bundle_directory, merged_bundle_directory))
+
+
+def merge_inventories(previous_collection: pds4.CollectionProduct, delta_collection: pds4.CollectionProduct) -> pds4.CollectionInventory:
+    """
+    Combines the inventories of the previous and delta collection. Newer versions of a product replace older ones.
+    """
+    inventory = pds4.CollectionInventory()
+    inventory.ingest_new_inventory(previous_collection.inventory)
+    inventory.ingest_new_inventory(delta_collection.inventory)
+    return inventory
+
+
+def merge_inventory_rows(previous_rows: List[str], delta_rows: List[str]) -> List[str]:
+    """
+    Combines the status,lidvid rows of the previous and delta inventories in the same way as merge_inventories, and
+    returns them sorted as CollectionInventory.to_csv writes them. The rows are compared as strings, and versions are
+    only parsed when a delta row replaces a previous one, so the inventories need not be parsed into LidVids. Each
+    inventory must hold at most one row per LID, as a loaded inventory does.
+    """
+    merged: Dict[str, str] = {}
+    for row in previous_rows:
+        merged[row.partition(",")[2].rpartition("::")[0]] = row
+    for row in delta_rows:
+        lidvid = row.partition(",")[2]
+        lid, _, vid = lidvid.rpartition("::")
+        previous = merged.get(lid)
+        if previous is not None:
+            previous_lidvid = previous.partition(",")[2]
+            if lids.Vid.parse(previous_lidvid.rpartition("::")[2]) >= lids.Vid.parse(vid):
+                raise Exception(f"Product {lidvid} is not newer than the version that already exists in the inventory {previous_lidvid}")
+        merged[lid] = row
+    return sorted(merged.values())
 
 
 def report_superseded(products_to_keep: List[pds4.Pds4Product],
@@ -204,12 +524,14 @@ def report_superseded(products_to_keep: List[pds4.Pds4Product],
     """
     Logs which products will be superseded by MADI
     """
-    logger.info(f"{label} to supersede: {[str(x.lidvid()) for x in products_to_supersede]}")
-    report_new_paths(products_to_supersede, previous_bundle_dir, merged_bundle_dir, True)
-    logger.info(f"{label} to keep: {[str(x.lidvid()) for x in products_to_keep]}")
-    report_new_paths(products_to_keep, previous_bundle_dir, merged_bundle_dir)
-    logger.info(f"New {label.lower()}: {[str(x.lidvid()) for x in delta_products]}")
-    report_new_paths(delta_products, delta_bundle_dir, merged_bundle_dir)
+    logger.info("%s to supersede: %d, to keep: %d, new: %d", label, len(products_to_supersede), len(products_to_keep), len(delta_products))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s to supersede: %s", label, [str(x.lidvid()) for x in products_to_supersede])
+        report_new_paths(products_to_supersede, previous_bundle_dir, merged_bundle_dir, True)
+        logger.debug("%s to keep: %s", label, [str(x.lidvid()) for x in products_to_keep])
+        report_new_paths(products_to_keep, previous_bundle_dir, merged_bundle_dir)
+        logger.debug("New %s: %s", label.lower(), [str(x.lidvid()) for x in delta_products])
+        report_new_paths(delta_products, delta_bundle_dir, merged_bundle_dir)
 
 
 def report_new_paths(products: List[pds4.Pds4Product], old_base, new_base, superseded=False) -> None:
@@ -220,10 +542,10 @@ def report_new_paths(products: List[pds4.Pds4Product], old_base, new_base, super
         vid = p.lidvid().vid
         versioned_path = paths.generate_product_path(p.label_path, superseded=superseded, vid=vid)
         new_path = paths.relocate_path(versioned_path, old_base, new_base)
-        logger.info(f"{p.lidvid()} will be moved to {new_path}")
+        logger.debug("%s will be moved to %s", p.lidvid(), new_path)
 
 
-def do_copy_label(products: Iterable[pds4.Pds4Product], old_base, new_base, dry: bool, superseded=False) -> None:
+def do_copy_label(products: Iterable[pds4.Pds4Product], old_base, new_base, writer: bundlewriter.BundleWriter, superseded=False) -> None:
     """
     Copies a label to a new directory. This will update the path to move it to the superseded directory if necessary.
     """
@@ -231,7 +553,7 @@ def do_copy_label(products: Iterable[pds4.Pds4Product], old_base, new_base, dry:
         vid = p.lidvid().vid
         versioned_path = paths.generate_product_path(p.label_path, superseded=superseded, vid=vid)
         new_path = paths.relocate_path(versioned_path, old_base, new_base)
-        copy_to_path(p.label_path, new_path, dry)
+        copy_to_path(p.label_path, new_path, writer)
 
 
 def copy_previously_superseded_products(
@@ -240,39 +562,40 @@ def copy_previously_superseded_products(
         bundles: Iterable[pds4.BundleProduct],
         old_base: str,
         new_base: str,
-        dry: bool):
+        writer: bundlewriter.BundleWriter):
     """
     Copies products that have already been superseded to a new directory. Since these have already been superseded,
     no manipulations to their path should be necessary.
     """
     logger.info(f"Copying already-superseded products from {old_base} to {new_base}")
     for bundle in bundles:
-        copy_to_path(bundle.label_path, paths.relocate_path(bundle.label_path, old_base, new_base), dry)
+        copy_to_path(bundle.label_path, paths.relocate_path(bundle.label_path, old_base, new_base), writer)
     for collection in collections:
-        copy_to_path(collection.label_path, paths.relocate_path(collection.label_path, old_base, new_base), dry)
-        copy_to_path(collection.inventory_path, paths.relocate_path(collection.inventory_path, old_base, new_base), dry)
+        copy_to_path(collection.label_path, paths.relocate_path(collection.label_path, old_base, new_base), writer)
+        copy_to_path(collection.inventory_path, paths.relocate_path(collection.inventory_path, old_base, new_base), writer)
     for product in products:
-        copy_to_path(product.label_path, paths.relocate_path(product.label_path, old_base, new_base), dry)
+        copy_to_path(product.label_path, paths.relocate_path(product.label_path, old_base, new_base), writer)
         for data_path in product.data_paths:
-            if os.path.exists(data_path):
-                copy_to_path(data_path, paths.relocate_path(data_path, old_base, new_base), dry)
+            if writer.exists(data_path):
+                copy_to_path(data_path, paths.relocate_path(data_path, old_base, new_base), writer)
 
 
-def copy_unmodified_collections(collections: Iterable[pds4.Pds4Product], old_base: str, new_base: str, dry: bool) -> None:
+def copy_unmodified_collections(collections: Iterable[pds4.Pds4Product], old_base: str, new_base: str, writer: bundlewriter.BundleWriter) -> None:
     """
     Copies collection labels and inventories that should be passed through as-is to a new directory
     """
     collections_to_copy = list(collections)
-    logger.info(f"Copying unmodified collections from {old_base} to {new_base} : {[str(x.label.identification_area.lidvid) for x in collections_to_copy]}")
-    for c in collections:
+    logger.info(f"Copying {len(collections_to_copy)} unmodified collections from {old_base} to {new_base}")
+    logger.debug("Unmodified collections: %s", [str(x.label.identification_area.lidvid) for x in collections_to_copy])
+    for c in collections_to_copy:
         if isinstance(c, pds4.CollectionProduct):
             new_path = paths.relocate_path(paths.generate_product_path(c.inventory_path), old_base, new_base)
-            copy_to_path(c.inventory_path, new_path, dry)
+            copy_to_path(c.inventory_path, new_path, writer)
         else:
-            logger.info(f'Skipping non-collection product: {c.lidvid()}')
+            logger.debug('Skipping non-collection product: %s', c.lidvid())
 
 
-def do_copy_inventory(collections: Iterable[pds4.Pds4Product], old_base, new_base, superseded=False, dry=False) -> None:
+def do_copy_inventory(collections: Iterable[pds4.Pds4Product], old_base, new_base, writer: bundlewriter.BundleWriter, superseded=False) -> None:
     """
     Copies the collection inventories of a collection product to a new directory
     """
@@ -283,28 +606,30 @@ def do_copy_inventory(collections: Iterable[pds4.Pds4Product], old_base, new_bas
             vid = c.lidvid().vid
             versioned_path = paths.generate_product_path(d, superseded=superseded, vid=vid)
             new_path = paths.relocate_path(versioned_path, old_base, new_base)
-            copy_to_path(d, new_path, dry)
+            copy_to_path(d, new_path, writer)
         else:
-            logger.info(f'Skipping non-collection product: {c.lidvid()}')
+            logger.debug('Skipping non-collection product: %s', c.lidvid())
 
 
-def do_copy_data(products: Iterable[pds4.Pds4Product], old_base, new_base, dry: bool, superseded=False) -> None:
+def do_copy_data(products: Iterable[pds4.Pds4Product], old_base, new_base, writer: bundlewriter.BundleWriter, superseded=False) -> None:
     """
     Copies the data files of a basic product to another directory
     """
-    logger.info(f"Copying data from {old_base} to {new_base}")
+    progress = Progress(logger, f"Copying data from {old_base} to {new_base}")
     for p in products:
+        progress.step()
         if isinstance(p, pds4.BasicProduct):
             for d in p.data_paths:
                 vid = p.lidvid().vid
                 versioned_path = paths.generate_product_path(d, superseded=superseded, vid=vid)
                 new_path = paths.relocate_path(versioned_path, old_base, new_base)
-                copy_to_path(d, new_path, dry)
+                copy_to_path(d, new_path, writer)
         else:
-            logger.info(f'Skipping non-basic product: {p.lidvid()}')
+            logger.debug('Skipping non-basic product: %s', p.lidvid())
+    progress.done()
 
 
-def do_copy_readme(products: Iterable[pds4.BundleProduct], old_base, new_base, superseded=False, dry = False) -> None:
+def do_copy_readme(products: Iterable[pds4.BundleProduct], old_base, new_base, writer: bundlewriter.BundleWriter, superseded=False) -> None:
     """
     Copies the readme file of a bundle product to another directory
     """
@@ -314,19 +639,15 @@ def do_copy_readme(products: Iterable[pds4.BundleProduct], old_base, new_base, s
             vid = p.lidvid().vid
             versioned_path = paths.generate_product_path(p.readme_path, superseded=superseded, vid=vid)
             new_path = paths.relocate_path(versioned_path, old_base, new_base)
-            copy_to_path(p.readme_path, new_path, dry)
+            copy_to_path(p.readme_path, new_path, writer)
 
 
-def copy_to_path(src_path: str, dest_path: str, dry: bool):
+def copy_to_path(src_path: str, dest_path: str, writer: bundlewriter.BundleWriter):
     """
-    Copies files from one path to another. Essentially a wrapper for shutil.copy that logs the copy operation
-    and makes sure that all of the parent directories exist.
+    Copies files from one path to another. Essentially a wrapper for the writer's copy operation, which logs the copy
+    operation and makes sure that all of the parent directories exist.
     """
-    logger.debug(f'{src_path} -> {dest_path}')
-    if not dry:
-        dirname = os.path.dirname(dest_path)
-        os.makedirs(dirname, exist_ok=True)
-        shutil.copy(src_path, dest_path)
+    writer.copy(src_path, dest_path)
 
 
 def find_products_to_supersede(previous_products: List[pds4.Pds4Product],
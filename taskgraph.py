@@ -0,0 +1,166 @@
+"""
+Runs a set of tasks with declared dependencies on shared pools of threads, and reports what limited the total runtime.
+
+Each task names the pool it runs on (CPU or I/O) and the tasks that must complete before it starts. A task starts as
+soon as its dependencies have completed and its pool has a free worker, so independent work from different stages
+runs interleaved. Without workers, the tasks run one after another in the order they were added, which must then
+respect their dependencies.
+
+Once the graph has run, its critical path is reconstructed from the recorded start and end times: starting from the
+task that finished last, each step goes back to whatever the task was waiting for when it started, either a
+dependency or the task that freed a worker in its pool.
+"""
+import concurrent.futures
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+CPU = "cpu"
+IO = "io"
+
+# How close a predecessor's end must be to a task's start for the task to have been waiting on it
+SLACK = 0.005
+
+
+@dataclass
+class Task:
+    name: str
+    function: Callable[[], None]
+    pool: str
+    dependencies: List[str]
+    ready: Optional[float] = None
+    start: Optional[float] = None
+    end: Optional[float] = None
+    dependents: List[str] = field(default_factory=list)
+
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class TaskGraph:
+    def __init__(self):
+        self.tasks: Dict[str, Task] = {}
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.workers: Dict[str, int] = {}
+
+    def add(self, name: str, function: Callable[[], None], pool: str = IO, after: Sequence[str] = ()) -> str:
+        """Adds a task that runs after the named tasks. Returns the name of the task, for use in later dependencies."""
+        if name in self.tasks:
+            raise Exception(f"Duplicate task: {name}")
+        for dependency in after:
+            if dependency not in self.tasks:
+                raise Exception(f"Task {name} depends on unknown task {dependency}")
+            self.tasks[dependency].dependents.append(name)
+        self.tasks[name] = Task(name, function, pool, list(after))
+        return name
+
+    def run(self, workers: Dict[str, int] = None) -> None:
+        """
+        Runs every task, with the given number of worker threads per pool. Without workers, the tasks run in the calling
+        thread in the order they were added. If a task fails, no further tasks are started, and the first error is
+        raised once the running tasks have completed.
+        """
+        self.started = time.monotonic()
+        try:
+            if not workers:
+                self.workers = {}
+                for task in self.tasks.values():
+                    task.ready = time.monotonic()
+                    self._run_task(task)
+            else:
+                self.workers = dict(workers)
+                self._run_concurrently()
+        finally:
+            self.finished = time.monotonic()
+
+    def _run_task(self, task: Task) -> None:
+        task.start = time.monotonic()
+        try:
+            task.function()
+        finally:
+            task.end = time.monotonic()
+
+    def _run_concurrently(self) -> None:
+        executors = dict((pool, concurrent.futures.ThreadPoolExecutor(max_workers=max(1, count), thread_name_prefix=f"phase-{pool}"))
+                         for pool, count in self.workers.items())
+        remaining = dict((name, len(task.dependencies)) for name, task in self.tasks.items())
+        running: Dict[concurrent.futures.Future, Task] = {}
+        error: Optional[BaseException] = None
+
+        def submit(task: Task) -> None:
+            task.ready = time.monotonic()
+            if task.pool not in executors:
+                raise Exception(f"Task {task.name} runs on a pool without workers: {task.pool}")
+            running[executors[task.pool].submit(self._run_task, task)] = task
+
+        try:
+            for name, count in remaining.items():
+                if count == 0:
+                    submit(self.tasks[name])
+            while running:
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        if error is None:
+                            error = future.exception()
+                            logger.error(f"Task {task.name} failed: {error}")
+                        continue
+                    if error is not None:
+                        continue
+                    for dependent in task.dependents:
+                        remaining[dependent] -= 1
+                        if remaining[dependent] == 0:
+                            submit(self.tasks[dependent])
+        finally:
+            for executor in executors.values():
+                executor.shutdown()
+        if error is not None:
+            raise error
+
+    def critical_path(self) -> List[Task]:
+        """The chain of tasks that determined the total runtime, in the order they ran"""
+        completed = [t for t in self.tasks.values() if t.end is not None]
+        if not completed:
+            return []
+        path = [max(completed, key=lambda t: t.end)]
+        while True:
+            task = path[-1]
+            if not self.workers:
+                candidates = [t for t in completed if t.end <= task.start + SLACK]
+            else:
+                candidates = [self.tasks[d] for d in task.dependencies]
+                if task.start - task.ready > SLACK:
+                    candidates += [t for t in completed if t.pool == task.pool and task.ready <= t.end <= task.start + SLACK]
+            # Predecessors started strictly earlier, so that tasks ending within the slack of each other cannot loop
+            candidates = [t for t in candidates if t.end is not None and t.start < task.start]
+            if not candidates:
+                break
+            path.append(max(candidates, key=lambda t: t.end))
+        return list(reversed(path))
+
+    def report(self) -> str:
+        """A table of the tasks on the critical path, and the utilization of each pool"""
+        total = (self.finished or time.monotonic()) - self.started
+        path = self.critical_path()
+        lines = [f"Critical path: {sum(t.duration() for t in path):.3f}s of {total:.3f}s total"]
+        lines.append(f"  {'task':<36} {'pool':<5} {'start':>8} {'end':>8} {'waited':>8}  waiting for")
+        previous = None
+        for task in path:
+            if previous is None:
+                reason = ""
+            elif previous.name in task.dependencies:
+                reason = f"dependency {previous.name}"
+            else:
+                reason = f"{task.pool if self.workers else 'serial'} worker"
+            lines.append(f"  {task.name:<36} {task.pool:<5} {task.start - self.started:8.3f} {task.end - self.started:8.3f} "
+                         f"{task.start - task.ready:8.3f}  {reason}")
+            previous = task
+        for pool, count in self.workers.items():
+            busy = sum(t.duration() for t in self.tasks.values() if t.pool == pool and t.end is not None)
+            lines.append(f"  {pool} pool: {count} worker{'s' if count != 1 else ''}, {100.0 * busy / max(count * total, 1e-9):.0f}% busy")
+        return "\n".join(lines)
@@ -0,0 +1,222 @@
+"""
+Throughput controls for the file I/O of an integration.
+
+An IOControl combines three limits:
+
+* a cap on the number of bytes read and written per second, shared by every thread
+* a cap on the number of files that are open at the same time
+* an adaptive limit on the number of copies that run concurrently. Starting from one copy, the limit is raised while
+  doing so raises the measured throughput, and lowered again when throughput drops or the latency of a single copy
+  exceeds its target. Once the bandwidth cap is reached, more concurrency no longer helps and the limit stops growing.
+
+Once a control is installed with install(), labels and inventories opened through open_file() are charged against it,
+and directory writers copy files on a pool of workers governed by it. Without an installed control, I/O is unchanged.
+"""
+import concurrent.futures
+import contextlib
+import logging
+import os
+import re
+import statistics
+import threading
+import time
+from typing import Callable, IO, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class Bandwidth:
+    """
+    A token bucket that limits the number of bytes transferred per second. Transfers may overdraw the bucket, so that
+    a transfer larger than the burst size can still proceed; the debt is paid by later transfers waiting.
+    """
+    def __init__(self, bytes_per_second: int, burst: int = None):
+        self.rate = bytes_per_second
+        self.burst = burst or bytes_per_second
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class FileSlots:
+    """A limit on the number of open files. Several slots are acquired at once, so that copies cannot deadlock."""
+    def __init__(self, limit: int):
+        if limit < 2:
+            raise Exception(f"The open file limit must be at least 2: {limit}")
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, count: int = 1):
+        with self.condition:
+            self.condition.wait_for(lambda: self.used + count <= self.limit)
+            self.used += count
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.used -= count
+                self.condition.notify_all()
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the number of concurrent operations, adjusting the limit once per measurement window. The limit grows by
+    one while the throughput of each window is at least a tenth higher than that of the last, and falls by one when it
+    is a tenth lower. If the median latency of the window exceeds the latency target, the limit is halved. Windows in
+    which no operation had to wait for a slot are not used, since their throughput is limited by demand rather than by
+    concurrency.
+    """
+    def __init__(self, maximum: int, minimum: int = 1, window: float = 1.0, latency_target: float = None):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = minimum
+        self.window = window
+        self.latency_target = latency_target
+        self.active = 0
+        self.waiting = 0
+        self.waited = False
+        self.condition = threading.Condition()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.window_latencies: List[float] = []
+        self.previous_throughput: Optional[float] = None
+        self.adjustments = 0
+
+    @contextlib.contextmanager
+    def slot(self, size: int):
+        with self.condition:
+            if self.active >= self.limit:
+                self.waited = True
+                self.waiting += 1
+                self.condition.wait_for(lambda: self.active < self.limit)
+                self.waiting -= 1
+            self.active += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.window_bytes += size
+                self.window_latencies.append(time.monotonic() - start)
+                if time.monotonic() - self.window_start >= self.window:
+                    self._adjust()
+                self.condition.notify_all()
+
+    def _adjust(self) -> None:
+        now = time.monotonic()
+        throughput = self.window_bytes / (now - self.window_start)
+        latency = statistics.median(self.window_latencies)
+        limit = self.limit
+        self.waited = self.waited or self.waiting > 0
+        if not self.waited:
+            pass
+        elif self.latency_target is not None and latency > self.latency_target:
+            limit = max(self.minimum, limit // 2)
+        elif self.previous_throughput is None or throughput >= self.previous_throughput * 1.1:
+            limit = min(self.maximum, limit + 1)
+        elif throughput < self.previous_throughput * 0.9:
+            limit = max(self.minimum, limit - 1)
+        if limit != self.limit:
+            logger.debug("Concurrency %d -> %d at %.1f MB/s, median latency %.3fs", self.limit, limit, throughput / UNITS["M"], latency)
+            self.adjustments += 1
+        if self.waited:
+            self.previous_throughput = throughput
+        self.limit = limit
+        self.waited = False
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_latencies = []
+
+
+class IOControl:
+    """
+    Applies the configured limits to file operations. Copies submitted to the control run on a pool of at most
+    max_workers threads, of which the adaptive limit decides how many are busy at a time.
+    """
+    def __init__(self, bytes_per_second: int = None, max_open_files: int = None, max_workers: int = 1, latency_target: float = None):
+        self.bandwidth = Bandwidth(bytes_per_second) if bytes_per_second else None
+        self.files = FileSlots(max_open_files) if max_open_files else None
+        self.concurrency = AdaptiveConcurrency(max_workers, latency_target=latency_target)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="io")
+        self.transferred = 0
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def charge(self, size: int) -> None:
+        """Accounts for a number of bytes read or written, waiting if the bandwidth cap has been reached"""
+        with self.lock:
+            self.transferred += size
+        if self.bandwidth is not None:
+            self.bandwidth.consume(size)
+
+    def hold_files(self, count: int = 1):
+        return self.files.hold(count) if self.files is not None else contextlib.nullcontext()
+
+    def submit(self, size: int, function: Callable[[], None]) -> concurrent.futures.Future:
+        """Runs an operation that transfers about size bytes on the worker pool, within the adaptive limit"""
+        def run():
+            with self.concurrency.slot(size):
+                function()
+        return self.executor.submit(run)
+
+    def copy_stream(self, infile: IO[bytes], outfile: IO[bytes]) -> None:
+        """Copies one file object to another in chunks, charging each chunk as it is copied"""
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            self.charge(len(chunk))
+            outfile.write(chunk)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.transferred / UNITS['M']:.1f} MB transferred at {self.transferred / elapsed / UNITS['M']:.1f} MB/s, "
+                f"final concurrency {self.concurrency.limit} after {self.concurrency.adjustments} adjustments")
+
+
+_control: Optional[IOControl] = None
+
+
+def install(control: Optional[IOControl]) -> None:
+    """Makes the given control apply to all file I/O of the process, or removes it if control is None"""
+    global _control
+    _control = control
+
+
+def current() -> Optional[IOControl]:
+    return _control
+
+
+@contextlib.contextmanager
+def open_file(path: str, mode: str = "r", newline: str = None):
+    """Opens a file for reading, charging the installed control for its size. Can be used in place of open."""
+    control = _control
+    if control is None:
+        with open(path, mode, newline=newline) as f:
+            yield f
+        return
+    with control.hold_files():
+        control.charge(os.path.getsize(path))
+        with open(path, mode, newline=newline) as f:
+            yield f
+
+
+def parse_size(size: str) -> int:
+    """Parses a number of bytes, optionally followed by K, M or G, e.g. 50M"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", size.upper())
+    if not match:
+        raise Exception(f"Invalid size: {size}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
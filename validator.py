@@ -1,3 +1,4 @@
+import functools
 import operator
 
 import pds4
@@ -5,9 +6,10 @@ import label
 import labeltypes
 import os.path
 import re
-from typing import Dict, Set, Iterable, List, Tuple
+from typing import Dict, Set, Iterable, List, Tuple, Optional
 
 from lids import Lid, LidVid
+from progress import Progress
 import logging
 
 logger = logging.getLogger(__name__)
@@ -180,7 +182,7 @@ def _check_lidvid_increment(previous_lidvid: LidVid, delta_lidvid: LidVid, same=
         * Increment the major version number and reset the minor version number to 0 e.g. 1.1 -> 2.0
     Flags control which of these methods we allow at the moment
     """
-    logger.info(f'Checking increment of {delta_lidvid} against {previous_lidvid}')
+    logger.debug('Checking increment of %s against %s', delta_lidvid, previous_lidvid)
     errors = []
     if previous_lidvid.vid.major > 0:
         allowed = ([previous_lidvid] if same else []) + \
@@ -295,48 +297,120 @@ def _check_bundle_for_latest_collections(bundle: labeltypes.ProductLabel, collec
     return errors
 
 
-def check_filename_consistency(previous_products: Iterable[pds4.BasicProduct], delta_products: Iterable[pds4.BasicProduct]) -> List[ValidationError]:
+class FilenameEntry:
+    """
+    The label and data file names of a product, with and without version information
+    """
+    def __init__(self, product: pds4.BasicProduct):
+        self.label_filename = os.path.basename(product.label_path)
+        self.unversioned_label_filename = unversioned_filename(self.label_filename)
+        self.data_filenames = set(os.path.basename(x) for x in product.data_paths)
+        self.unversioned_data_filenames = set(unversioned_filename(x) for x in self.data_filenames)
+
+
+class FilenameIndex:
+    """
+    Indexes the file names of a bundle's products by LID. The entry for each product is only computed the first
+    time it is needed, and is kept for later lookups, so an index can be built once for a previous bundle and reused
+    for every check against it.
+    """
+    def __init__(self, products: Iterable[pds4.BasicProduct]):
+        self.products = dict((x.lidvid().lid, x) for x in products)
+        self.entries: Dict[Lid, FilenameEntry] = {}
+
+    def get(self, lid: Lid) -> Optional[FilenameEntry]:
+        entry = self.entries.get(lid)
+        if entry is None:
+            product = self.products.get(lid)
+            if product is None:
+                return None
+            entry = self.entries[lid] = FilenameEntry(product)
+        return entry
+
+
+def check_labels_in_inventories(delta_products: Iterable[pds4.BasicProduct], delta_index: pds4.LidvidIndex) -> List[ValidationError]:
+    """
+    Checks that every basic product label in the delta bundle is listed by an inventory of a delta collection
+    """
+    return [ValidationError(f"Product {p.lidvid()} is not listed in the inventory of any delta collection: {p.label_path}", "product_not_in_inventory")
+            for p in delta_products
+            if p.lidvid() not in delta_index.members and p.lidvid() not in delta_index.secondary_members]
+
+
+def check_inventory_labels(delta_index: pds4.LidvidIndex, previous_index: pds4.LidvidIndex) -> List[ValidationError]:
+    """
+    Checks that every primary member listed by a delta collection inventory has a label in the delta bundle or in the
+    previous bundle
+    """
+    return [ValidationError(f"Collection {collection} lists {lidvid}, but neither bundle has a label for it", "inventory_entry_without_label")
+            for lidvid, collection in delta_index.members.items()
+            if lidvid not in delta_index.labels and lidvid not in previous_index.labels]
+
+
+def check_lid_collections(delta_index: pds4.LidvidIndex, previous_index: pds4.LidvidIndex) -> List[ValidationError]:
+    """
+    Checks that no product listed as a primary member by a delta collection is also listed as a primary member by a
+    different collection, in either bundle
+    """
     errors = []
-    previous_products_by_lid = dict((x.lidvid().lid, x) for x in previous_products)
-    superseding_products = (x for x in delta_products if x.lidvid().vid.is_superseding())
+    for lid, collections in delta_index.collections_by_lid.items():
+        all_collections = collections | previous_index.collections_by_lid.get(lid, set())
+        if len(all_collections) > 1:
+            errors.append(ValidationError(f"Product {lid} is listed by more than one collection: {sorted(str(x) for x in all_collections)}", "lid_in_multiple_collections"))
+    return errors
+
+
+def check_filename_consistency(previous_products: Iterable[pds4.BasicProduct], delta_products: Iterable[pds4.BasicProduct],
+                               previous_index: FilenameIndex = None) -> List[ValidationError]:
+    """
+    Checks that every superseding product in the delta bundle keeps the file names of the product it supersedes,
+    apart from version information. An index of the previous products may be supplied to avoid rebuilding it.
+    """
+    errors = []
+    previous_index = previous_index if previous_index is not None else FilenameIndex(previous_products)
+    superseding_products = [x for x in delta_products if x.lidvid().vid.is_superseding()]
+    progress = Progress(logger, "Checking filename consistency", len(superseding_products))
     for delta_product in superseding_products:
-        previous_product = previous_products_by_lid.get(delta_product.lidvid().lid)
-        if previous_product:
-            errors.extend(_do_check_filename_consistency(previous_product, delta_product))
+        progress.step()
+        previous_entry = previous_index.get(delta_product.lidvid().lid)
+        if previous_entry:
+            errors.extend(_compare_filenames(previous_entry, FilenameEntry(delta_product), delta_product.lidvid()))
         else:
             errors.append(ValidationError(f"Could not check filename consistency for {delta_product.lidvid()}. Previous product not found.", "previous_product_missing"))
+    progress.done()
     return errors
 
 
 def _do_check_filename_consistency(previous_product: pds4.BasicProduct, delta_product: pds4.BasicProduct):
+    return _compare_filenames(FilenameEntry(previous_product), FilenameEntry(delta_product), delta_product.lidvid())
+
+
+def _compare_filenames(previous: FilenameEntry, delta: FilenameEntry, delta_lidvid: LidVid) -> List[ValidationError]:
     errors = []
-    previous_label_filename = os.path.basename(previous_product.label_path)
-    delta_label_filename = os.path.basename(delta_product.label_path)
+    previous_label_filename = previous.label_filename
+    delta_label_filename = delta.label_filename
 
     if previous_label_filename != delta_label_filename:
         errors.append(ValidationError(f"New product filename has a different version from previous product. Was: {previous_label_filename}, Now: {delta_label_filename}", "product_filename_version_differs", "warning"))
 
-    if not filename_matches(previous_label_filename, delta_label_filename):
+    if previous.unversioned_label_filename != delta.unversioned_label_filename:
         errors.append(ValidationError(
             f"New product has inconsistent label filename. Was: {previous_label_filename}, Now: {delta_label_filename}", "product_inconsistent_filenames"))
     else:
-        logger.info(f"Label Filename check for {delta_product.lidvid()}: OK. Original Filename: {previous_label_filename}, Delta Filename: {delta_label_filename}")
+        logger.debug("Label Filename check for %s: OK. Original Filename: %s, Delta Filename: %s", delta_lidvid, previous_label_filename, delta_label_filename)
 
-    previous_data_filenames = set(os.path.basename(x) for x in previous_product.data_paths)
-    delta_data_filenames = set(os.path.basename(x) for x in delta_product.data_paths)
-
-    previous_unversioned_filenames = set(unversioned_filename(x) for x in previous_data_filenames)
-    delta_unversioned_filenames = set(unversioned_filename(x) for x in delta_data_filenames)
+    previous_data_filenames = previous.data_filenames
+    delta_data_filenames = delta.data_filenames
 
     if previous_data_filenames != delta_data_filenames:
         errors.append(ValidationError(
             f"New product data filenames have a different version from previous product. Was: {','.join(previous_data_filenames)}, Now: {','.join(delta_data_filenames)}", "data_filename_version_differs", "warning"))
 
-    if previous_unversioned_filenames != delta_unversioned_filenames:
+    if previous.unversioned_data_filenames != delta.unversioned_data_filenames:
         errors.append(ValidationError(
             f"New product has inconsistent data filenames. Was: {','.join(previous_data_filenames)}, Now: {','.join(delta_data_filenames)}", "data_inconsistent_filename"))
     else:
-        logger.info(f"Data filename check for {delta_product.lidvid()}: OK. Filenames: {','.join(delta_data_filenames)}")
+        logger.debug("Data filename check for %s: OK. Filenames: %s", delta_lidvid, delta_data_filenames)
     return errors
 
 
@@ -344,10 +418,14 @@ def filename_matches(previous_filename: str, delta_filename: str):
     return unversioned_filename(previous_filename) == unversioned_filename(delta_filename)
 
 
+_VERSION_SUFFIX = re.compile('_?[vV]?[0-9](\\.[0-9])*$')
+
+
+@functools.lru_cache(maxsize=1 << 20)
 def unversioned_filename(filename: str):
     root, ext = os.path.splitext(filename)
-    unversioned_root = re.sub('_?[vV]?[0-9](\\.[0-9])*$', '', root)
-    logger.info(f'Removed version information from {filename}: {unversioned_root}')
+    unversioned_root = _VERSION_SUFFIX.sub('', root)
+    logger.debug('Removed version information from %s: %s', filename, unversioned_root)
     if ext:
         return unversioned_root + '.' + ext
     return unversioned_root
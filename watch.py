@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Watches a delta bundle while it is being assembled, and re-checks its readiness whenever its files change.
+
+Only labels and inventories that were added, changed or deleted are re-parsed. The checks are the registered readiness
+rules, run by a rules.RuleRunner as ready.do_checkready runs them, but only the rules whose declared inputs have
+changed are run again. The results of every other rule are kept from the previous pass.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import Dict, List, Set, Tuple, Optional
+
+import bundleloader
+import pds4
+import rules
+import validator
+from ready import summarize_errors
+
+logger = logging.getLogger(__name__)
+
+FileState = Tuple[int, int]
+
+# The rule inputs that depend on each kind of delta product
+DELTA_INPUTS = {
+    pds4.BundleProduct: {"delta.bundles", "delta.labels"},
+    pds4.CollectionProduct: {"delta.collections", "delta.inventories", "delta.labels"},
+    pds4.BasicProduct: {"delta.products", "delta.labels"},
+}
+ALL_DELTA_INPUTS = set.union(*DELTA_INPUTS.values())
+
+
+def scan(path: str) -> Dict[str, FileState]:
+    """
+    Lists every file below a directory with its modification time and size
+    """
+    result = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                result.update(scan(entry.path))
+            elif entry.is_file():
+                stat = entry.stat()
+                result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+class DeltaWatcher:
+    """
+    Keeps an in-memory copy of a delta bundle that is updated file by file, along with the results of every rule
+    that has been run against it.
+    """
+    def __init__(self, previous_fullbundle: pds4.FullBundle, delta_bundle_directory: str, jaxa: bool,
+                 runner: rules.RuleRunner = None):
+        self.previous_fullbundle = previous_fullbundle
+        self.path = delta_bundle_directory
+        self.jaxa = jaxa
+        self.runner = runner or rules.RuleRunner()
+        self.files: Dict[str, FileState] = {}
+        self.products: Dict[str, pds4.Pds4Product] = {}
+        self.parse_errors: Dict[str, validator.ValidationError] = {}
+
+        self.results: Dict[str, List[validator.ValidationError]] = {}
+        self.changed_inputs: Set[str] = set()
+
+    def poll(self) -> bool:
+        """
+        Looks for changed files and updates the delta bundle. Returns True if anything changed.
+        """
+        files = scan(self.path)
+        changed = set(p for p, state in files.items() if self.files.get(p) != state)
+        deleted = set(self.files.keys()) - set(files.keys())
+        self.files = files
+        if not changed and not deleted:
+            return False
+
+        inventory_owners = dict((p.inventory_path, label_path) for label_path, p in self.products.items()
+                                if isinstance(p, pds4.CollectionProduct))
+        labels_to_load = set(p for p in changed if p.endswith(".xml"))
+        labels_to_load.update(inventory_owners[p] for p in changed | deleted if p in inventory_owners and inventory_owners[p] in files)
+        # A label that could not be loaded may have been missing a file that it refers to, such as the inventory of a
+        # collection, whose path is not known until the label loads. Those are retried when their directory changes.
+        changed_directories = set(os.path.dirname(p) for p in changed | deleted)
+        labels_to_load.update(p for p in self.parse_errors if p in files and os.path.dirname(p) in changed_directories)
+        labels_to_drop = set(p for p in deleted if p.endswith(".xml"))
+
+        logger.info(f"Detected {len(changed)} changed and {len(deleted)} deleted files. Reloading {len(labels_to_load)} labels")
+        for label_path in labels_to_drop:
+            self._invalidate(self.products.pop(label_path, None))
+            self.parse_errors.pop(label_path, None)
+        for label_path in labels_to_load:
+            self._invalidate(self.products.pop(label_path, None))
+            self.parse_errors.pop(label_path, None)
+            try:
+                self.products[label_path] = bundleloader.load_local_product(label_path)
+            except Exception as e:
+                self.parse_errors[label_path] = validator.ValidationError(f"Could not load {label_path}: {e}", "unloadable_label")
+            self._invalidate(self.products.get(label_path))
+        return True
+
+    def fullbundle(self) -> Optional[pds4.FullBundle]:
+        """
+        Assembles the current state of the delta bundle, or returns None if it does not have a bundle label yet
+        """
+        def select(kind: type, superseded: bool) -> List:
+            return [p for path, p in sorted(self.products.items())
+                    if type(p) is kind and bundleloader.is_superseded(path) == superseded]
+
+        bundles = select(pds4.BundleProduct, False)
+        if not bundles:
+            return None
+        return pds4.FullBundle(self.path, bundles, select(pds4.BundleProduct, True), select(pds4.CollectionProduct, False),
+                               select(pds4.CollectionProduct, True), select(pds4.BasicProduct, False), select(pds4.BasicProduct, True))
+
+    def check(self) -> List[validator.ValidationError]:
+        """
+        Checks the readiness of the delta bundle with the registered rules, in the same way as ready.do_checkready,
+        but only re-running the rules whose inputs have changed
+        """
+        delta_fullbundle = self.fullbundle()
+        if delta_fullbundle is None:
+            logger.warning(f"Could not find bundle product in: {self.path}")
+            return list(self.parse_errors.values())
+
+        for name in list(self.results.keys()):
+            if self.changed_inputs.intersection(rules.RULES[name].inputs):
+                del self.results[name]
+        self.changed_inputs = set()
+        return list(self.parse_errors.values()) + self.runner.run(self.previous_fullbundle, delta_fullbundle, self.jaxa, self.results)
+
+    def _invalidate(self, product: Optional[pds4.Pds4Product]) -> None:
+        """
+        Marks the rule inputs that depend on a product as changed. A label that could not be loaded may have been any
+        kind of product, so it changes all of them.
+        """
+        self.changed_inputs.update(DELTA_INPUTS.get(type(product), ALL_DELTA_INPUTS))
+
+
+def report(errors: List[validator.ValidationError], elapsed: float) -> None:
+    if errors:
+        logger.info(f"Error summary:\n{summarize_errors(errors)}\nTotal: {len(errors)} (checked in {elapsed:.2f}s)")
+    else:
+        logger.info(f"No errors encountered (checked in {elapsed:.2f}s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("previous_bundle_directory", type=str)
+    parser.add_argument("delta_bundle_directory", type=str)
+    parser.add_argument("-j", "--jaxa", action="store_true")
+    parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("-l", "--logfile", type=str)
+    parser.add_argument("-i", "--interval", type=float, default=2.0)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename=args.logfile,
+        format='%(asctime)s;%(levelname)s;%(name)s; %(message)s',
+        level=logging.DEBUG if args.debug else logging.INFO)
+    logger.info(f'Previous Bundle Directory: {args.previous_bundle_directory}')
+    logger.info(f'Watching Delta Bundle Directory: {args.delta_bundle_directory}')
+
+    previous_fullbundle = bundleloader.load_local_bundle(args.previous_bundle_directory)
+    watcher = DeltaWatcher(previous_fullbundle, args.delta_bundle_directory, args.jaxa)
+    try:
+        while True:
+            start = time.monotonic()
+            if watcher.poll():
+                report(watcher.check(), time.monotonic() - start)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")
+
+
+if __name__ == "__main__":
+    sys.exit(main())